@@ -70,13 +70,15 @@ setup_args = dict(
     # Optional requirements
     extras_require={
         "test": ["pytest", "nose", "coverage"],
+        "arrow": ["pyarrow"],
     },
     setup_requires=["pytest-runner"],
     tests_require=["pytest"],
     entry_points={
         "console_scripts": [
             "pii-extract-transformers-info = pii_extract_plg_transformers.app.info:main",
-            "pii-extract-transformers-detect = pii_extract_plg_transformers.app.detect:main"
+            "pii-extract-transformers-detect = pii_extract_plg_transformers.app.detect:main",
+            "pii-extract-transformers-model = pii_extract_plg_transformers.app.model:main"
         ],
         "pii_extract.plugins": "piisa-detectors-transformers = pii_extract_plg_transformers.plugin_loader:PiiExtractPluginLoader"
     },
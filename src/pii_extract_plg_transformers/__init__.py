@@ -1 +1 @@
-VERSION = "0.1.3"
+VERSION = "0.2.0"
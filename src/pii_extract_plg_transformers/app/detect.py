@@ -5,9 +5,10 @@ Command-line test script to launch the detection process on a text buffer
 import sys
 import argparse
 
-from typing import List, Iterable
+from typing import Dict, List, Iterable
 
-from pii_data.types.doc import DocumentChunk
+from pii_data.helper.exception import ConfigException
+from pii_data.types.doc import DocumentChunk, LocalSrcDocumentFile
 from pii_data.types.piicollection import PiiDetector, PiiCollection
 
 from pii_extract.build.task import BasePiiTask
@@ -16,6 +17,9 @@ from pii_extract.gather.parser import parse_task_descriptor
 
 from .. import VERSION
 from ..task.collector import TaskCollector
+from ..task.document import detect_documents
+from ..task.textfile import text_file_chunks, CHUNK_SIZE
+from ..task.columnar import ColumnarWriter, FORMATS
 from ..plugin_loader import load_plugin_config
 
 
@@ -28,12 +32,21 @@ def parse_args(args: List[str]) -> argparse.Namespace:
     g00 = g0.add_mutually_exclusive_group(required=True)
     g00.add_argument("--input-data", help="string to process")
     g00.add_argument("--input-file", help="text file to process")
+    g00.add_argument("--input-doc", nargs="+",
+                     help="pii-data source document file(s) to process")
     g0.add_argument("--outfile", help="destination file")
+    g0.add_argument("--output-format", choices=("jsonl",) + FORMATS,
+                    default="jsonl",
+                    help="output format; arrow (Arrow IPC) and parquet write columnar results, for --input-data and --input-file (default: %(default)s)")
 
     g1 = parser.add_argument_group("Specification")
     g1.add_argument("--lang", help="set document language")
     g1.add_argument("--configfile", "--config", nargs="+",
                     help="add a custom configuration file")
+    g1.add_argument("--batch-size", type=int,
+                    help="chunks per pipeline call, for source documents and text files")
+    g1.add_argument("--chunk-size", type=int, default=CHUNK_SIZE,
+                    help="maximum chunk size (in bytes) to split text files into (default: %(default)s)")
 
     g3 = parser.add_argument_group("Other")
     g3.add_argument("--debug", action="store_true", help="debug mode")
@@ -63,18 +76,142 @@ def create_task_object(config, lang: Iterable[str],
     return build_task(taskdef)
 
 
+def process_documents(input_doc: List[str], outfile: str = None,
+                      lang: str = None, configfile: str = None,
+                      batch_size: int = None, debug: bool = False):
+    """
+    Do the processing over source documents, producing one PII collection
+    per document
+    """
+    config = load_plugin_config(configfile)
+    task = create_task_object(config, lang, debug)
+
+    # Documents are loaded one at a time, as their chunks are needed
+    docs = (LocalSrcDocumentFile(name) for name in input_doc)
+    results = detect_documents(task, docs, lang=lang, batch_size=batch_size)
+
+    out = open(outfile, "w", encoding="utf-8") if outfile else None
+    try:
+        for doc, piic in results:
+            if debug:
+                print(f"# Document {doc.id}: {len(piic)} entities",
+                      file=sys.stderr)
+            if out:
+                piic.dump(out, format="jsonl")
+                continue
+            print(f". Document {doc.id}")
+            for pii in piic:
+                for n, v in pii.asdict().items():
+                    print(f"{n:>12}", v)
+                print()
+    finally:
+        if out:
+            out.close()
+
+
+def process_file(input_file: str, outfile: str = None, lang: str = None,
+                 configfile: str = None, batch_size: int = None,
+                 chunk_size: int = CHUNK_SIZE, debug: bool = False):
+    """
+    Do the processing over a text file, split into chunks read lazily from
+    a memory-mapped view of the file. Entities are reported as in a single
+    chunk for the whole file (i.e. with their positions relative to it)
+    """
+    config = load_plugin_config(configfile)
+    task = create_task_object(config, lang, debug)
+
+    tinfo = task.task_info
+    det = PiiDetector(source=tinfo.source, name=tinfo.name,
+                      version=tinfo.version, method=tinfo.method)
+    piic = PiiCollection(lang=lang, docid=input_file)
+
+    # Perform detection
+    chunks = text_file_chunks(input_file, lang, max_bytes=chunk_size)
+    for chunk, pii_list in task.find_chunks(chunks, batch_size):
+        offset = chunk.context["offset"]
+        for pii in pii_list:
+            pii.pos += offset
+            pii.fields["chunkid"] = "1"
+            piic.add(pii, det)
+    if debug:
+        print("# Entities detected:", len(piic), file=sys.stderr)
+
+    # Save results
+    if outfile:
+        with open(outfile, "w", encoding="utf-8") as f:
+            piic.dump(f, format="jsonl")
+        return
+
+    # Print out
+    for pii in piic:
+        for n, v in pii.asdict().items():
+            print(f"{n:>12}", v)
+        print()
+
+
+def process_columns(chunks: Iterable[DocumentChunk], outfile: str, fmt: str,
+                    lang: str = None, configfile: str = None,
+                    batch_size: int = None, debug: bool = False,
+                    metadata: Dict = None):
+    """
+    Do the processing over a sequence of chunks, writing the results as
+    columns into an Arrow IPC or Parquet file. If the chunks have an
+    `offset` field in their context, it is added to the entity positions
+    """
+    if not outfile:
+        raise ConfigException("an output file is needed for {} output", fmt)
+    config = load_plugin_config(configfile)
+    task = create_task_object(config, lang, debug)
+
+    offsets = []
+
+    def track(chunks):
+        for chunk in chunks:
+            offsets.append((chunk.context or {}).get("offset", 0))
+            yield chunk
+
+    if debug:
+        print("# Saving to:", outfile, file=sys.stderr)
+    with ColumnarWriter(outfile, task.entity_types(), fmt, metadata) as out:
+        for res in task.find_columns(track(chunks), batch_size):
+            res.shift(offsets)
+            out.write(res)
+    if debug:
+        print("# Entities detected:", out.num, file=sys.stderr)
+
+
 def process(input_data: str = None, input_file: str = None, outfile: str = None,
             lang: str = None, configfile: str = None, debug: bool = False,
-            **kwargs):
+            input_doc: List[str] = None, **kwargs):
     """
     Do the processing
     """
-    # Read data
+    fmt = kwargs.get("output_format") or "jsonl"
+    if fmt != "jsonl":
+        if input_doc:
+            raise ConfigException("{} output is not available for source documents",
+                                  fmt)
+        if input_file:
+            chunks = text_file_chunks(input_file, lang,
+                                      kwargs.get("chunk_size") or CHUNK_SIZE)
+            meta = {"docid": input_file}
+        else:
+            chunks = [DocumentChunk(id="1", data=input_data,
+                                    context={"lang": lang})]
+            meta = None
+        return process_columns(chunks, outfile, fmt, lang, configfile,
+                               kwargs.get("batch_size"), debug, meta)
+
+    if input_doc:
+        return process_documents(input_doc, outfile, lang, configfile,
+                                 kwargs.get("batch_size"), debug)
+
     if input_file:
         if debug:
-            print("# Loading text:", input_file, file=sys.stderr)
-        with open(input_file, encoding="utf-8") as f:
-            input_data = f.read()
+            print("# Processing text file:", input_file, file=sys.stderr)
+        return process_file(input_file, outfile, lang, configfile,
+                            kwargs.get("batch_size"),
+                            kwargs.get("chunk_size") or CHUNK_SIZE, debug)
 
     # Create the task
     config = load_plugin_config(configfile)
@@ -3,10 +3,11 @@ Command-line script to show information about the plugin
 """
 
 import sys
+import json
 import argparse
-from operator import itemgetter
+from time import perf_counter
 
-from typing import List, TextIO
+from typing import Dict, List, TextIO
 
 from pii_data import VERSION as VERSION_DATA
 from pii_data.helper.exception import ProcException
@@ -21,8 +22,10 @@ from pii_extract.build.build import build_task
 from .. import VERSION
 from .. import defs
 from ..plugin_loader import load_plugin_config
-from ..task.utils import hf_cachedir, transformers_version
+from ..task.utils import hf_cachedir, transformers_version, \
+    package_languages, process_rss
 from ..task import TaskCollector
+from ..model.autotune import VARIANTS, BATCH_SIZES, AGGREGATIONS
 
 
 class Processor:
@@ -61,20 +64,95 @@ class Processor:
             print(f"{n:>25}: {v}")
 
 
+    def _model_report(self) -> List[Dict]:
+        """
+        Load the pipelines one language at a time, and collect their
+        footprint information
+        """
+        task_config = load_plugin_config(self.args.config)[defs.CFG_TASK]
+        hf_cachedir(task_config.get("cachedir"))
+        languages = self.args.lang or sorted(package_languages(task_config))
+        try:
+            from ..task import pipeline as mod_pl
+            from ..model.footprint import pipeline_footprint
+            from ..model.compile import compile_stats
+
+            report = []
+            for lang in languages:
+                rss = process_rss()
+                start = perf_counter()
+                pp = mod_pl.create_pipelines(task_config, languages=[lang],
+                                             logger=self.log).get(lang)
+                if pp is None:
+                    continue
+                elapsed = perf_counter() - start
+                compiled = compile_stats(pp.model)
+                ctime = compiled["compile_time_total"] if compiled else 0
+                cfg = pp.model.config
+                report.append({
+                    "lang": lang,
+                    "class": pp.model.__class__.__name__,
+                    "type": getattr(cfg, "model_type", ""),
+                    "name": getattr(cfg, "_name_or_path", ""),
+                    "load_time": elapsed - ctime,
+                    "compile_time": ctime if compiled else None,
+                    "compiled": compiled["buckets"] if compiled else None,
+                    "rss_before": rss,
+                    "rss_after": process_rss(),
+                    "cache_key": mod_pl.ENGINE_CACHE.model_key(pp.model),
+                    **pipeline_footprint(pp)
+                })
+        except Exception as e:
+            raise ProcException("cannot create Transformers pipelines: {}",
+                                e) from e
+
+        # Languages sharing the same cached model objects
+        for r in report:
+            r["shared_with"] = [o["lang"] for o in report
+                                if o is not r and r["cache_key"]
+                                and o["cache_key"] == r["cache_key"]]
+        return report
+
+
     def proc_models(self, out: TextIO):
         """
-        Print Transformers models loaded
+        Print Transformers models loaded, with their footprint
         """
-        print(f". Available pipelines (lang={self.args.lang})", flush=True)
-        pipelines = self._init_pipelines()
-        param = {"type": "model_type", "name": "_name_or_path"}
-        for lang, pp in sorted(pipelines.items(), key=itemgetter(0)):
-            name = pp.model.__class__.__name__
-            cfg = pp.model.config
-            print(f"{lang}:   {name}")
-            for f, a in param.items():
-                print(f"{f:>10}:", getattr(cfg, a, ""))
-            #print(pp.model.config)
+        if not self.args.json:
+            print(f". Available pipelines (lang={self.args.lang})", flush=True)
+        report = self._model_report()
+        if self.args.json:
+            json.dump(report, out, indent=2)
+            print(file=out)
+            return
+
+        def mb(v):
+            return "n/a" if v is None else f"{v/2**20:.1f} MB"
+
+        for r in report:
+            print(f"{r['lang']}:   {r['class']}", file=out)
+            print(f"{'type':>14}:", r["type"], file=out)
+            print(f"{'name':>14}:", r["name"], file=out)
+            if "params" in r:
+                print(f"{'params':>14}: {r['params']:,}", file=out)
+                print(f"{'weights':>14}:", mb(r["bytes"]), "(" +
+                      ", ".join(f"{k} {mb(v)}" for k, v in r["bytes_by_dtype"].items())
+                      + ")", file=out)
+                print(f"{'embeddings':>14}: {mb(r['embedding_bytes'])} ({r['embedding_share']:.1%})",
+                      file=out)
+                print(f"{'encoder':>14}: {mb(r['encoder_bytes'])} ({r['encoder_share']:.1%})",
+                      file=out)
+            print(f"{'vocabulary':>14}:", r["vocab_size"], file=out)
+            print(f"{'max length':>14}:", r["max_length"], file=out)
+            print(f"{'load time':>14}: {r['load_time']:.2f} s", file=out)
+            if r["compiled"]:
+                print(f"{'compile time':>14}: {r['compile_time']:.2f} s (lengths:",
+                      ", ".join(map(str, r["compiled"])) + ")", file=out)
+            print(f"{'rss':>14}:", mb(r["rss_before"]), "->",
+                  mb(r["rss_after"]), file=out)
+            if r["shared_with"]:
+                print(f"{'shared with':>14}:", ", ".join(r["shared_with"]),
+                      "(engine cache)", file=out)
 
 
     def proc_model_entities(self, out: TextIO):
@@ -93,6 +171,174 @@ class Processor:
             raise ProcException("cannot get model labels: {}", e) from e
 
 
+    def proc_execution(self, out: TextIO):
+        """
+        Print the execution settings in the configuration, and the ones in
+        effect once they are applied
+        """
+        from ..task.execution import apply_execution, execution_info
+
+        config = load_plugin_config(self.args.config)
+        options = config[defs.CFG_TASK].get("execution") or {}
+        apply_execution(options, self.log)
+        info = execution_info()
+        if self.args.json:
+            json.dump({"config": options, **info}, out, indent=2)
+            print(file=out)
+            return
+
+        print(". Execution settings", file=out)
+        print(f"{'configured':>24}:", options or "none", file=out)
+        print(f"{'CPUs':>24}:", info["cpu_count"], file=out)
+        affinity = info["cpu_affinity"]
+        print(f"{'CPU affinity':>24}:",
+              "n/a" if affinity is None else ",".join(map(str, affinity)),
+              file=out)
+        for f in ("intra_op_threads", "inter_op_threads"):
+            print(f"{f.replace('_', ' '):>24}:", info.get(f, "n/a"), file=out)
+        print(f"{'tokenizer parallelism':>24}:",
+              info["tokenizer_parallelism"] or "default", file=out)
+        print(f"{'grad mode':>24}:", options.get("grad_mode", "inference"),
+              file=out)
+
+
+    def proc_autotune(self, out: TextIO):
+        """
+        Find the fastest settings for the model of a language over a sample
+        corpus, and write them as a configuration overlay
+        """
+        from ..model.autotune import autotune
+        from ..model.utils import read_corpus
+
+        config = load_plugin_config(self.args.config)
+        hf_cachedir(config[defs.CFG_TASK].get("cachedir"))
+        texts = read_corpus(self.args.corpus, self.args.sample)
+        lang = self.args.lang[0]
+        print(f". Autotuning model for lang={lang} ({len(texts)} texts)",
+              file=sys.stderr, flush=True)
+        overlay, report = autotune(config, lang, texts,
+                                   variants=self.args.variants,
+                                   batch_sizes=self.args.batch_sizes,
+                                   aggregations=self.args.aggregations,
+                                   min_agreement=self.args.min_agreement,
+                                   max_p95=self.args.max_p95, logger=self.log)
+
+        print(f"  {'candidate':24} {'texts/s':>9} {'p50':>8} {'p95':>8} {'f1':>7}",
+              file=sys.stderr)
+        for r in report:
+            if "error" in r:
+                print(f"  {r['candidate']:24} error: {r['error']}",
+                      file=sys.stderr)
+                continue
+            flag = "" if r["accepted"] else "  rejected"
+            print(f"  {r['candidate']:24} {r['texts_per_sec']:9.2f} {r['p50']:8.4f} {r['p95']:8.4f} {r['f1']:7.4f}{flag}",
+                  file=sys.stderr)
+
+        if self.args.report:
+            with open(self.args.report, "w", encoding="utf-8") as f:
+                json.dump(report, f, indent=2)
+        if self.args.output:
+            with open(self.args.output, "w", encoding="utf-8") as f:
+                json.dump(overlay, f, indent=2)
+            print(". Overlay written into", self.args.output, file=sys.stderr)
+        else:
+            json.dump(overlay, out, indent=2)
+            print(file=out)
+
+
+    def _cache_entries(self, config: Dict) -> List[Dict]:
+        """
+        Return the model entries to be cached (including cascade models)
+        """
+        entries, seen = [], set()
+        for m in config.get(defs.CFG_TASK_MODELS, []):
+            if self.args.lang and m["lang_code"] not in self.args.lang:
+                continue
+            for e in m, m.get("cascade"):
+                if not e:
+                    continue
+                key = (e["model"], e.get("tokenizer"), e.get("trimmed"),
+                       e.get("format"))
+                if key not in seen:
+                    seen.add(key)
+                    entries.append(e)
+        return entries
+
+
+    def _cache_fetch(self, name: str, out: TextIO) -> str:
+        """
+        Fetch a model or tokenizer into the cache, and verify its files
+        """
+        from ..model.cache import fetch, verify_snapshot, verify_checksums, \
+            dir_size, CHECKSUMS
+
+        path, snapshot = fetch(name, self.args.mirror)
+        if snapshot:
+            bad = verify_snapshot(path)
+        elif (path / CHECKSUMS).is_file():
+            bad = verify_checksums(path)
+        else:
+            bad = None
+        print(f"   {'path':>10}: {path}", file=out)
+        print(f"   {'disk':>10}: {dir_size(path)/2**20:.1f} MB", file=out)
+        print(f"   {'checksums':>10}:",
+              "n/a" if bad is None else "ERROR" if bad else "ok", file=out)
+        if bad:
+            raise ProcException("checksum mismatch for {}: {}", name,
+                                ", ".join(bad))
+        return str(path)
+
+
+    def proc_cache(self, out: TextIO):
+        """
+        Fetch the configured models into the cache, convert them to the
+        requested formats, and verify them
+        """
+        config = load_plugin_config(self.args.config)[defs.CFG_TASK]
+        hf_cachedir(config.get("cachedir"))
+
+        from ..model.cache import convert, verify_checksums, dir_size
+        from ..model.trim import trimmed_path
+        from ..task.pipeline import _load_model, model_bytes
+
+        print(f". Preparing the model cache (lang={self.args.lang})",
+              file=out, flush=True)
+        for m in self._cache_entries(config):
+            name = m["model"]
+            print(f"{name}", file=out, flush=True)
+            mdpath = self._cache_fetch(name, out)
+            tkname = m.get("tokenizer")
+            tkpath = None
+            if tkname and tkname != name:
+                print(f"  tokenizer {tkname}", file=out)
+                tkpath = self._cache_fetch(tkname, out)
+            if m.get("trimmed"):
+                mdpath = tkpath = str(trimmed_path(name))
+            model = _load_model(mdpath, None, m.get("model_params", {}))
+            print(f"   {'memory':>10}: {model_bytes(model)/2**20:.1f} MB",
+                  file=out)
+            del model
+
+            formats = set(self.args.convert or [])
+            if m.get("format"):
+                formats.add(m["format"])
+            for fmt in sorted(formats):
+                print(f"  format {fmt}", file=out, flush=True)
+                path = convert(m, fmt, mdpath, tkpath)
+                bad = verify_checksums(path)
+                if bad:
+                    raise ProcException("checksum mismatch for {} {}: {}",
+                                        name, fmt, ", ".join(bad))
+                model = _load_model(str(path), fmt, {})
+                mem = model_bytes(model)
+                print(f"   {'path':>10}: {path}", file=out)
+                print(f"   {'disk':>10}: {dir_size(path)/2**20:.1f} MB",
+                      file=out)
+                print(f"   {'memory':>10}:",
+                      f"{mem/2**20:.1f} MB" if mem else "n/a", file=out)
+                del model
+
+
     def proc_pii_entities(self, out: TextIO):
         """
         Print entity recognizers
@@ -155,11 +401,49 @@ def parse_args(args: List[str]) -> argparse.Namespace:
     subp1 = subp.add_parser('models',
                             help='information about configured models',
                             parents=[opt_com1, opt_com3])
+    subp1.add_argument("--json", action="store_true",
+                       help="produce JSON output")
 
     subp1 = subp.add_parser('model-entities',
                             help='information about entities defined in Transformer models',
                             parents=[opt_com1, opt_com3])
 
+    subp1 = subp.add_parser('execution',
+                            help='execution settings (threads, CPU affinity) for the models',
+                            parents=[opt_com1, opt_com3])
+    subp1.add_argument("--json", action="store_true",
+                       help="produce JSON output")
+
+    subp1 = subp.add_parser('autotune',
+                            help='find the fastest settings for a model over a sample corpus',
+                            parents=[opt_com1, opt_com3])
+    subp1.add_argument("--corpus", nargs="+", required=True,
+                       help="sample corpus file(s), one text per line")
+    subp1.add_argument("--sample", type=int, default=200,
+                       help="maximum number of texts to use (default: %(default)s)")
+    subp1.add_argument("--min-agreement", type=float, default=0.99,
+                       help="minimum entity F1 against the fp32 eager model (default: %(default)s)")
+    subp1.add_argument("--max-p95", type=float,
+                       help="maximum p95 batch latency, in seconds")
+    subp1.add_argument("--variants", nargs="+", default=VARIANTS,
+                       choices=VARIANTS, help="model variants to try")
+    subp1.add_argument("--batch-sizes", nargs="+", type=int,
+                       default=BATCH_SIZES, help="batch sizes to try")
+    subp1.add_argument("--aggregations", nargs="+", default=AGGREGATIONS,
+                       choices=AGGREGATIONS,
+                       help="aggregation strategies to try")
+    subp1.add_argument("--output", help="file to write the configuration overlay into")
+    subp1.add_argument("--report", help="file to write the candidate measurements into")
+
+    subp1 = subp.add_parser('cache',
+                            help='fetch, convert and verify the configured models in the cache',
+                            parents=[opt_com1, opt_com3])
+    subp1.add_argument("--mirror",
+                       help="local folder to take the models from (instead of the Hub)")
+    subp1.add_argument("--convert", nargs="+",
+                       choices=("safetensors", "quantized", "onnx"),
+                       help="convert the models also to these formats")
+
     subp1 = subp.add_parser('pii-entities',
                             help='information about PII tasks defined via the plugin',
                             parents=[opt_com1, opt_com3])
@@ -168,6 +452,8 @@ def parse_args(args: List[str]) -> argparse.Namespace:
     if not parsed.cmd:
         parser.print_usage()
         sys.exit(1)
+    elif parsed.cmd == "autotune" and (not parsed.lang or len(parsed.lang) != 1):
+        parser.error("autotune needs a single --lang")
     return parsed
 
 
@@ -0,0 +1,283 @@
+"""
+Command-line script to build optimized versions of the configured models
+"""
+
+import sys
+import json
+import argparse
+
+from typing import Dict, List, TextIO
+
+from pii_data.helper.exception import ProcException
+from pii_data.helper.logger import PiiLogger
+
+from .. import VERSION
+from .. import defs
+from ..plugin_loader import load_plugin_config
+from ..task.utils import hf_cachedir
+from ..model.utils import read_corpus, compare_pipelines
+
+
+class Processor:
+
+    def __init__(self, args: argparse.Namespace, debug: bool = False):
+        self.args = args
+        self.debug = debug
+        self.log = PiiLogger(__name__, debug=True) if debug else None
+        self.plugin_config = load_plugin_config(args.config)
+        self.config = self.plugin_config[defs.CFG_TASK]
+        hf_cachedir(self.config.get("cachedir"))
+
+
+    def _models(self) -> Dict[str, Dict]:
+        """
+        Return the configured model entries (for the selected languages),
+        indexed by model name, and the languages each one is used for
+        """
+        models = {}
+        for m in self.config.get(defs.CFG_TASK_MODELS, []):
+            if self.args.lang and m["lang_code"] not in self.args.lang:
+                continue
+            name = m["model"]
+            if name not in models:
+                models[name] = {"entry": m, "lang": set()}
+            models[name]["lang"].add(m["lang_code"])
+        return models
+
+
+    def _pipeline(self, m: Dict, **options):
+        """
+        Create a pipeline for a model entry, with some modified options
+        """
+        from ..task.pipeline import create_pipelines
+        cfg = {**self.config, defs.CFG_TASK_REUSE: False,
+               defs.CFG_TASK_MODELS: [{**m, **options}]}
+        return create_pipelines(cfg)[m["lang_code"]]
+
+
+    def _verify(self, m: Dict, out: TextIO, **options):
+        """
+        Compare the results of a modified model against the original one,
+        over the validation sample
+        """
+        texts = read_corpus(self.args.validation or
+                            getattr(self.args, "corpus", None) or [],
+                            self.args.sample)
+        if not texts:
+            return
+        print(f"   validation: {len(texts)} texts", file=out, flush=True)
+        res = compare_pipelines(self._pipeline(m), self._pipeline(m, **options),
+                                texts)
+        for f in ("equal", "precision", "recall", "f1"):
+            print(f"   {f:>12}: {res[f]:.4f}", file=out)
+        if res["equal"] < self.args.min_agreement:
+            raise ProcException("validation failed: agreement {:.4f} < {}",
+                                res["equal"], self.args.min_agreement)
+
+
+    def proc_trim(self, out: TextIO):
+        """
+        Build trimmed-vocabulary versions of the models
+        """
+        from ..model.trim import build_trimmed_model
+
+        texts = read_corpus(self.args.corpus)
+        for name, m in self._models().items():
+            print(f". Trimming {name} (lang={','.join(sorted(m['lang']))})",
+                  file=out, flush=True)
+            info = build_trimmed_model(m["entry"], texts, m["lang"],
+                                       logger=self.log)
+            emb = info["embedding_bytes"]
+            print(f"   vocabulary: {info['vocab_size']} -> {info['trimmed_vocab_size']}",
+                  file=out)
+            print(f"   embeddings: {emb[0]/2**20:.1f} MB -> {emb[1]/2**20:.1f} MB",
+                  file=out)
+            print(f"   saved into: {info['path']}", file=out)
+            if not self.args.no_verify:
+                self._verify(m["entry"], out, trimmed=True)
+
+
+    def proc_prune(self, out: TextIO):
+        """
+        Build versions of the models with only the first encoder layers
+        """
+        from ..model.prune import build_pruned_model, read_labeled
+
+        samples = read_labeled(self.args.labeled) if self.args.labeled else None
+        for name, m in self._models().items():
+            print(f". Pruning {name} (lang={','.join(sorted(m['lang']))})",
+                  file=out, flush=True)
+            info = build_pruned_model(m["entry"], self.args.layers, samples,
+                                      epochs=self.args.epochs, logger=self.log)
+            print(f"   layers: {info['layers'][0]} -> {info['layers'][1]}",
+                  file=out)
+            if info["refit_samples"]:
+                print(f"   head re-fit: {info['refit_samples']} samples, loss {info['refit_loss']:.4f}",
+                      file=out)
+            print(f"   saved into: {info['path']}", file=out)
+            if not self.args.no_verify:
+                self._verify(m["entry"], out, layers=self.args.layers)
+
+
+    def proc_distill(self, out: TextIO):
+        """
+        Train a small student model for a language on the results of the
+        configured model
+        """
+        from ..model.distill import distill
+
+        if not self.args.lang or len(self.args.lang) != 1:
+            raise ProcException("distillation needs a single language")
+        lang = self.args.lang[0]
+        texts = read_corpus(self.args.corpus, self.args.max_texts)
+        print(f". Distilling the model for {lang}: {len(texts)} texts",
+              file=out, flush=True)
+        info = distill(self.plugin_config, lang, texts, name=self.args.name,
+                       layers=self.args.layers, student=self.args.student,
+                       epochs=self.args.epochs, holdout=self.args.holdout,
+                       logger=self.log)
+        print(f"   student: {info['student_init']}, {info['train_texts']} training texts, loss {info['loss']:.4f}",
+              file=out)
+        report = info["agreement"]
+        if report:
+            print(f"   agreement with the teacher ({info['test_texts']} texts):",
+                  file=out)
+            for lbl, r in report.items():
+                print(f"   {lbl:>12}: P={r['precision']:.4f} R={r['recall']:.4f} F1={r['f1']:.4f}",
+                      file=out)
+        print(f"   saved into: {info['path']}", file=out)
+        print("   model entry:", json.dumps(info["entry"]), file=out)
+        if self.args.report:
+            with open(self.args.report, "w", encoding="utf-8") as f:
+                json.dump(info, f, indent=2)
+        if report and report["all"]["f1"] < self.args.min_agreement:
+            raise ProcException("validation failed: agreement {:.4f} < {}",
+                                report["all"]["f1"], self.args.min_agreement)
+
+
+    def proc_evaluate(self, out: TextIO):
+        """
+        Compare the entities produced by a modified version of the models
+        against the full ones
+        """
+        options = {}
+        if self.args.layers:
+            options["layers"] = self.args.layers
+        if self.args.trimmed:
+            options["trimmed"] = True
+        if self.args.format:
+            options["format"] = self.args.format
+        if not options:
+            raise ProcException("no model modification selected")
+        for name, m in self._models().items():
+            print(f". Evaluating {name} {options}", file=out, flush=True)
+            self._verify(m["entry"], out, **options)
+
+
+
+def parse_args(args: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description=f"Build optimized versions of the plugin models (version {VERSION})")
+
+    opt_com1 = argparse.ArgumentParser(add_help=False)
+    c1 = opt_com1.add_argument_group('Configuration options')
+    c1.add_argument("--config", nargs="+",
+                    help="add PIISA configuration file(s)")
+    c1.add_argument("--lang", nargs='+', help="language to select")
+
+    opt_com2 = argparse.ArgumentParser(add_help=False)
+    c2 = opt_com2.add_argument_group('Validation options')
+    c2.add_argument("--validation", nargs="+",
+                    help="text file(s) with the validation sample (default: the corpus)")
+    c2.add_argument("--sample", type=int, default=200,
+                    help="maximum number of validation texts (default: %(default)s)")
+    c2.add_argument("--min-agreement", type=float,
+                    help="fail if the fraction of texts with identical results is lower (default: 1 for trim, 0 otherwise)")
+    c2.add_argument("--no-verify", action="store_true",
+                    help="do not validate the model")
+
+    opt_com3 = argparse.ArgumentParser(add_help=False)
+    c3 = opt_com3.add_argument_group("Other")
+    c3.add_argument("--debug", action="store_true", help="debug mode")
+    c3.add_argument('--reraise', action='store_true',
+                    help='re-raise exceptions on errors')
+
+    subp = parser.add_subparsers(help='command', dest='cmd')
+
+    subp1 = subp.add_parser('trim',
+                            help='trim the model vocabularies to the tokens used in a corpus',
+                            parents=[opt_com1, opt_com2, opt_com3])
+    subp1.add_argument("--corpus", nargs="+", required=True,
+                       help="text file(s) with the reference corpus (one text per line)")
+
+    subp2 = subp.add_parser('prune',
+                            help='keep only the first encoder layers of the models',
+                            parents=[opt_com1, opt_com2, opt_com3])
+    subp2.add_argument("--layers", type=int, required=True,
+                       help="number of encoder layers to keep")
+    subp2.add_argument("--labeled", nargs="+",
+                       help="JSONL file(s) with a labeled sample to re-fit the classification head")
+    subp2.add_argument("--epochs", type=int, default=3,
+                       help="training epochs for the head re-fit (default: %(default)s)")
+
+    subp3 = subp.add_parser('evaluate',
+                            help='compare a modified version of the models against the full ones',
+                            parents=[opt_com1, opt_com2, opt_com3])
+    subp3.add_argument("--layers", type=int,
+                       help="evaluate keeping only these encoder layers")
+    subp3.add_argument("--trimmed", action="store_true",
+                       help="evaluate the trimmed-vocabulary version")
+    subp3.add_argument("--format", choices=("safetensors", "quantized", "onnx"),
+                       help="evaluate a converted version")
+
+    subp4 = subp.add_parser('distill',
+                            help='train a small student model on the results of the configured one, for a language',
+                            parents=[opt_com1, opt_com3])
+    subp4.add_argument("--corpus", nargs="+", required=True,
+                       help="text file(s) with the unlabeled corpus (one text per line)")
+    subp4.add_argument("--max-texts", type=int,
+                       help="maximum number of corpus texts to use")
+    subp4.add_argument("--name",
+                       help="name for the student model (default: <model>-student-<lang>[-L<layers>])")
+    subp4.add_argument("--layers", type=int, default=4,
+                       help="encoder layers for a student initialized from the teacher (default: %(default)s)")
+    subp4.add_argument("--student",
+                       help="pretrained model to initialize the student from, instead of the teacher")
+    subp4.add_argument("--epochs", type=int, default=3,
+                       help="training epochs (default: %(default)s)")
+    subp4.add_argument("--holdout", type=float, default=0.1,
+                       help="fraction of the corpus kept out of training, to measure agreement (default: %(default)s)")
+    subp4.add_argument("--min-agreement", type=float, default=0,
+                       help="fail if the entity F1 against the teacher is lower")
+    subp4.add_argument("--report", help="JSON file to write the distillation report into")
+
+    parsed = parser.parse_args(args)
+    if not parsed.cmd:
+        parser.print_usage()
+        sys.exit(1)
+    if parsed.min_agreement is None:
+        # trimming should not change the results
+        parsed.min_agreement = 1.0 if parsed.cmd == "trim" else 0
+    return parsed
+
+
+def main(args: List[str] = None):
+    if args is None:
+        args = sys.argv[1:]
+    args = parse_args(args)
+
+    try:
+        proc = Processor(args, args.debug)
+        mth_name = 'proc_' + args.cmd.replace('-', '_')
+        mth = getattr(proc, mth_name)
+        mth(sys.stdout)
+    except Exception as e:
+        print(f"Error: {e}", file=sys.stderr)
+        if args.reraise:
+            raise
+        else:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -12,6 +12,7 @@ CFG_TASK = "task_config"
 # Elements inside the task config
 CFG_TASK_REUSE = "reuse_engine"
 CFG_TASK_MODELS = "models"
+CFG_TASK_BATCH = "batch_size"
 
 # ----------------------------------------------------------------------
 
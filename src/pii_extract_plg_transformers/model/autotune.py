@@ -0,0 +1,246 @@
+"""
+Automatic tuning of the speed settings for a model: measure throughput and
+latency over a sample corpus for a number of candidate settings, check that
+their results agree with the ones of the fp32 eager model, and produce a
+configuration overlay with the best settings
+"""
+
+from copy import deepcopy
+from time import perf_counter
+
+from pii_data.defs import FMT_CONFIG_PREFIX
+from pii_data.helper.exception import ConfigException, ProcException
+from pii_data.types.doc import DocumentChunk
+from pii_extract.helper.logger import PiiLogger
+
+from typing import Dict, Iterable, List, Tuple
+
+from .. import defs
+from ..task.adaptive import percentile
+from ..task.utils import transformers_version
+from .utils import agreement
+
+
+# Model entry fields that select a faster variant of the model
+VARIANT_FIELDS = ("format", "compile", "trimmed", "layers", "snapshot")
+
+# Candidate model variants
+VARIANTS = ("fp32", "bf16", "safetensors", "quantized", "onnx", "compile")
+
+# Candidate batch sizes
+BATCH_SIZES = (1, 4, 8, 16, 32)
+
+# Candidate aggregation strategies
+AGGREGATIONS = ("simple", "first", "average", "max")
+
+# Model parameters that select the model dtype (renamed in Transformers 5)
+DTYPE_PARAMS = ("torch_dtype", "dtype")
+
+
+def dtype_param() -> str:
+    """
+    Return the name of the model parameter that selects the model dtype in
+    the available Transformers version
+    """
+    return "dtype" if int(transformers_version().split(".")[0]) >= 5 \
+        else "torch_dtype"
+
+
+def baseline_entry(m: Dict) -> Dict:
+    """
+    Return the model entry for the fp32 eager version of a model
+    """
+    out = {k: v for k, v in m.items() if k not in VARIANT_FIELDS}
+    par = {k: v for k, v in m.get("model_params", {}).items()
+           if k not in DTYPE_PARAMS}
+    if par:
+        out["model_params"] = par
+    else:
+        out.pop("model_params", None)
+    return out
+
+
+def model_variants(m: Dict, names: Iterable[str] = VARIANTS) -> Dict[str, Dict]:
+    """
+    Build the model entries for the candidate variants of a model (only the
+    converted formats already available in the cache are included)
+    """
+    from .cache import model_name, converted_path
+
+    base = baseline_entry(m)
+    out = {}
+    for name in names:
+        if name == "fp32":
+            out[name] = base
+        elif name == "bf16":
+            par = {**base.get("model_params", {}), dtype_param(): "bfloat16"}
+            out[name] = {**base, "model_params": par}
+        elif name == "compile":
+            out[name] = {**base, "compile": True}
+        elif (converted_path(name, model_name(base)) / "config.json").is_file():
+            out[name] = {**base, "format": name}
+    return out
+
+
+def _entities(pii_list: List) -> List[Dict]:
+    """
+    Convert the entities for a chunk into the format used by `agreement()`
+    """
+    return [{"entity_group": p.fields["type"], "start": p.pos,
+             "end": p.pos + len(p)} for p in pii_list]
+
+
+def measure(config: Dict, lang: str, texts: List[str],
+            batch_size: int) -> Dict:
+    """
+    Build the task for a configuration, and run a corpus through it
+      :param config: the full plugin configuration
+      :param lang: the language of the corpus
+      :param texts: the corpus
+      :param batch_size: number of texts per batch
+      :return: a dict with the load time, the throughput, the latency per
+        batch and the results
+    """
+    from ..app.detect import create_task_object
+
+    start = perf_counter()
+    task = create_task_object(config, lang)
+    load_time = perf_counter() - start
+
+    chunks = [DocumentChunk(str(n), t, {"lang": lang})
+              for n, t in enumerate(texts)]
+    batches = [chunks[i:i+batch_size] for i in range(0, len(chunks), batch_size)]
+
+    # Warm-up
+    list(task.find_chunks(batches[0], batch_size))
+
+    results, latency = [], []
+    start = perf_counter()
+    for batch in batches:
+        bstart = perf_counter()
+        results += [_entities(r) for _, r in task.find_chunks(batch, batch_size)]
+        latency.append(perf_counter() - bstart)
+    elapsed = perf_counter() - start
+    return {"load_time": load_time, "time": elapsed,
+            "texts_per_sec": len(texts)/elapsed if elapsed else 0,
+            "chars_per_sec": sum(map(len, texts))/elapsed if elapsed else 0,
+            "p50": percentile(latency, 0.5), "p95": percentile(latency, 0.95),
+            "results": results}
+
+
+def _config(config: Dict, lang: str, entry: Dict, batch_size: int) -> Dict:
+    """
+    Build a full plugin configuration with a model entry and batch size
+    """
+    cfg = deepcopy(config)
+    task_config = cfg[defs.CFG_TASK]
+    task_config[defs.CFG_TASK_REUSE] = False
+    task_config[defs.CFG_TASK_BATCH] = batch_size
+    task_config[defs.CFG_TASK_MODELS] = [
+        entry if m["lang_code"] == lang else m
+        for m in task_config[defs.CFG_TASK_MODELS]]
+    return cfg
+
+
+def autotune(config: Dict, lang: str, texts: List[str],
+             variants: Iterable[str] = VARIANTS,
+             batch_sizes: Iterable[int] = BATCH_SIZES,
+             aggregations: Iterable[str] = AGGREGATIONS,
+             min_agreement: float = 0.99, max_p95: float = None,
+             logger: PiiLogger = None) -> Tuple[Dict, List[Dict]]:
+    """
+    Find the fastest settings for the model of a language. The search is
+    done one dimension at a time: model variant, then batch size, then
+    aggregation strategy, keeping the best value found for each one
+      :param config: the full plugin configuration
+      :param lang: the language
+      :param texts: the sample corpus
+      :param variants: the model variants to try
+      :param batch_sizes: the batch sizes to try
+      :param aggregations: the aggregation strategies to try
+      :param min_agreement: minimum entity F1 against the fp32 eager model
+        for a candidate to be accepted
+      :param max_p95: maximum p95 batch latency for a candidate to be
+        accepted, in seconds
+      :param logger: a logger instance
+      :return: a tuple (configuration overlay, report for each candidate)
+    """
+    if not texts:
+        raise ConfigException("no texts in the sample corpus")
+    task_config = config[defs.CFG_TASK]
+    entry = next((m for m in task_config.get(defs.CFG_TASK_MODELS, [])
+                  if m["lang_code"] == lang), None)
+    if entry is None:
+        raise ConfigException("no model configured for language: {}", lang)
+    default_agg = task_config.get("aggregation", "max")
+    bsize = task_config.get(defs.CFG_TASK_BATCH, 8)
+
+    report = []
+
+    def run(name: str, m: Dict, bs: int) -> Dict:
+        if logger:
+            logger(".. candidate %s", name)
+        try:
+            r = measure(_config(config, lang, m, bs), lang, texts, bs)
+        except (ConfigException, ProcException) as e:
+            report.append({"candidate": name, "error": str(e)})
+            return None
+        res = r.pop("results")
+        r.update(agreement(res if ref is None else ref, res))
+        r["candidate"] = name
+        r["accepted"] = (r["f1"] >= min_agreement and
+                         (max_p95 is None or r["p95"] <= max_p95))
+        report.append(r)
+        return {**r, "results": res}
+
+    def best(candidates: Dict[str, Tuple[Dict, int]], current):
+        for name, (m, bs) in candidates.items():
+            r = run(name, m, bs)
+            if r and r["accepted"] and r["texts_per_sec"] > current[2]:
+                current = m, bs, r["texts_per_sec"]
+        return current
+
+    # The reference: the fp32 eager model
+    ref = None
+    base = {**baseline_entry(entry), "aggregation":
+            entry.get("aggregation", default_agg)}
+    r = run("baseline", base, bsize)
+    if r is None:
+        raise ProcException("cannot run the baseline model: {}",
+                            report[-1]["error"])
+    ref = r["results"]
+    current = base, bsize, r["texts_per_sec"]
+
+    # Model variants
+    cands = {f"variant={name}": ({**m, "aggregation": base["aggregation"]}, bsize)
+             for name, m in model_variants(entry, variants).items()
+             if name != "fp32"}
+    if baseline_entry(entry) != entry:
+        cands["variant=configured"] = ({**entry, "aggregation": base["aggregation"]},
+                                       bsize)
+    current = best(cands, current)
+
+    # Batch sizes
+    cands = {f"batch_size={bs}": (current[0], bs) for bs in batch_sizes
+             if bs != current[1]}
+    current = best(cands, current)
+
+    # Aggregation strategies
+    cands = {f"aggregation={agg}": ({**current[0], "aggregation": agg}, current[1])
+             for agg in aggregations if agg != current[0]["aggregation"]}
+    current = best(cands, current)
+
+    # Build the overlay
+    m, bs, tps = current
+    models = [m if e["lang_code"] == lang else e
+              for e in task_config.get(defs.CFG_TASK_MODELS, [])]
+    overlay = {
+        "format": FMT_CONFIG_PREFIX + defs.FMT_CONFIG,
+        defs.CFG_TASK: {defs.CFG_TASK_BATCH: bs,
+                        defs.CFG_TASK_MODELS: models},
+        "autotune": {"lang": lang, "texts": len(texts),
+                     "texts_per_sec": tps,
+                     "baseline_texts_per_sec": report[0]["texts_per_sec"],
+                     "min_agreement": min_agreement, "max_p95": max_p95}
+    }
+    return overlay, report
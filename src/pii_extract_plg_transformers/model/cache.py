@@ -0,0 +1,230 @@
+"""
+Prepare the model cache: fetch models, convert them to faster formats, and
+verify file checksums
+"""
+
+import json
+import shutil
+import hashlib
+from os import environ
+from pathlib import Path
+
+try:
+    import torch
+    from transformers import AutoTokenizer, AutoModelForTokenClassification
+except ImportError:
+    torch = None
+
+from pii_data.helper.exception import ConfigException, ProcException
+
+from typing import Dict, List, Tuple
+
+from ..task.utils import ENV_HF_CACHE, artifact_dir
+
+
+# Converted model formats
+FORMATS = "safetensors", "quantized", "onnx"
+
+# Filenames for converted models
+QUANTIZED_FILE = "model-quantized.pt"
+ONNX_FILE = "model.onnx"
+
+# Name of the checksum manifest in a model folder
+CHECKSUMS = "piisa-checksums.json"
+
+# Name of the file with information about a model built by distillation
+DISTILL_INFO = "piisa-distill.json"
+
+
+def model_name(m: Dict) -> str:
+    """
+    Return the name used for the artifacts of a model entry
+    """
+    return m["model"] + ("-trimmed" if m.get("trimmed") else "")
+
+
+def local_path(name: str) -> Path:
+    """
+    Return the folder for a local copy of a model (taken from a mirror)
+    """
+    return artifact_dir("models", name)
+
+
+def converted_path(fmt: str, name: str) -> Path:
+    """
+    Return the folder for a model converted to a given format
+    """
+    if fmt not in FORMATS:
+        raise ConfigException("unknown model format: {}", fmt)
+    return artifact_dir(fmt, name)
+
+
+# -----------------------------------------------------------------------
+
+
+def file_hash(path: Path, algorithm: str = "sha256", prefix: bytes = b"") -> str:
+    """
+    Compute the hash for a file
+    """
+    h = hashlib.new(algorithm)
+    h.update(prefix)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(2**20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def dir_files(path: Path) -> List[Path]:
+    return sorted(p for p in path.rglob("*")
+                  if p.is_file() and p.name != CHECKSUMS)
+
+
+def dir_size(path: Path) -> int:
+    """
+    Return the total size of the files in a folder (following symlinks)
+    """
+    return sum(p.stat().st_size for p in dir_files(path))
+
+
+def write_checksums(path: Path) -> Dict[str, str]:
+    """
+    Write a checksum manifest for all the files in a folder
+    """
+    sums = {str(p.relative_to(path)): file_hash(p) for p in dir_files(path)}
+    with open(path / CHECKSUMS, "w", encoding="utf-8") as f:
+        json.dump(sums, f, indent=2)
+    return sums
+
+
+def verify_checksums(path: Path) -> List[str]:
+    """
+    Verify the files in a folder against its checksum manifest
+      :return: the list of files that are missing or have a wrong checksum
+    """
+    try:
+        with open(path / CHECKSUMS, encoding="utf-8") as f:
+            sums = json.load(f)
+    except FileNotFoundError:
+        raise ProcException("no checksum manifest in {}", path)
+    return [name for name, h in sums.items()
+            if not (path / name).is_file() or file_hash(path / name) != h]
+
+
+def verify_snapshot(path: Path) -> List[str]:
+    """
+    Verify the files in a Hugging Face Hub cache snapshot. Their blob names
+    are either the SHA256 hash of the file (for LFS files) or its git SHA1
+      :return: the list of files with a wrong checksum
+    """
+    bad = []
+    for p in dir_files(path):
+        blob = p.resolve().name
+        size = p.stat().st_size
+        if len(blob) == 64:
+            ok = file_hash(p) == blob
+        elif len(blob) == 40:
+            ok = file_hash(p, "sha1", f"blob {size}\0".encode()) == blob
+        else:
+            continue
+        if not ok:
+            bad.append(str(p.relative_to(path)))
+    return bad
+
+
+# -----------------------------------------------------------------------
+
+
+def fetch(name: str, mirror: str = None) -> Tuple[Path, bool]:
+    """
+    Fetch a model (or tokenizer) into the cache
+      :param name: the model name in the Hub
+      :param mirror: a local folder containing models, each one in a subfolder
+        named as the model (to be used when there is no network access)
+      :return: a tuple (folder for the model, is-hub-snapshot)
+    """
+    if Path(name).is_dir():
+        return Path(name), False        # a local model, nothing to fetch
+    if (local_path(name) / DISTILL_INFO).is_file():
+        return local_path(name), False  # a model built by distillation
+
+    if mirror:
+        src = Path(mirror) / name
+        if not src.is_dir():
+            raise ProcException("model {} not found in mirror {}", name, mirror)
+        dest = local_path(name)
+        if dest.is_dir():
+            shutil.rmtree(dest)
+        shutil.copytree(src, dest)
+        write_checksums(dest)
+        return dest, False
+
+    # When working offline, this just checks the model is already in the cache
+    offline = environ.get("HF_HUB_OFFLINE", "").lower() in ("1", "true", "yes")
+    try:
+        from huggingface_hub import snapshot_download
+        path = snapshot_download(name, cache_dir=environ.get(ENV_HF_CACHE),
+                                 local_files_only=offline)
+        return Path(path), True
+    except Exception as e:
+        raise ProcException("cannot fetch model {}: {}", name, e) from e
+
+
+def _example_input(tokenizer) -> Dict:
+    return dict(tokenizer(["Alan Turing was born in London"],
+                          return_tensors="pt"))
+
+
+def convert(m: Dict, fmt: str, model_src: str = None,
+            tokenizer_src: str = None) -> Path:
+    """
+    Convert a configured model into a format, and save it into the cache
+      :param m: the model entry
+      :param fmt: the destination format
+      :param model_src: the folder to load the model from (default: the
+        model name)
+      :param tokenizer_src: the folder to load the tokenizer from (default:
+        the tokenizer name)
+      :return: the folder with the converted model
+    """
+    if torch is None:
+        raise ConfigException("PyTorch/Transformers packages not found")
+    mdname = model_src or m["model"]
+    tkname = tokenizer_src or m.get("tokenizer") or m["model"]
+    tokenizer = AutoTokenizer.from_pretrained(tkname)
+    model = AutoModelForTokenClassification.from_pretrained(
+        mdname, **m.get("model_params", {}))
+    model.eval()
+
+    dest = converted_path(fmt, model_name(m))
+    if dest.is_dir():
+        shutil.rmtree(dest)
+    dest.mkdir(parents=True)
+    tokenizer.save_pretrained(str(dest))
+
+    try:
+        if fmt == "safetensors":
+            model.save_pretrained(str(dest), safe_serialization=True)
+
+        elif fmt == "quantized":
+            qmodel = torch.quantization.quantize_dynamic(
+                model, {torch.nn.Linear}, dtype=torch.qint8)
+            model.config.save_pretrained(str(dest))
+            torch.save(qmodel, dest / QUANTIZED_FILE)
+
+        elif fmt == "onnx":
+            inputs = _example_input(tokenizer)
+            axes = {k: {0: "batch", 1: "sequence"} for k in inputs}
+            axes["logits"] = {0: "batch", 1: "sequence"}
+            model.config.save_pretrained(str(dest))
+            with torch.no_grad():
+                torch.onnx.export(model, (inputs,), str(dest / ONNX_FILE),
+                                  input_names=list(inputs),
+                                  output_names=["logits"],
+                                  dynamic_axes=axes, opset_version=14)
+    except Exception as e:
+        shutil.rmtree(dest, ignore_errors=True)
+        raise ProcException("cannot convert model {} to {}: {}",
+                            m["model"], fmt, e) from e
+
+    write_checksums(dest)
+    return dest
@@ -0,0 +1,278 @@
+"""
+Compile a token classification model for a set of fixed sequence lengths
+(buckets): inputs are padded to the smallest bucket that fits them, and run
+through the compiled version for that length. Longer inputs (or calls with
+unexpected arguments) run through the eager model
+"""
+
+import os
+import json
+from pathlib import Path
+from time import perf_counter
+from collections import Counter
+from threading import Lock
+
+try:
+    import torch
+    from transformers.modeling_outputs import TokenClassifierOutput
+except ImportError:
+    torch = None
+
+from pii_data.helper.exception import ConfigException
+from pii_extract.helper.logger import PiiLogger
+
+from typing import Dict, List, Optional, Tuple
+
+from ..task.utils import artifact_dir
+
+
+# Default sequence length buckets
+BUCKETS = (64, 128, 256, 512)
+
+# Compilation methods
+METHODS = ("trace", "compile")
+
+# Name of the file with information about the compiled artifacts
+COMPILE_INFO = "piisa-compile.json"
+
+# Maximum absolute difference allowed between compiled and eager logits
+TOLERANCE = 1e-3
+
+
+def compiled_path(name: str, key: str) -> Path:
+    """
+    Return the folder for the compiled artifacts of a model
+      :param name: the model name
+      :param key: the engine cache key for the model (which identifies its
+        variant and parameters)
+    """
+    return artifact_dir("compiled", name, key)
+
+
+def choose_bucket(length: int, buckets: List[int]) -> int:
+    """
+    Return the smallest bucket that fits a sequence length, or None
+    """
+    for b in buckets:
+        if length <= b:
+            return b
+    return None
+
+
+class _Logits(torch.nn.Module if torch else object):
+    """
+    A module returning only the logits of a model, with positional inputs
+    (as needed by tracing). It calls the original forward method of the
+    model, so that it is not affected by its replacement
+    """
+
+    def __init__(self, model, names: Tuple[str]):
+        super().__init__()
+        self.model = model
+        self.names = names
+        self._forward = model.forward
+
+    def forward(self, *args):
+        return self._forward(**dict(zip(self.names, args)), return_dict=False)[0]
+
+
+class CompiledForward:
+    """
+    A replacement for the `forward` method of a model, dispatching inputs
+    to the compiled version for their bucket
+    """
+
+    def __init__(self, eager, names: Tuple[str], pad_id: int):
+        """
+          :param eager: the original forward method
+          :param names: the model input names, in positional order
+          :param pad_id: the tokenizer padding id
+        """
+        self.eager = eager
+        self.names = names
+        self.pad = {"input_ids": pad_id}
+        self.compiled = {}
+        self.compile_time = {}
+        self.loaded = []
+        self.stats = Counter()
+        self._lock = Lock()
+
+
+    def __repr__(self) -> str:
+        return f"<CompiledForward {sorted(self.compiled)}>"
+
+
+    def _pad(self, name: str, t: "torch.Tensor", size: int) -> "torch.Tensor":
+        extra = size - t.shape[1]
+        if not extra:
+            return t
+        fill = t.new_full((t.shape[0], extra), self.pad.get(name, 0))
+        return torch.cat([t, fill], dim=1)
+
+
+    def __call__(self, input_ids=None, attention_mask=None, **kwargs):
+        inputs = {"input_ids": input_ids, "attention_mask": attention_mask,
+                  **kwargs}
+        bucket = None
+        if input_ids is not None and set(k for k in inputs
+                                         if inputs[k] is not None) <= set(self.names):
+            bucket = choose_bucket(input_ids.shape[1], sorted(self.compiled))
+        if bucket is None:
+            with self._lock:
+                self.stats["eager"] += 1
+            return self.eager(**inputs)
+
+        length = input_ids.shape[1]
+        args = [self._pad(n, inputs[n], bucket) for n in self.names]
+        with torch.no_grad():
+            logits = self.compiled[bucket](*args)[:, :length]
+        with self._lock:
+            self.stats[f"L{bucket}"] += 1
+        return TokenClassifierOutput(logits=logits)
+
+
+    def get_stats(self) -> Dict:
+        """
+        Return the compilation time per bucket, the buckets loaded from
+        saved artifacts, and the number of calls per bucket
+        """
+        with self._lock:
+            return {"buckets": sorted(self.compiled),
+                    "compile_time": dict(self.compile_time),
+                    "compile_time_total": sum(self.compile_time.values()),
+                    "loaded": list(self.loaded), "calls": dict(self.stats)}
+
+
+def compile_stats(model) -> Optional[Dict]:
+    """
+    Return the compilation statistics for a model, if it has been compiled
+    """
+    fwd = getattr(model, "__dict__", {}).get("forward")
+    return fwd.get_stats() if isinstance(fwd, CompiledForward) else None
+
+
+def _example(names: Tuple[str], batch: int, length: int, vocab: int,
+             device) -> List:
+    """
+    Build random example inputs for a model
+    """
+    out = []
+    for n in names:
+        if n == "input_ids":
+            out.append(torch.randint(5, vocab, (batch, length), device=device))
+        elif n == "attention_mask":
+            out.append(torch.ones(batch, length, dtype=torch.long, device=device))
+        else:
+            out.append(torch.zeros(batch, length, dtype=torch.long, device=device))
+    return out
+
+
+def _check(compiled, module: "_Logits", names: Tuple[str], length: int,
+           vocab: int, device) -> bool:
+    """
+    Check a compiled module against the eager model, with a batch size
+    different from the one used to compile it
+    """
+    args = _example(names, 3, length, vocab, device)
+    with torch.no_grad():
+        ref = module(*args)
+        got = compiled(*args)
+    return bool((ref - got).abs().max() <= TOLERANCE)
+
+
+def compile_key(options: Dict) -> str:
+    """
+    Build a canonical string for a set of compilation options, to use as
+    part of the engine cache key
+      :param options: compilation options (`True` for the defaults)
+    """
+    if options is True:
+        options = {}
+    buckets = sorted(int(b) for b in options.get("buckets", BUCKETS))
+    return "{}:{}".format(options.get("method", "trace"),
+                          ",".join(map(str, buckets)))
+
+
+def compile_model(model, tokenizer, name: str, key: str, options: Dict,
+                  logger: PiiLogger = None) -> CompiledForward:
+    """
+    Compile a model for a set of sequence length buckets, and replace its
+    forward method with one that dispatches to the compiled versions
+      :param model: the model
+      :param tokenizer: the tokenizer for the model
+      :param name: the model name (to name the artifacts)
+      :param key: the engine cache key for the model
+      :param options: compilation options: `method` (`trace` or `compile`)
+         and `buckets` (a list of sequence lengths)
+      :param logger: a logger instance
+      :return: the new forward method
+    """
+    if torch is None:
+        raise ConfigException("PyTorch/Transformers packages not found")
+    if not isinstance(model, torch.nn.Module):
+        raise ConfigException("cannot compile a non-PyTorch model: {}", name)
+    method = options.get("method", "trace")
+    if method not in METHODS:
+        raise ConfigException("invalid compile method: {}", method)
+    buckets = sorted(options.get("buckets", BUCKETS))
+
+    names = tuple(n for n in tokenizer.model_input_names
+                  if n in ("input_ids", "attention_mask", "token_type_ids"))
+    device = next(model.parameters()).device
+    vocab = min(model.config.vocab_size, len(tokenizer))
+    module = _Logits(model, names).eval()
+    fwd = CompiledForward(model.forward, names,
+                          tokenizer.pad_token_id or 0)
+
+    outdir = compiled_path(name, key)
+    outdir.mkdir(parents=True, exist_ok=True)
+    info_file = outdir / COMPILE_INFO
+    try:
+        with open(info_file, encoding="utf-8") as f:
+            info = json.load(f)
+        if info.get("torch") != torch.__version__:
+            info = {}
+    except (OSError, ValueError):
+        info = {}
+    info.update({"model": name, "key": key, "torch": torch.__version__})
+    saved = info.setdefault("buckets", {})
+
+    if method == "compile":
+        # Keep the compiler cache next to the other artifacts
+        os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR",
+                              str(outdir.parent / "inductor"))
+
+    for length in buckets:
+        path = outdir / f"{method}-L{length}.pt"
+        start = perf_counter()
+        compiled = None
+        if method == "trace" and saved.get(str(length)) and path.is_file():
+            compiled = torch.jit.load(str(path), map_location=device)
+            fwd.loaded.append(length)
+        elif method == "trace":
+            with torch.no_grad():
+                compiled = torch.jit.trace(
+                    module, _example(names, 2, length, vocab, device),
+                    check_trace=False)
+        else:
+            compiled = torch.compile(module, dynamic=False)
+        # Validate (this also triggers the compilation for torch.compile)
+        if not _check(compiled, module, names, length, vocab, device):
+            if logger:
+                logger(".... compiled model for L=%d does not match the eager one: skipped",
+                       length)
+            continue
+        if method == "trace" and length not in fwd.loaded:
+            torch.jit.save(compiled, str(path))
+            saved[str(length)] = True
+        fwd.compiled[length] = compiled
+        fwd.compile_time[length] = perf_counter() - start
+        if logger:
+            logger(".... compiled L=%d (%s): %.2f secs", length, method,
+                   fwd.compile_time[length])
+
+    with open(info_file, "w", encoding="utf-8") as f:
+        json.dump(info, f, indent=2)
+
+    model.forward = fwd
+    return fwd
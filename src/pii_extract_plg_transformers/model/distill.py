@@ -0,0 +1,261 @@
+"""
+Teacher-student distillation: label an unlabeled corpus with the configured
+task (the teacher), train a small token classification model (the student)
+on those labels, and save it in the cache directory, where model entries in
+the configuration can refer to it by name
+"""
+
+import json
+import random
+from copy import deepcopy
+from datetime import datetime
+
+try:
+    import torch
+    from transformers import AutoConfig, AutoTokenizer, \
+        AutoModelForTokenClassification
+except ImportError:
+    torch = None
+
+from pii_data.helper.exception import ConfigException, ProcException
+from pii_data.types.doc import DocumentChunk
+from pii_extract.helper.logger import PiiLogger
+
+from typing import Dict, Iterable, List, Tuple
+
+from .. import defs
+from .cache import local_path, DISTILL_INFO
+from .prune import Sample, token_labels, truncate_layers
+from .utils import agreement
+
+
+def student_name(teacher: str, lang: str, layers: int = None) -> str:
+    """
+    Return the default name for a student model
+    """
+    name = f"{teacher}-student-{lang}"
+    return name + (f"-L{layers}" if layers else "")
+
+
+def entity_labels(task, lang: str) -> Dict:
+    """
+    Return the map from PII entity info to model label, for the entities
+    the task produces in a language
+    """
+    return {info: label for label, info in task._ent_map[lang].items()}
+
+
+def teacher_labels(task, lang: str, texts: List[str],
+                   batch_size: int = None) -> List[Sample]:
+    """
+    Label a list of texts with the teacher task
+      :return: a list of samples (text, entities), each entity with
+        "start", "end" and "label" (the teacher model label)
+    """
+    labels = entity_labels(task, lang)
+    chunks = (DocumentChunk(str(n), t, {"lang": lang})
+              for n, t in enumerate(texts))
+    out = []
+    for chunk, pii_list in task.find_chunks(chunks, batch_size):
+        out.append((chunk.data,
+                    [{"start": p.pos, "end": p.pos + len(p),
+                      "label": labels[p.info]} for p in pii_list]))
+    return out
+
+
+def bio_labels(labels: Iterable[str]) -> Dict[int, str]:
+    """
+    Build the id2label map of a student model, with BIO tags for each label
+    """
+    id2label = {0: "O"}
+    for lbl in sorted(set(labels)):
+        id2label[len(id2label)] = f"B-{lbl}"
+        id2label[len(id2label)] = f"I-{lbl}"
+    return id2label
+
+
+def build_student(m: Dict, id2label: Dict[int, str], layers: int = None,
+                  student: str = None) -> Tuple:
+    """
+    Create the initial student model
+      :param m: the teacher model entry in the configuration
+      :param id2label: the labels for the student
+      :param layers: if no student model is given, initialize it from the
+        first layers of the teacher
+      :param student: a (small) pretrained model to initialize the student
+        from, instead of the teacher
+      :return: a tuple (tokenizer, model)
+    """
+    if torch is None:
+        raise ConfigException("PyTorch/Transformers packages not found")
+    label2id = {v: k for k, v in id2label.items()}
+    if student:
+        tokenizer = AutoTokenizer.from_pretrained(student)
+        model = AutoModelForTokenClassification.from_pretrained(
+            student, num_labels=len(id2label), id2label=id2label,
+            label2id=label2id, ignore_mismatched_sizes=True)
+        return tokenizer, model
+
+    if not layers:
+        raise ConfigException("the number of student layers is needed to initialize it from the teacher")
+    src = m["model"]
+    if (local_path(src) / "config.json").is_file():
+        src = str(local_path(src))
+    tksrc = m.get("tokenizer") or m["model"]
+    if local_path(tksrc).is_dir():
+        tksrc = str(local_path(tksrc))
+    tokenizer = AutoTokenizer.from_pretrained(tksrc)
+    teacher = AutoModelForTokenClassification.from_pretrained(src)
+    truncate_layers(teacher, layers)
+    config = AutoConfig.from_pretrained(src, num_labels=len(id2label),
+                                        id2label=id2label, label2id=label2id)
+    for f in ("num_hidden_layers", "n_layers", "num_layers"):
+        if hasattr(teacher.config, f):
+            setattr(config, f, getattr(teacher.config, f))
+    model = AutoModelForTokenClassification.from_config(config)
+    # Copy the teacher body (the classification head is new)
+    model.base_model.load_state_dict(teacher.base_model.state_dict())
+    return tokenizer, model
+
+
+def train_student(model, tokenizer, samples: List[Sample], epochs: int = 3,
+                  lr: float = 5e-5, batch_size: int = 16,
+                  max_length: int = 256, logger: PiiLogger = None) -> float:
+    """
+    Train the student model on the teacher labels (on CPU)
+      :return: the final training loss
+    """
+    label2id = model.config.label2id
+    opt = torch.optim.AdamW(model.parameters(), lr=lr)
+    samples = list(samples)
+    loss = None
+    model.train()
+    for epoch in range(epochs):
+        random.shuffle(samples)
+        total = 0.0
+        for i in range(0, len(samples), batch_size):
+            batch = samples[i:i+batch_size]
+            enc = tokenizer([s[0] for s in batch], return_tensors="pt",
+                            truncation=True, max_length=max_length,
+                            padding=True, return_offsets_mapping=True)
+            offsets = enc.pop("offset_mapping").tolist()
+            lbl = [token_labels(offsets[n], entities, label2id)
+                   for n, (_, entities) in enumerate(batch)]
+            inputs = {k: enc[k] for k in tokenizer.model_input_names if k in enc}
+            opt.zero_grad()
+            out = model(**inputs, labels=torch.tensor(lbl))
+            out.loss.backward()
+            opt.step()
+            total += out.loss.item() * len(batch)
+        loss = total/len(samples) if samples else 0.0
+        if logger:
+            logger(".. epoch %d: loss %.4f", epoch + 1, loss)
+    model.eval()
+    return loss
+
+
+def _results(samples: List[Sample]) -> List[List[Dict]]:
+    """
+    Convert labeled samples into the format used by `agreement()`
+    """
+    return [[{"entity_group": e["label"], "start": e["start"], "end": e["end"]}
+             for e in s[1]] for s in samples]
+
+
+def _task_config(config: Dict, lang: str, entry: Dict) -> Dict:
+    """
+    Build a full plugin configuration, replacing the model for a language
+    """
+    cfg = deepcopy(config)
+    task_config = cfg[defs.CFG_TASK]
+    task_config[defs.CFG_TASK_REUSE] = False
+    task_config[defs.CFG_TASK_MODELS] = [
+        entry if m["lang_code"] == lang else m
+        for m in task_config[defs.CFG_TASK_MODELS]]
+    return cfg
+
+
+def distill(config: Dict, lang: str, texts: List[str], name: str = None,
+            layers: int = 4, student: str = None, epochs: int = 3,
+            holdout: float = 0.1, batch_size: int = 16,
+            logger: PiiLogger = None) -> Dict:
+    """
+    Distill the configured model for a language into a student model
+      :param config: the full plugin configuration
+      :param lang: the language
+      :param texts: the unlabeled corpus
+      :param name: the name for the student model
+      :param layers: number of encoder layers for a student initialized from
+        the teacher
+      :param student: a pretrained model to initialize the student from
+      :param epochs: training epochs
+      :param holdout: fraction of the corpus kept out of training, to
+        measure agreement between student and teacher
+      :param batch_size: batch size for labeling and training
+      :param logger: a logger instance
+      :return: information about the student model, including the model
+        entry to use it and the agreement report
+    """
+    from ..app.detect import create_task_object
+
+    entry = next((m for m in config[defs.CFG_TASK].get(defs.CFG_TASK_MODELS, [])
+                  if m["lang_code"] == lang), None)
+    if entry is None:
+        raise ConfigException("no model configured for language: {}", lang)
+    if len(texts) < 2:
+        raise ConfigException("not enough texts in the corpus")
+    name = name or student_name(entry["model"], lang,
+                                None if student else layers)
+
+    # Label the corpus with the teacher
+    teacher = create_task_object(config, lang)
+    if logger:
+        logger(".. labeling %d texts with the teacher", len(texts))
+    samples = teacher_labels(teacher, lang, texts, batch_size)
+    num_test = max(1, int(len(samples)*holdout)) if holdout else 0
+    train, test = samples[num_test:], samples[:num_test]
+
+    # Train the student
+    id2label = bio_labels(entity_labels(teacher, lang).values())
+    tokenizer, model = build_student(entry, id2label, layers, student)
+    if logger:
+        logger(".. training student: %d texts, labels %s", len(train),
+               list(id2label.values()))
+    try:
+        loss = train_student(model, tokenizer, train, epochs=epochs,
+                             batch_size=batch_size, logger=logger)
+    except Exception as e:
+        raise ProcException("cannot train student for {}: {}", lang, e) from e
+
+    outdir = local_path(name)
+    outdir.mkdir(parents=True, exist_ok=True)
+    tokenizer.save_pretrained(str(outdir))
+    model.save_pretrained(str(outdir))
+
+    # Agreement against the teacher, over the held-out texts
+    new_entry = {k: v for k, v in entry.items()
+                 if k not in ("model", "tokenizer", "trimmed", "format",
+                              "layers", "snapshot", "compile", "cascade")}
+    new_entry["model"] = name
+    report = None
+    if test:
+        st_task = create_task_object(_task_config(config, lang, new_entry),
+                                     lang)
+        st_samples = teacher_labels(st_task, lang, [t for t, _ in test],
+                                    batch_size)
+        ref, got = _results(test), _results(st_samples)
+        report = {"all": agreement(ref, got)}
+        for lbl in sorted({v.split("-")[-1] for v in id2label.values()} - {"O"}):
+            report[lbl] = agreement(ref, got, [lbl])
+
+    info = {"teacher": entry["model"], "lang": lang, "student_init":
+            student or f"teacher:L{layers}", "labels": list(id2label.values()),
+            "train_texts": len(train), "test_texts": len(test),
+            "epochs": epochs, "loss": loss, "agreement": report,
+            "date": datetime.now().isoformat(timespec="seconds")}
+    with open(outdir / DISTILL_INFO, "w", encoding="utf-8") as f:
+        json.dump(info, f, indent=2)
+    info["path"] = str(outdir)
+    info["entry"] = new_entry
+    return info
+
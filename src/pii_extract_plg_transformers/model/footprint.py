@@ -0,0 +1,75 @@
+"""
+Compute the memory footprint of a loaded pipeline
+"""
+
+from collections import defaultdict
+
+from typing import Dict, Iterable, List
+
+# Values of tokenizer model_max_length used as "no limit"
+_NO_LIMIT = 10**9
+
+
+def _tensors(module) -> List:
+    """
+    Return the tensors in the state of a module (skipping other objects,
+    such as packed parameters of quantized layers)
+    """
+    return [t for t in module.state_dict().values()
+            if hasattr(t, "element_size")]
+
+
+def _tensor_bytes(tensors: Iterable) -> int:
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+
+def _module_bytes(module) -> int:
+    if module is None:
+        return 0
+    return _tensor_bytes(_tensors(module))
+
+
+def pipeline_footprint(pp) -> Dict:
+    """
+    Compute size information for the model and tokenizer in a pipeline
+      :return: a dict with the number of parameters, the bytes taken by the
+        weights (in total and by dtype), the share of embeddings and encoder
+        layers, and tokenizer vocabulary size and max sequence length
+    """
+    model = pp.model
+    tokenizer = pp.tokenizer
+    max_len = tokenizer.model_max_length
+    info = {
+        "vocab_size": len(tokenizer),
+        "max_length": max_len if max_len and max_len < _NO_LIMIT else None,
+        "max_position_embeddings": getattr(model.config,
+                                           "max_position_embeddings", None)
+    }
+    if not hasattr(model, "state_dict"):
+        return info         # not a PyTorch model
+
+    by_dtype = defaultdict(int)
+    for t in _tensors(model):
+        by_dtype[str(t.dtype).replace("torch.", "")] += t.numel() * t.element_size()
+    total = sum(by_dtype.values())
+
+    # Embeddings: the full embeddings module of the base model, if there is
+    # one (word, position & type embeddings), else the input embeddings
+    base = getattr(model, "base_model", model)
+    emb = getattr(base, "embeddings", None)
+    if emb is None:
+        emb = model.get_input_embeddings()
+    emb_bytes = _module_bytes(emb)
+    enc_bytes = _module_bytes(getattr(base, "encoder", None))
+
+    return {
+        "params": sum(p.numel() for p in model.parameters()),
+        "bytes": total,
+        "bytes_by_dtype": dict(by_dtype),
+        "embedding_bytes": emb_bytes,
+        "encoder_bytes": enc_bytes,
+        "other_bytes": total - emb_bytes - enc_bytes,
+        "embedding_share": emb_bytes/total if total else 0,
+        "encoder_share": enc_bytes/total if total else 0,
+        **info
+    }
@@ -0,0 +1,253 @@
+"""
+Prune a token classification model to its first K encoder layers, optionally
+re-fitting the classification head on a labeled sample
+"""
+
+import json
+import random
+from datetime import datetime
+from pathlib import Path
+
+try:
+    import torch
+    from transformers import AutoTokenizer, AutoModelForTokenClassification
+except ImportError:
+    torch = None
+
+from pii_data.helper.exception import ConfigException, FileException, \
+    ProcException
+from pii_extract.helper.logger import PiiLogger
+
+from typing import Dict, Iterable, List, Tuple
+
+from ..task.utils import artifact_dir
+
+
+# Name of the file with information about a pruned model
+PRUNE_INFO = "piisa-prune.json"
+
+# Places where the list of encoder layers can be found, in the base model
+LAYER_ATTRS = ("encoder.layer", "encoder.layers", "transformer.layer",
+               "layers", "layer")
+
+# Config fields for the number of layers
+LAYER_CONFIG = ("num_hidden_layers", "n_layers", "num_layers")
+
+# A labeled text: (text, list of entities with start, end & label)
+Sample = Tuple[str, List[Dict]]
+
+
+def pruned_path(model: str, layers: int, trimmed: bool = False) -> Path:
+    """
+    Return the folder containing the pruned (and re-fitted) version of a
+    model, or of its trimmed-vocabulary version
+    """
+    suffix = "-trimmed" if trimmed else ""
+    return artifact_dir("pruned", f"{model}{suffix}-L{layers}")
+
+
+def encoder_layers(model):
+    """
+    Find the module list holding the encoder layers of a model
+      :return: a tuple (parent module, attribute name, layer list)
+    """
+    base = getattr(model, "base_model", model)
+    for path in LAYER_ATTRS:
+        obj, parent, name = base, None, None
+        for name in path.split("."):
+            parent, obj = obj, getattr(obj, name, None)
+            if obj is None:
+                break
+        if obj is not None and hasattr(obj, "__len__"):
+            return parent, name, obj
+    raise ConfigException("cannot find the encoder layers in model {}",
+                          type(model).__name__)
+
+
+def truncate_layers(model, layers: int) -> Tuple[int, int]:
+    """
+    Keep only the first encoder layers of a model (in place)
+      :return: the number of layers, before and after
+    """
+    parent, name, layer_list = encoder_layers(model)
+    before = len(layer_list)
+    if layers < 1:
+        raise ConfigException("invalid number of layers: {}", layers)
+    if layers < before:
+        setattr(parent, name, layer_list[:layers])
+        for f in LAYER_CONFIG:
+            if hasattr(model.config, f):
+                setattr(model.config, f, layers)
+    return before, min(layers, before)
+
+
+def read_labeled(paths: Iterable[str], max_samples: int = None) -> List[Sample]:
+    """
+    Read a labeled sample: JSONL files, each line a JSON object with a "text"
+    field and an "entities" list, each entity with "start", "end" & "label"
+    """
+    samples = []
+    for name in paths:
+        try:
+            with open(name, encoding="utf-8") as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    d = json.loads(line)
+                    samples.append((d["text"], d.get("entities", [])))
+                    if max_samples and len(samples) >= max_samples:
+                        return samples
+        except (OSError, ValueError, KeyError) as e:
+            raise FileException("cannot read labeled file '{}': {}",
+                                name, e) from e
+    return samples
+
+
+def token_labels(offsets: List[Tuple[int, int]], entities: List[Dict],
+                 label2id: Dict[str, int]) -> List[int]:
+    """
+    Assign a label id to each token, from entity character spans, using the
+    BIO labels of the model. Special tokens and labels unknown to the model
+    get -100 (ignored in the loss), tokens out of entities get "O"
+    """
+    out_id = label2id.get("O", -100)
+    labels = []
+    for start, end in offsets:
+        if start == end:
+            labels.append(-100)
+            continue
+        lbl = out_id
+        for e in entities:
+            if e["start"] <= start < e["end"]:
+                tag = "B" if start == e["start"] else "I"
+                lbl = label2id.get(f"{tag}-{e['label']}",
+                                   label2id.get(e["label"], -100))
+                break
+        labels.append(lbl)
+    return labels
+
+
+def refit_head(model, tokenizer, samples: List[Sample], epochs: int = 3,
+               lr: float = 1e-3, batch_size: int = 16,
+               logger: PiiLogger = None) -> float:
+    """
+    Re-fit the classification head of a model over a labeled sample, keeping
+    the rest of the model frozen
+      :return: the final training loss
+    """
+    head = getattr(model, "classifier", None)
+    if head is None:
+        raise ConfigException("cannot find the classification head in model {}",
+                              type(model).__name__)
+
+    # Compute the hidden states once, since the body is frozen (not in
+    # inference mode, since they are used for training)
+    model.eval()
+    label2id = model.config.label2id
+    feats, targets = [], []
+    with torch.no_grad():
+        for i in range(0, len(samples), batch_size):
+            batch = samples[i:i+batch_size]
+            enc = tokenizer([s[0] for s in batch], return_tensors="pt",
+                            truncation=True, padding=True,
+                            return_offsets_mapping=True)
+            offsets = enc.pop("offset_mapping").tolist()
+            inputs = {k: enc[k] for k in tokenizer.model_input_names if k in enc}
+            hidden = model.base_model(**inputs)[0]
+            for n, (_, entities) in enumerate(batch):
+                lbl = token_labels(offsets[n], entities, label2id)
+                mask = enc["attention_mask"][n].bool()
+                feats.append(hidden[n][mask])
+                targets.append(torch.tensor(lbl)[mask])
+    x = torch.cat(feats)
+    y = torch.cat(targets)
+
+    # Train the head
+    for p in model.parameters():
+        p.requires_grad = False
+    for p in head.parameters():
+        p.requires_grad = True
+    opt = torch.optim.Adam(head.parameters(), lr=lr)
+    loss_fn = torch.nn.CrossEntropyLoss(ignore_index=-100)
+    idx = list(range(len(x)))
+    loss = None
+    for epoch in range(epochs):
+        random.shuffle(idx)
+        total = 0.0
+        for i in range(0, len(idx), 256):
+            sel = torch.tensor(idx[i:i+256])
+            opt.zero_grad()
+            loss = loss_fn(head(x[sel]), y[sel])
+            loss.backward()
+            opt.step()
+            total += loss.item() * len(sel)
+        loss = total/len(idx) if idx else 0.0
+        if logger:
+            logger(".. epoch %d: loss %.4f", epoch + 1, loss)
+    model.eval()
+    return loss
+
+
+def build_pruned_model(m: Dict, layers: int, samples: List[Sample] = None,
+                       epochs: int = 3, logger: PiiLogger = None) -> Dict:
+    """
+    Build the pruned version of a configured model, optionally re-fitting
+    its head, and save it in the cache directory
+      :param m: the model entry in the configuration
+      :param layers: number of encoder layers to keep
+      :param samples: a labeled sample to re-fit the classification head
+      :param epochs: training epochs for the head re-fit
+      :param logger: a logger instance
+      :return: the information about the pruned model
+    """
+    if torch is None:
+        raise ConfigException("PyTorch/Transformers packages not found")
+
+    mdname = m["model"]
+    tkname = m.get("tokenizer") or mdname
+    trimmed = bool(m.get("trimmed"))
+    src = mdname
+    if trimmed:
+        # Prune the trimmed model, so that it keeps its own tokenizer
+        from .trim import trimmed_path
+        path = trimmed_path(mdname)
+        if not (path / "config.json").is_file():
+            raise ConfigException("no trimmed model available for {}", mdname)
+        src = tkname = str(path)
+    tokenizer = AutoTokenizer.from_pretrained(tkname)
+    model = AutoModelForTokenClassification.from_pretrained(
+        src, **m.get("model_params", {}))
+    before, after = truncate_layers(model, layers)
+    if logger:
+        logger(".. keeping %d encoder layers out of %d", after, before)
+
+    loss = None
+    if samples:
+        if logger:
+            logger(".. re-fitting head: %d samples", len(samples))
+        try:
+            loss = refit_head(model, tokenizer, samples, epochs=epochs,
+                              logger=logger)
+        except ConfigException:
+            raise
+        except Exception as e:
+            raise ProcException("cannot re-fit head for {}: {}",
+                                mdname, e) from e
+
+    outdir = pruned_path(mdname, layers, trimmed)
+    outdir.mkdir(parents=True, exist_ok=True)
+    tokenizer.save_pretrained(str(outdir))
+    model.save_pretrained(str(outdir))
+
+    info = {
+        "model": mdname,
+        "trimmed": trimmed,
+        "layers": [before, after],
+        "refit_samples": len(samples) if samples else 0,
+        "refit_loss": loss,
+        "date": datetime.now().isoformat(timespec="seconds")
+    }
+    with open(outdir / PRUNE_INFO, "w", encoding="utf-8") as f:
+        json.dump(info, f, indent=2)
+    info["path"] = str(outdir)
+    return info
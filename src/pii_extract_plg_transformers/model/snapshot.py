@@ -0,0 +1,208 @@
+"""
+Single-file snapshots of a fully initialized tokenizer & model, restored by
+memory-mapping the weight tensors. Processes restoring the same snapshot
+share its pages through the page cache, instead of each one keeping a
+private copy of the weights.
+
+Snapshots are pickled Python objects, and restoring one can execute
+arbitrary code: they must be kept in a cache directory writable only by
+the user running the process. Snapshot files that are not owned by that user,
+or that are writable by others, are not restored
+"""
+
+import os
+import stat
+from hashlib import sha256
+from pathlib import Path
+
+try:
+    import torch
+    from transformers import __version__ as transformers_version
+except ImportError:
+    torch = None
+    transformers_version = None
+
+from pii_data.helper.exception import ConfigException, ProcException
+from pii_extract.helper.logger import PiiLogger
+
+from typing import Optional, Tuple
+
+from ..task.utils import artifact_dir, ENV_HF_CACHE
+
+
+# Format tag for snapshot files
+SNAPSHOT_FORMAT = "piisa:snapshot:v2"
+
+# Environment variables that disable access to the Hugging Face Hub
+ENV_OFFLINE = ("HF_HUB_OFFLINE", "TRANSFORMERS_OFFLINE")
+
+
+def snapshot_path(name: str, key: str) -> Path:
+    """
+    Return the snapshot file for a model
+      :param name: the model name
+      :param key: the engine cache key for the model (which identifies its
+        variant and parameters)
+    """
+    path = artifact_dir("snapshots", name, key)
+    return path.with_name(path.name + ".pt")
+
+
+def _hub_commit(name: str, revision: str = None,
+                hub_timeout: float = None) -> Optional[str]:
+    """
+    Return the commit hash a Hub model name resolves to: the one in the local
+    cache or, if a timeout is given, the current one in the Hub (falling back
+    to the local cache if the Hub cannot be reached in time)
+    """
+    try:
+        from huggingface_hub import HfApi, try_to_load_from_cache
+    except ImportError:
+        return None
+    offline = any(os.environ.get(v, "").upper() in ("1", "ON", "YES", "TRUE")
+                  for v in ENV_OFFLINE)
+    if hub_timeout and not offline:
+        try:
+            return HfApi().model_info(name, revision=revision,
+                                      timeout=hub_timeout).sha
+        except Exception:
+            pass
+    for fname in ("config.json", "tokenizer_config.json"):
+        try:
+            cached = try_to_load_from_cache(
+                name, fname, cache_dir=os.environ.get(ENV_HF_CACHE),
+                revision=revision)
+        except Exception:
+            cached = None
+        if isinstance(cached, str):
+            return Path(cached).parent.name     # snapshots/<commit>/<file>
+    return None
+
+
+def model_revision(name: str, revision: str = None,
+                   hub_timeout: float = None) -> Optional[str]:
+    """
+    Identify the current version of a model or tokenizer
+      :param name: a model name in the Hub, or a local folder
+      :param revision: the requested Hub revision, if any
+      :param hub_timeout: query the Hub for the current commit, with this
+        timeout in seconds (default: use the commit in the local cache)
+      :return: for a Hub model, its resolved commit hash; for a local folder,
+        a digest of its config plus the size and modification time of its
+        files; None if it cannot be determined
+    """
+    path = Path(name)
+    if not path.is_dir():
+        return _hub_commit(name, revision, hub_timeout)
+    digest = sha256()
+    for f in sorted(path.iterdir()):
+        if f.is_file():
+            st = f.stat()
+            digest.update(f"{f.name}:{st.st_size}:{st.st_mtime_ns}\n".encode())
+    cfg = path / "config.json"
+    if cfg.is_file():
+        digest.update(cfg.read_bytes())
+    return "local:" + digest.hexdigest()
+
+
+def source_revision(model: str, tokenizer: str, revision: str = None,
+                    hub_timeout: float = None) -> Optional[str]:
+    """
+    Identify the current version of the sources of a snapshot: the model and
+    the tokenizer (see `model_revision()`)
+      :return: the revision, or None if it cannot be determined
+    """
+    mrev = model_revision(model, revision, hub_timeout)
+    trev = mrev if tokenizer == model else \
+        model_revision(tokenizer, hub_timeout=hub_timeout)
+    return None if mrev is None or trev is None else f"{mrev}|{trev}"
+
+
+def _trusted(path: Path) -> bool:
+    """
+    Check that a snapshot file can only have been written by the current user
+    """
+    if not hasattr(os, "getuid"):
+        return True
+    st = path.stat()
+    return st.st_uid == os.getuid() and not st.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+
+
+def write_snapshot(path: Path, tokenizer, model, key: str, revision: str):
+    """
+    Write a tokenizer & model into a snapshot file. The file is written
+    under a temporary name and then renamed, so that processes starting at
+    the same time never see a partial file
+      :param path: the snapshot file
+      :param tokenizer: the tokenizer
+      :param model: the model
+      :param key: the engine cache key for the model
+      :param revision: the version of the model source (as given by
+        `model_revision()`)
+    """
+    if torch is None:
+        raise ConfigException("PyTorch/Transformers packages not found")
+    if not isinstance(model, torch.nn.Module):
+        raise ConfigException("cannot snapshot a non-PyTorch model: {}", key)
+    if revision is None:
+        raise ProcException("cannot snapshot {}: unknown model revision", key)
+    data = {"format": SNAPSHOT_FORMAT, "key": key, "revision": revision,
+            "torch": torch.__version__, "transformers": transformers_version,
+            "tokenizer": tokenizer, "model": model}
+    path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    try:
+        torch.save(data, str(tmp))
+        os.chmod(tmp, 0o600)
+        os.replace(tmp, path)
+    except Exception as e:
+        tmp.unlink(missing_ok=True)
+        raise ProcException("cannot write snapshot {}: {}", path, e) from e
+
+
+def read_snapshot(path: Path, key: str, revision: str,
+                  logger: PiiLogger = None) -> Optional[Tuple]:
+    """
+    Restore a tokenizer & model from a snapshot file, memory-mapping the
+    weights (read-only pages, shared with other processes until written)
+      :param path: the snapshot file
+      :param key: the engine cache key for the model
+      :param revision: the current version of the model source
+      :param logger: a logger instance
+      :return: a (tokenizer, model) tuple, or None if the snapshot cannot be
+        used (it was written for another model variant or revision or by
+        other library versions, it is damaged, or it is not trusted)
+    """
+    if torch is None:
+        raise ConfigException("PyTorch/Transformers packages not found")
+    if revision is None:
+        if logger:
+            logger(".... snapshot %s not used: unknown model revision", path)
+        return None
+    if not _trusted(path):
+        if logger:
+            logger(".... snapshot %s not used: writable by other users", path)
+        return None
+    try:
+        try:
+            data = torch.load(str(path), map_location="cpu", mmap=True,
+                              weights_only=False)
+        except TypeError:   # PyTorch < 2.1: no memory-mapping
+            if logger:
+                logger(".... snapshot loaded without memory-mapping (PyTorch %s)",
+                       torch.__version__)
+            data = torch.load(str(path), map_location="cpu")
+    except Exception as e:
+        if logger:
+            logger(".... cannot read snapshot %s: %s", path, e)
+        return None
+
+    if (data.get("format") != SNAPSHOT_FORMAT or data.get("key") != key
+            or data.get("revision") != revision
+            or data.get("torch") != torch.__version__
+            or data.get("transformers") != transformers_version):
+        if logger:
+            logger(".... snapshot %s does not match the model revision or library versions",
+                   path)
+        return None
+    return data["tokenizer"], data["model"]
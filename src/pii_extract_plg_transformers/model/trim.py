@@ -0,0 +1,212 @@
+"""
+Trim the vocabulary of a model (and its tokenizer) to the tokens used in a
+reference corpus, to shrink the size of its embedding matrix
+"""
+
+import json
+from datetime import datetime
+from pathlib import Path
+
+try:
+    import torch
+    from transformers import AutoTokenizer, AutoModelForTokenClassification
+except ImportError:
+    torch = None
+
+from pii_data.helper.exception import ConfigException, ProcException
+from pii_extract.helper.logger import PiiLogger
+
+from typing import Dict, Iterable, List, Set, Tuple
+
+from ..task.utils import artifact_dir
+
+
+# Name of the file with information about a trimmed model
+TRIM_INFO = "piisa-trim.json"
+
+# Tokenizer models we can trim
+TRIM_MODELS = "WordPiece", "Unigram"
+
+
+def trimmed_path(model: str) -> Path:
+    """
+    Return the folder containing the trimmed version of a model
+    """
+    return artifact_dir("trimmed", model)
+
+
+def used_tokens(tokenizer, texts: Iterable[str],
+                batch_size: int = 256) -> Tuple[Set[int], Set[str]]:
+    """
+    Find the tokens used when tokenizing a corpus
+      :return: a tuple (set of token ids, set of characters in the corpus)
+    """
+    texts = list(texts)
+    ids, chars = set(), set()
+    for i in range(0, len(texts), batch_size):
+        batch = texts[i:i+batch_size]
+        for t in tokenizer(batch, add_special_tokens=False)["input_ids"]:
+            ids.update(t)
+        for t in batch:
+            chars.update(t)
+    return ids, chars
+
+
+def _keep_ids(tokenizer, tk_model: Dict, used: Set[int],
+              chars: Set[str]) -> List[int]:
+    """
+    Decide the token ids to keep: the used ones, plus all special tokens, plus
+    the single-character tokens for characters in the corpus (so that unseen
+    words can still be tokenized with pieces instead of UNK)
+    """
+    keep = set(used)
+    keep.update(tokenizer.all_special_ids)
+    keep.update(tokenizer.get_added_vocab().values())
+
+    prefix = tk_model.get("continuing_subword_prefix") or ""
+    for tok, idx in tokenizer.get_vocab().items():
+        if prefix and tok.startswith(prefix):
+            tok = tok[len(prefix):]
+        tok = tok.lstrip("▁")
+        if (len(tok) == 1 and tok in chars) or tok.startswith("<0x"):
+            keep.add(idx)
+    return sorted(keep)
+
+
+def _remap_processor(obj, remap: Dict[int, int]):
+    """
+    Change the token ids in a tokenizer post-processor definition
+    """
+    if isinstance(obj, dict):
+        for k, v in obj.items():
+            if k == "ids" and isinstance(v, list):
+                obj[k] = [remap[i] for i in v]
+            elif k in ("sep", "cls") and isinstance(v, list) and len(v) == 2:
+                obj[k] = [v[0], remap[v[1]]]
+            else:
+                _remap_processor(v, remap)
+    elif isinstance(obj, list):
+        for v in obj:
+            _remap_processor(v, remap)
+
+
+def trim_tokenizer(tokenizer, keep: List[int], outdir: Path):
+    """
+    Save a tokenizer with a vocabulary restricted to a set of tokens, and
+    load it back
+      :param tokenizer: the original (fast) tokenizer
+      :param keep: the ids of the tokens to keep, sorted
+      :param outdir: the destination folder
+    """
+    if not tokenizer.is_fast:
+        raise ConfigException("vocabulary trimming needs a fast tokenizer")
+    data = json.loads(tokenizer.backend_tokenizer.to_str())
+    tk_model = data["model"]
+    if tk_model["type"] not in TRIM_MODELS:
+        raise ConfigException("cannot trim vocabulary for tokenizer model {}",
+                              tk_model["type"])
+
+    remap = {old: new for new, old in enumerate(keep)}
+    if tk_model["type"] == "WordPiece":
+        tk_model["vocab"] = {t: remap[i] for t, i in tk_model["vocab"].items()
+                             if i in remap}
+    else:
+        tk_model["vocab"] = [tk_model["vocab"][i] for i in keep]
+        if tk_model.get("unk_id") is not None:
+            tk_model["unk_id"] = remap[tk_model["unk_id"]]
+    for t in data.get("added_tokens") or []:
+        t["id"] = remap[t["id"]]
+    _remap_processor(data.get("post_processor"), remap)
+
+    # Save the tokenizer, and replace its definition (removing the files
+    # for the slow version, which would carry the original vocabulary)
+    tokenizer.save_pretrained(outdir)
+    for name in tokenizer.vocab_files_names.values():
+        if name != "tokenizer.json":
+            (outdir / name).unlink(missing_ok=True)
+    with open(outdir / "tokenizer.json", "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    return AutoTokenizer.from_pretrained(str(outdir))
+
+
+def trim_model(model, keep: List[int]) -> Tuple[int, int]:
+    """
+    Restrict the input embedding matrix of a model to a set of tokens
+      :return: the size in bytes of the embedding matrix, before and after
+    """
+    remap = {old: new for new, old in enumerate(keep)}
+    emb = model.get_input_embeddings()
+    pad = remap.get(emb.padding_idx) if emb.padding_idx is not None else None
+    new = torch.nn.Embedding(len(keep), emb.embedding_dim, padding_idx=pad,
+                             dtype=emb.weight.dtype)
+    with torch.no_grad():
+        new.weight.copy_(emb.weight[torch.tensor(keep, dtype=torch.long)])
+    model.set_input_embeddings(new)
+
+    model.config.vocab_size = len(keep)
+    if model.config.pad_token_id is not None:
+        model.config.pad_token_id = remap.get(model.config.pad_token_id)
+
+    def nbytes(e):
+        return e.weight.numel() * e.weight.element_size()
+    return nbytes(emb), nbytes(new)
+
+
+def build_trimmed_model(m: Dict, texts: List[str], languages: Iterable[str],
+                        logger: PiiLogger = None) -> Dict:
+    """
+    Build the trimmed version of a configured model, and save it in the
+    cache directory
+      :param m: the model entry in the configuration
+      :param texts: the reference corpus
+      :param languages: the languages the corpus covers
+      :param logger: a logger instance
+      :return: the information about the trimmed model
+    """
+    if torch is None:
+        raise ConfigException("PyTorch/Transformers packages not found")
+
+    mdname = m["model"]
+    tkname = m.get("tokenizer") or mdname
+    tokenizer = AutoTokenizer.from_pretrained(tkname)
+    model = AutoModelForTokenClassification.from_pretrained(
+        mdname, **m.get("model_params", {}))
+    if not tokenizer.is_fast:
+        raise ConfigException("vocabulary trimming needs a fast tokenizer")
+
+    # Find the tokens to keep
+    if logger:
+        logger(".. scanning corpus: %d texts", len(texts))
+    used, chars = used_tokens(tokenizer, texts)
+    tk_model = json.loads(tokenizer.backend_tokenizer.to_str())["model"]
+    keep = _keep_ids(tokenizer, tk_model, used, chars)
+    if logger:
+        logger(".. keeping %d tokens out of %d", len(keep), len(tokenizer))
+
+    # Trim & save
+    outdir = trimmed_path(mdname)
+    outdir.mkdir(parents=True, exist_ok=True)
+    try:
+        trim_tokenizer(tokenizer, keep, outdir)
+        emb_bytes = trim_model(model, keep)
+        model.save_pretrained(str(outdir))
+    except ConfigException:
+        raise
+    except Exception as e:
+        raise ProcException("cannot build trimmed model for {}: {}",
+                            mdname, e) from e
+
+    info = {
+        "model": mdname,
+        "tokenizer": tkname,
+        "languages": sorted(languages),
+        "corpus_texts": len(texts),
+        "vocab_size": len(tokenizer),
+        "trimmed_vocab_size": len(keep),
+        "embedding_bytes": list(emb_bytes),
+        "date": datetime.now().isoformat(timespec="seconds")
+    }
+    with open(outdir / TRIM_INFO, "w", encoding="utf-8") as f:
+        json.dump(info, f, indent=2)
+    info["path"] = str(outdir)
+    return info
@@ -0,0 +1,85 @@
+"""
+Utilities for the model tools: reading a local text corpus, and comparing
+detection results
+"""
+
+from itertools import islice
+
+from typing import Dict, Iterable, List, Set, Tuple
+
+from pii_data.helper.exception import FileException
+
+
+def read_corpus(paths: Iterable[str], max_texts: int = None) -> List[str]:
+    """
+    Read a local corpus of plain text files; each non-empty line is a text
+      :param paths: the files to read
+      :param max_texts: maximum number of texts to read
+    """
+    def lines():
+        for name in paths:
+            try:
+                with open(name, encoding="utf-8") as f:
+                    for line in f:
+                        line = line.strip()
+                        if line:
+                            yield line
+            except OSError as e:
+                raise FileException("cannot read corpus file '{}': {}",
+                                    name, e) from e
+    return list(islice(lines(), max_texts))
+
+
+def entity_set(results: List[Dict]) -> Set[Tuple]:
+    """
+    Convert the pipeline results for a text into a set of (label, start, end)
+    """
+    return set((r.get("entity_group", r.get("entity")), r["start"], r["end"])
+               for r in results)
+
+
+def agreement(reference: List[List[Dict]], results: List[List[Dict]],
+              labels: Iterable[str] = None) -> Dict:
+    """
+    Compare the results obtained for a list of texts against reference results
+      :param reference: the reference results, one list per text
+      :param results: the results to compare, one list per text
+      :param labels: consider only these labels (default: all)
+      :return: a dict with entity-level precision, recall and F1, and the
+        fraction of texts with identical results
+    """
+    ref_total = got_total = common = equal = 0
+    for ref, got in zip(reference, results):
+        ref, got = entity_set(ref), entity_set(got)
+        if labels:
+            ref = set(e for e in ref if e[0] in labels)
+            got = set(e for e in got if e[0] in labels)
+        ref_total += len(ref)
+        got_total += len(got)
+        common += len(ref & got)
+        equal += ref == got
+
+    p = common/got_total if got_total else 1.0
+    r = common/ref_total if ref_total else 1.0
+    num = len(reference)
+    return {"texts": num, "equal": equal/num if num else 1.0,
+            "entities_ref": ref_total, "entities": got_total,
+            "precision": p, "recall": r,
+            "f1": 2*p*r/(p + r) if p + r else 0.0}
+
+
+def compare_pipelines(reference, pipeline, texts: List[str],
+                      batch_size: int = 8, labels: Iterable[str] = None) -> Dict:
+    """
+    Compare the entities produced by a pipeline against a reference pipeline
+    (e.g. a modified model against the full one)
+      :param reference: the reference pipeline
+      :param pipeline: the pipeline to evaluate
+      :param texts: the texts to process
+      :param batch_size: number of texts per pipeline call
+      :param labels: consider only these labels (default: all)
+      :return: the result of `agreement()`
+    """
+    ref = reference(texts, batch_size=batch_size)
+    got = pipeline(texts, batch_size=batch_size)
+    return agreement(ref, got, labels)
@@ -0,0 +1,181 @@
+"""
+Adaptive batch sizing: adjust the batch size and token budget for batched
+detection to keep latency under a target while maximizing throughput
+"""
+
+from math import ceil
+from time import perf_counter
+from collections import deque, Counter
+from threading import Lock
+
+from typing import Dict, List
+
+
+def approx_tokens(text: str) -> int:
+    """
+    A cheap estimate of the number of model tokens in a text
+    """
+    return len(text)//4 + 1
+
+
+def percentile(values: List[float], q: float) -> float:
+    """
+    Compute a percentile (nearest rank) over a list of values
+    """
+    values = sorted(values)
+    rank = min(len(values), max(1, ceil(q*len(values))))
+    return values[rank - 1]
+
+
+class BatchController:
+    """
+    Measure the latency and throughput of batches, and grow or shrink the
+    batch size (number of chunks) and token budget (approximate number of
+    tokens) for the next batches:
+      * if the p95 batch latency goes over the target, both limits shrink
+        multiplicatively
+      * if there is latency headroom, they grow, as long as throughput
+        (tokens/sec) keeps improving
+    """
+
+    def __init__(self, target_p95: float = 0.5, batch_size: int = 8,
+                 min_batch: int = 1, max_batch: int = 128,
+                 token_budget: int = None, window: int = 20,
+                 min_samples: int = 5):
+        """
+          :param target_p95: target p95 latency for a batch, in seconds
+          :param batch_size: initial batch size
+          :param min_batch: minimum batch size
+          :param max_batch: maximum batch size
+          :param token_budget: initial token budget for a batch (default is
+            128 tokens per chunk in the batch)
+          :param window: number of batches in the latency window
+          :param min_samples: minimum number of batches measured before
+            adjusting the limits
+        """
+        self.target = target_p95
+        self.min_batch = min_batch
+        self.max_batch = max_batch
+        self.batch_size = min(max(batch_size, min_batch), max_batch)
+        self.token_budget = token_budget or 128*self.batch_size
+        self.window = window
+        self.min_samples = min_samples
+        self._init()
+
+
+    def _init(self):
+        self._lat = deque(maxlen=self.window)
+        self._tok = deque(maxlen=self.window)
+        self._tps = {}
+        self._lock = Lock()
+        self.stats = Counter()
+
+
+    def __repr__(self) -> str:
+        return f"<BatchController bs={self.batch_size} tokens={self.token_budget} target={self.target}>"
+
+
+    def __getstate__(self) -> Dict:
+        state = self.__dict__.copy()
+        for f in ("_lat", "_tok", "_tps", "_lock", "stats"):
+            del state[f]
+        return state
+
+
+    def __setstate__(self, state: Dict):
+        self.__dict__.update(state)
+        self._init()
+
+
+    def limits(self) -> tuple:
+        """
+        Return the current limits for a batch: (batch size, token budget)
+        """
+        with self._lock:
+            return self.batch_size, self.token_budget
+
+
+    def batches(self, items: List, key=None):
+        """
+        Split a sequence of items into batches, respecting the current limits
+          :param items: the items to split
+          :param key: a function returning the text for an item
+        """
+        batch, tokens = [], 0
+        size, budget = self.limits()
+        for item in items:
+            n = approx_tokens(key(item) if key else item)
+            if batch and (len(batch) >= size or tokens + n > budget):
+                yield batch
+                batch, tokens = [], 0
+                size, budget = self.limits()
+            batch.append(item)
+            tokens += n
+        if batch:
+            yield batch
+
+
+    def start(self) -> float:
+        """
+        Get a start timestamp for a batch
+        """
+        return perf_counter()
+
+
+    def record(self, start: float, chunks: int, tokens: int):
+        """
+        Record the processing of a batch, and adjust the limits
+          :param start: the start timestamp for the batch
+          :param chunks: number of chunks in the batch
+          :param tokens: approximate number of tokens in the batch
+        """
+        elapsed = perf_counter() - start
+        with self._lock:
+            self.stats["batches"] += 1
+            self.stats["chunks"] += chunks
+            self.stats["tokens"] += tokens
+            self._lat.append(elapsed)
+            self._tok.append(tokens)
+            if len(self._lat) >= self.min_samples:
+                self._adjust()
+
+
+    def _adjust(self):
+        """
+        Adjust the batch limits according to the measured latency
+        """
+        p95 = percentile(self._lat, 0.95)
+        tps = sum(self._tok)/sum(self._lat) if sum(self._lat) else 0
+        self._tps[self.batch_size] = tps
+        smaller = [b for b in self._tps if b < self.batch_size]
+        prev = self._tps[max(smaller)] if smaller else 0
+
+        if p95 > self.target:
+            self.batch_size = max(self.min_batch, int(self.batch_size*0.7))
+            self.token_budget = max(1, int(self.token_budget*0.7))
+            self.stats["shrink"] += 1
+        elif p95 < 0.8*self.target and tps >= 0.95*prev:
+            if self.batch_size < self.max_batch:
+                self.batch_size = min(self.max_batch,
+                                      self.batch_size + max(1, self.batch_size//4))
+            self.token_budget = min(512*self.max_batch,
+                                    int(self.token_budget*1.25))
+            self.stats["grow"] += 1
+        else:
+            return
+        # Limits changed: start a new measurement window
+        self._lat.clear()
+        self._tok.clear()
+
+
+    def get_stats(self) -> Dict:
+        """
+        Return the current settings and the processing statistics
+        """
+        with self._lock:
+            lat = list(self._lat)
+            return {**self.stats, "batch_size": self.batch_size,
+                    "token_budget": self.token_budget,
+                    "target_p95": self.target,
+                    "p95": percentile(lat, 0.95) if lat else None,
+                    "tokens_per_sec": self._tps.get(self.batch_size)}
@@ -0,0 +1,91 @@
+"""
+Cascade detection: a small, fast model selects the texts that contain
+candidate entities, and only those are sent to the main model
+"""
+
+from collections import Counter
+
+from typing import Dict, Iterable, List, Tuple
+
+
+class Cascade:
+    """
+    The first stage of a cascade. It also measures the recall of the cascade
+    against the main model alone, by sending a sample of the texts to the main
+    model regardless of the first stage decision
+    """
+
+    def __init__(self, pipeline, labels: Iterable[str], threshold: float = 0.3,
+                 sample: float = 0):
+        """
+          :param pipeline: the pipeline for the first stage model
+          :param labels: the model labels that define a candidate entity
+          :param threshold: minimum score for a candidate entity
+          :param sample: fraction of the texts to send to the main model
+            for recall measurement
+        """
+        self.pipeline = pipeline
+        self.labels = set(labels)
+        self.threshold = threshold
+        self._sample_every = round(1/sample) if sample else 0
+        self.stats = Counter()
+
+
+    def __repr__(self) -> str:
+        return f"<Cascade {sorted(self.labels)} th={self.threshold}>"
+
+
+    def _is_candidate(self, results: List[Dict]) -> bool:
+        return any(r.get("entity_group", r.get("entity")) in self.labels
+                   and r["score"] >= self.threshold for r in results)
+
+
+    def select(self, texts: List[str],
+               batch_size: int = None) -> Tuple[List[bool], List[bool]]:
+        """
+        Decide which texts must go to the main model
+          :return: a tuple with two lists of flags: texts with candidate
+            entities, and texts sampled for recall measurement
+        """
+        results = self.pipeline(texts, batch_size=batch_size)
+        keep = [self._is_candidate(r) for r in results]
+
+        sample = [False] * len(texts)
+        if self._sample_every:
+            first = self.stats["chunks"]
+            sample = [(first + n) % self._sample_every == 0
+                      for n in range(len(texts))]
+
+        self.stats["chunks"] += len(texts)
+        self.stats["candidates"] += sum(keep)
+        return keep, sample
+
+
+    def record(self, keep: List[bool], sample: List[bool],
+               num_entities: List[int]):
+        """
+        Record the main model results on the sampled texts
+          :param keep: the candidate flags
+          :param sample: the sample flags
+          :param num_entities: number of entities found by the main model in
+            each text (only used for sampled texts)
+        """
+        for k, s, n in zip(keep, sample, num_entities):
+            if s:
+                self.stats["sampled"] += 1
+                self.stats["sample_entities"] += n
+                if not k:
+                    self.stats["sample_missed"] += n
+
+
+    def get_stats(self) -> Dict:
+        """
+        Return the cascade statistics, including the fraction of texts that
+        skipped the main model and the recall of the cascade on the sample
+        """
+        st = dict(self.stats)
+        if st.get("chunks"):
+            st["skip_rate"] = 1 - st["candidates"]/st["chunks"]
+        if st.get("sample_entities"):
+            st["recall"] = 1 - st.get("sample_missed", 0)/st["sample_entities"]
+        return st
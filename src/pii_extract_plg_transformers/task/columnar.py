@@ -0,0 +1,184 @@
+"""
+Columnar detection results: the entities found in a batch of chunks, kept
+as parallel arrays instead of one PiiEntity object per entity, plus writers
+for Arrow IPC & Parquet files
+"""
+
+import json
+from array import array
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pa = None
+
+from pii_data.helper.exception import ConfigException
+from pii_data.types import PiiEntityInfo
+
+from typing import Dict, Iterable, List, Tuple
+
+from .. import VERSION
+
+
+# Output formats for columnar results
+FORMATS = ("arrow", "parquet")
+
+# Key for the entity type table in the Arrow schema metadata
+META_TYPES = b"piisa:entity_types"
+
+
+class ColumnarResults:
+    """
+    The entities detected in a batch of chunks, as columns:
+      * chunk: index of the chunk in the sequence of processed chunks
+      * start, end: character positions of the entity in its chunk
+      * type: entity type id (an index into the `types` table)
+      * lang: language of the chunk
+      * score: model score for the entity
+    """
+
+    __slots__ = "types", "chunk", "start", "end", "type", "lang", "score"
+
+
+    def __init__(self, types: List[PiiEntityInfo]):
+        """
+          :param types: the entity type table
+        """
+        self.types = types
+        self.chunk = array("q")
+        self.start = array("q")
+        self.end = array("q")
+        self.type = array("H")
+        self.lang = []
+        self.score = array("f")
+
+
+    def __repr__(self) -> str:
+        return f"<ColumnarResults #{len(self)}>"
+
+
+    def __len__(self) -> int:
+        return len(self.start)
+
+
+    def append(self, chunk: int, start: int, end: int, type_id: int,
+               lang: str, score: float):
+        """
+        Add an entity
+        """
+        self.chunk.append(chunk)
+        self.start.append(start)
+        self.end.append(end)
+        self.type.append(type_id)
+        self.lang.append(lang)
+        self.score.append(score)
+
+
+    def shift(self, offsets: List[int]):
+        """
+        Add an offset to the entity positions, depending on their chunk
+          :param offsets: the offset for each chunk, indexed by chunk index
+        """
+        for n, c in enumerate(self.chunk):
+            self.start[n] += offsets[c]
+            self.end[n] += offsets[c]
+
+
+    def rows(self) -> Iterable[Tuple]:
+        """
+        Iterate over the entities, as tuples (chunk, start, end,
+        PiiEntityInfo, lang, score)
+        """
+        types = self.types
+        return zip(self.chunk, self.start, self.end,
+                   (types[t] for t in self.type), self.lang, self.score)
+
+
+    def to_arrow(self) -> "pa.RecordBatch":
+        """
+        Convert to an Arrow record batch
+        """
+        _check()
+        return pa.RecordBatch.from_arrays([
+            pa.array(self.chunk, pa.int64()),
+            pa.array(self.start, pa.int64()),
+            pa.array(self.end, pa.int64()),
+            pa.array(self.type, pa.uint16()),
+            pa.array(self.lang, pa.string()).dictionary_encode(),
+            pa.array(self.score, pa.float32())
+        ], schema=arrow_schema(self.types))
+
+
+def _check():
+    if pa is None:
+        raise ConfigException("pyarrow package not found, needed for Arrow/Parquet output")
+
+
+def arrow_schema(types: List[PiiEntityInfo], metadata: Dict = None) -> "pa.Schema":
+    """
+    Build the Arrow schema for columnar results. The entity type table is
+    stored as JSON in the schema metadata
+      :param types: the entity type table
+      :param metadata: additional metadata to add to the schema
+    """
+    _check()
+    meta = {META_TYPES: json.dumps([t.asdict() for t in types]),
+            b"piisa:version": VERSION}
+    for k, v in (metadata or {}).items():
+        meta[f"piisa:{k}".encode("utf-8")] = v if isinstance(v, str) else json.dumps(v)
+    return pa.schema([
+        ("chunk", pa.int64()),
+        ("start", pa.int64()),
+        ("end", pa.int64()),
+        ("type", pa.uint16()),
+        ("lang", pa.dictionary(pa.int32(), pa.string())),
+        ("score", pa.float32())
+    ], metadata=meta)
+
+
+class ColumnarWriter:
+    """
+    Write a sequence of columnar results into an Arrow IPC or Parquet file,
+    one record batch (or row group) at a time
+    """
+
+    def __init__(self, filename: str, types: List[PiiEntityInfo],
+                 fmt: str = "arrow", metadata: Dict = None):
+        """
+          :param filename: the output file
+          :param types: the entity type table
+          :param fmt: the file format: "arrow" (Arrow IPC) or "parquet"
+          :param metadata: additional metadata to add to the file schema
+        """
+        _check()
+        if fmt not in FORMATS:
+            raise ConfigException("unknown columnar output format: {}", fmt)
+        self.schema = arrow_schema(types, metadata)
+        self.num = 0
+        if fmt == "arrow":
+            self._w = pa.ipc.new_file(filename, self.schema)
+        else:
+            self._w = pa.parquet.ParquetWriter(filename, self.schema)
+
+
+    def __enter__(self) -> "ColumnarWriter":
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    def write(self, results: ColumnarResults):
+        """
+        Write a set of results
+        """
+        if len(results):
+            self._w.write_batch(results.to_arrow())
+            self.num += len(results)
+
+
+    def close(self):
+        self._w.close()
@@ -0,0 +1,59 @@
+"""
+Distribute detection over partitions of chunks, using worker processes
+"""
+
+from multiprocessing import Pool
+
+from typing import Iterable, List
+
+from pii_data.types import PiiEntity
+from pii_data.types.doc import DocumentChunk
+
+from .task import TransformersTask
+
+
+class PartitionDetector:
+    """
+    A picklable callable that performs detection over a partition of chunks.
+    It can be sent to multiprocessing workers, or used as the function for
+    Spark `mapPartitions` or Dask `map_partitions`.
+
+    The task travels as a lightweight spec; in each worker process its
+    pipelines are loaded on first use and then kept in the engine cache
+    """
+
+    def __init__(self, task: TransformersTask, batch_size: int = None):
+        """
+          :param task: the task object to use for detection
+          :param batch_size: chunks per pipeline call (default: task config)
+        """
+        self.task = task
+        self.batch_size = batch_size
+
+
+    def __repr__(self) -> str:
+        return f"<PartitionDetector {self.task}>"
+
+
+    def __call__(self, chunks: Iterable[DocumentChunk]) -> List[PiiEntity]:
+        """
+        Detect PII in all the chunks of a partition
+        """
+        return list(self.task.find_batch(chunks, self.batch_size))
+
+
+def map_partitions(task: TransformersTask,
+                   partitions: Iterable[List[DocumentChunk]],
+                   processes: int = None,
+                   batch_size: int = None) -> Iterable[List[PiiEntity]]:
+    """
+    Perform detection over partitions of chunks in a local process pool
+      :param task: the task object to use for detection
+      :param partitions: an iterable of partitions, each one a list of chunks
+      :param processes: number of worker processes (default: number of CPUs)
+      :param batch_size: chunks per pipeline call (default: task config)
+    Produces the list of detected entities for each partition, in order
+    """
+    detector = PartitionDetector(task, batch_size)
+    with Pool(processes) as pool:
+        yield from pool.imap(detector, partitions)
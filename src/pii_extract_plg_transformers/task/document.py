@@ -0,0 +1,91 @@
+"""
+Perform detection over full source documents, batching their chunks across
+documents
+"""
+
+from collections import deque
+
+from typing import Iterable, Tuple
+
+from pii_data.types.doc import DocumentChunk, SrcDocument
+from pii_data.types.doc.defs import META_DOC
+from pii_data.types.piicollection import PiiDetector, PiiCollection
+
+from .task import TransformersTask
+
+
+def document_chunks(doc: SrcDocument, lang: str = None,
+                    context: bool = False) -> Iterable[DocumentChunk]:
+    """
+    Iterate over the chunks of a document, ensuring they have a language.
+    Chunks without a context of their own share a single context dict for
+    the document, instead of getting a copy each
+      :param doc: the document
+      :param lang: the document language (default: the one in the document
+        metadata)
+      :param context: add context to the chunks (document metadata and
+        before/after fields)
+    """
+    lang = lang or doc.metadata[META_DOC].get("main_lang")
+    shared = {"lang": lang} if lang else None
+    for chunk in doc.iter_full(context=context):
+        if chunk.context is None:
+            chunk.context = shared
+        elif lang and "lang" not in chunk.context:
+            chunk.context = {**chunk.context, "lang": lang}
+        yield chunk
+
+
+def detect_documents(task: TransformersTask, docs: Iterable[SrcDocument],
+                     lang: str = None, batch_size: int = None,
+                     context: bool = False) -> Iterable[Tuple[SrcDocument, PiiCollection]]:
+    """
+    Perform PII detection over a sequence of documents. Chunks are read
+    lazily from each document and sent to the task in batches, which can
+    span document boundaries
+      :param task: the task object
+      :param docs: the documents to process
+      :param lang: the language for all documents (default: the one in
+        each document metadata)
+      :param batch_size: chunks per pipeline call (default: task config)
+      :param context: add context to the chunks
+      :return: an iterable of tuples (document, PII collection), produced
+        as soon as all the chunks in a document have been processed
+    """
+    tinfo = task.task_info
+    det = PiiDetector(source=tinfo.source, name=tinfo.name,
+                      version=tinfo.version, method=tinfo.method)
+
+    # Documents started (in order), and the document for each chunk sent
+    started = deque()
+    chunk_doc = deque()
+
+    def chunks():
+        for n, doc in enumerate(docs):
+            started.append((n, doc))
+            for chunk in document_chunks(doc, lang, context):
+                chunk_doc.append(n)
+                yield chunk
+
+    def collection(doc: SrcDocument) -> PiiCollection:
+        return PiiCollection(lang=lang or doc.metadata[META_DOC].get("main_lang"),
+                             docid=doc.id)
+
+    current = None
+    for _, pii_list in task.find_chunks(chunks(), batch_size):
+        n = chunk_doc.popleft()
+        # Finish the documents before the one this chunk belongs to
+        while current is None or current[0] < n:
+            if current is not None:
+                yield current[1], current[2]
+            idx, doc = started.popleft()
+            current = idx, doc, collection(doc)
+        for pii in pii_list:
+            current[2].add(pii, det)
+
+    # Finish the pending documents (including those with no chunks)
+    if current is not None:
+        yield current[1], current[2]
+    while started:
+        _, doc = started.popleft()
+        yield doc, collection(doc)
@@ -0,0 +1,96 @@
+"""
+A pipelined execution engine: each processing stage runs in its own thread,
+connected to the next one by a bounded queue
+"""
+
+from queue import Queue, Full, Empty
+from threading import Thread, Event
+
+from typing import Any, Callable, Iterable
+
+
+# Marks the end of the items in a queue
+_END = object()
+
+
+class _Failure:
+    """
+    An exception raised in a stage, to be propagated downstream
+    """
+    def __init__(self, exc: BaseException):
+        self.exc = exc
+
+
+def _put(q: Queue, item: Any, stop: Event):
+    """
+    Put an item in a queue, giving up if the engine is stopped
+    """
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return
+        except Full:
+            pass
+
+
+def _iter_queue(q: Queue, stop: Event) -> Iterable:
+    """
+    Get items from a queue until its end, or until the engine is stopped
+    """
+    while not stop.is_set():
+        try:
+            item = q.get(timeout=0.1)
+        except Empty:
+            continue
+        if item is _END:
+            return
+        yield item
+
+
+def _run_stage(func: Callable, src: Iterable, dst: Queue, stop: Event):
+    """
+    Apply a function to all items from the source and send the results
+    downstream
+    """
+    try:
+        for item in src:
+            if stop.is_set():
+                break
+            _put(dst, item if isinstance(item, _Failure) else func(item), stop)
+    except BaseException as e:
+        _put(dst, _Failure(e), stop)
+    finally:
+        _put(dst, _END, stop)
+
+
+def staged(source: Iterable, *stages: Callable,
+           queue_size: int = 2) -> Iterable:
+    """
+    Process items through a sequence of stages, each one running in a separate
+    thread, so that a stage works on an item while the next one works on the
+    previous item. Results are produced in the same order as the source items.
+      :param source: the iterable of items to process
+      :param stages: the functions to apply, in order
+      :param queue_size: maximum number of items waiting between stages
+    Exceptions raised in a stage are re-raised in the consumer thread.
+    """
+    stop = Event()
+    threads = []
+    src = source
+    for func in stages:
+        dst = Queue(queue_size)
+        t = Thread(target=_run_stage, args=(func, src, dst, stop),
+                   daemon=True)
+        t.start()
+        threads.append(t)
+        src = _iter_queue(dst, stop)
+
+    try:
+        for item in src:
+            if isinstance(item, _Failure):
+                raise item.exc
+            yield item
+    finally:
+        stop.set()
+        for t in threads:
+            t.join(timeout=1)
@@ -0,0 +1,146 @@
+"""
+Process-wide execution settings for the models: PyTorch thread pools,
+tokenizer parallelism, gradient mode and CPU affinity
+"""
+
+import os
+from threading import Lock
+
+try:
+    import torch
+except ImportError:
+    torch = None
+
+from pii_data.helper.exception import ConfigException
+from pii_extract.helper.logger import PiiLogger
+
+from typing import Dict, Optional, Set
+
+# Environment variable used by the tokenizers library
+ENV_TOKENIZERS = "TOKENIZERS_PARALLELISM"
+
+# Default environment variable holding the worker index
+ENV_WORKER = "PII_WORKER_INDEX"
+
+# Gradient modes for model inference
+GRAD_MODES = ("inference", "no_grad")
+
+# The settings applied in this process
+_APPLIED = {}
+_LOCK = Lock()
+
+
+def worker_index(options: Dict) -> Optional[int]:
+    """
+    Find the index of the current worker process (or model replica)
+    """
+    value = options.get("worker_index")
+    if value is None:
+        value = os.environ.get(options.get("worker_env", ENV_WORKER))
+    try:
+        return None if value is None else int(value)
+    except ValueError as e:
+        raise ConfigException("invalid worker index: {}", value) from e
+
+
+def cpu_set(options: Dict) -> Optional[Set[int]]:
+    """
+    Decide the CPU affinity set for this process: either a single list of
+    CPUs, or a list of sets from which one is chosen by the worker index
+    """
+    cpus = options.get("cpu_affinity")
+    if not cpus:
+        return None
+    if all(isinstance(c, int) for c in cpus):
+        return set(cpus)
+    idx = worker_index(options)
+    if idx is None:
+        raise ConfigException("CPU affinity sets defined, but no worker index (set the {} environment variable)",
+                              options.get("worker_env", ENV_WORKER))
+    return set(cpus[idx % len(cpus)])
+
+
+def grad_context(options: Dict = None):
+    """
+    Return the context manager class to use for model inference
+    """
+    mode = (options or {}).get("grad_mode", "inference")
+    if mode not in GRAD_MODES:
+        raise ConfigException("invalid grad_mode: {}", mode)
+    if torch is None:
+        return None
+    return torch.inference_mode if mode == "inference" else torch.no_grad
+
+
+def apply_execution(options: Dict, logger: PiiLogger = None) -> Dict:
+    """
+    Apply the execution settings to the current process. Settings are
+    applied only once; later calls with different values for settings that
+    cannot be changed are reported through the logger
+      :param options: the `execution` section in the task config
+      :param logger: a logger instance
+      :return: the settings applied
+    """
+    if not options:
+        return {}
+
+    with _LOCK:
+        done = {}
+        cpus = cpu_set(options)
+        if cpus is not None and _APPLIED.get("cpu_affinity") != sorted(cpus):
+            try:
+                os.sched_setaffinity(0, cpus)
+                done["cpu_affinity"] = sorted(cpus)
+            except (AttributeError, OSError) as e:
+                if logger:
+                    logger(".. cannot set CPU affinity: %s", e)
+
+        par = options.get("tokenizer_parallelism")
+        if par is not None:
+            os.environ[ENV_TOKENIZERS] = "true" if par else "false"
+            done["tokenizer_parallelism"] = bool(par)
+
+        # By default, use as many intra-op threads as CPUs in the affinity set
+        intra = options.get("intra_op_threads") or (len(cpus) if cpus else None)
+        if intra and torch is not None:
+            torch.set_num_threads(intra)
+            done["intra_op_threads"] = intra
+
+        inter = options.get("inter_op_threads")
+        if inter and torch is not None and _APPLIED.get("inter_op_threads") != inter:
+            try:
+                torch.set_num_interop_threads(inter)
+                done["inter_op_threads"] = inter
+            except RuntimeError as e:
+                # can only be set once, before any inter-op parallel work
+                if logger:
+                    logger(".. cannot set inter-op threads: %s", e)
+
+        if "grad_mode" in options:
+            grad_context(options)
+            done["grad_mode"] = options["grad_mode"]
+
+        _APPLIED.update(done)
+        if logger and done:
+            logger(".. execution settings: %s", done)
+        return done
+
+
+def execution_info() -> Dict:
+    """
+    Return the execution settings in effect in the current process
+    """
+    try:
+        affinity = sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        affinity = None
+    info = {
+        "cpu_count": os.cpu_count(),
+        "cpu_affinity": affinity,
+        "tokenizer_parallelism": os.environ.get(ENV_TOKENIZERS),
+        "applied": dict(_APPLIED)
+    }
+    if torch is not None:
+        info["intra_op_threads"] = torch.get_num_threads()
+        info["inter_op_threads"] = torch.get_num_interop_threads()
+    return info
@@ -0,0 +1,329 @@
+"""
+Run the steps of a Transformers token classification pipeline separately:
+batch tokenization, model forward pass and decoding of the model output into
+entities
+"""
+
+import inspect
+
+try:
+    import numpy as np
+    import torch
+    from transformers import __version__ as transformers_version
+    from transformers.pipelines.token_classification import AggregationStrategy
+except ImportError:
+    np = None
+    torch = None
+    transformers_version = None
+    AggregationStrategy = None
+
+from pii_data.helper.exception import ProcException
+
+from typing import Dict, Iterable, List, Sequence, Tuple
+
+
+def _check():
+    if torch is None:
+        from .pipeline import MissingDependency
+        raise MissingDependency("PyTorch/Transformers packages not found")
+
+
+def aggregation(pp) -> "AggregationStrategy":
+    """
+    Return the aggregation strategy configured in a pipeline
+    """
+    _check()
+    agg = pp._postprocess_params.get("aggregation_strategy")
+    return agg or AggregationStrategy.NONE
+
+
+def encode(pp, texts: List[str]) -> Dict:
+    """
+    Tokenize a batch of texts, in the same way the pipeline does (but in a
+    single call to the fast tokenizer, and with padding)
+    """
+    _check()
+    tk = pp.tokenizer
+    if not tk.is_fast:
+        raise ProcException("a fast tokenizer is needed to compute offsets")
+    truncation = bool(tk.model_max_length and tk.model_max_length > 0)
+    return tk(texts, return_tensors="pt", truncation=truncation,
+              padding=True, return_special_tokens_mask=True,
+              return_offsets_mapping=True)
+
+
+def token_lengths(enc: Dict) -> List[int]:
+    """
+    Return the length (in tokens, including special tokens) of each text in
+    a tokenized batch
+    """
+    return enc["attention_mask"].sum(dim=1).tolist()
+
+
+def supports_packing(pp) -> bool:
+    """
+    Check if the model in a pipeline can process packed sequences: it must
+    be a PyTorch model accepting explicit position ids. The class method is
+    checked, since a compiled model replaces the instance one (and runs
+    packed sequences through the eager version)
+    """
+    _check()
+    model = pp.model
+    if not isinstance(model, torch.nn.Module):
+        return False
+    return "position_ids" in inspect.signature(type(model).forward).parameters
+
+
+def _position_start(model) -> int:
+    """
+    Return the position id of the first token in a sequence (models in the
+    RoBERTa family start counting after the padding index)
+    """
+    emb = getattr(model.base_model, "embeddings", None)
+    pad = getattr(emb, "padding_idx", None)
+    return pad + 1 if isinstance(pad, int) else 0
+
+
+def pack_encoding(pp, enc: Dict, groups: List[List[int]]) -> Dict:
+    """
+    Pack the texts in a tokenized batch into longer sequences. Each text
+    keeps its own special tokens, and gets position ids starting from the
+    beginning; the attention mask is block-diagonal, so that tokens attend
+    only to the tokens of the same text. The model output for each text is
+    then the same as if it had been sent alone
+      :param pp: the pipeline
+      :param enc: the tokenized batch (as produced by `encode()`)
+      :param groups: the indices of the texts in each packed sequence
+      :return: the packed batch, with a "segments" field holding, for each
+        packed sequence, a list of (text index, start token, end token)
+    """
+    _check()
+    lengths = token_lengths(enc)
+    rows = [sum(lengths[n] for n in g) for g in groups]
+    size = max(rows)
+    pos0 = _position_start(pp.model)
+    fields = [k for k in ("input_ids", "token_type_ids", "special_tokens_mask",
+                          "offset_mapping") if k in enc]
+
+    out = {k: torch.zeros((len(groups), size) + enc[k].shape[2:],
+                          dtype=enc[k].dtype) for k in fields}
+    out["attention_mask"] = torch.zeros((len(groups), size), dtype=torch.long)
+    out["position_ids"] = torch.zeros((len(groups), size), dtype=torch.long)
+    block = torch.zeros((len(groups), size, size), dtype=torch.bool)
+    segments = []
+    for r, group in enumerate(groups):
+        segs, pos = [], 0
+        for n in group:
+            end = pos + lengths[n]
+            for k in fields:
+                out[k][r, pos:end] = enc[k][n, :lengths[n]]
+            out["attention_mask"][r, pos:end] = 1
+            out["position_ids"][r, pos:end] = torch.arange(pos0, pos0 + lengths[n])
+            block[r, pos:end, pos:end] = True
+            segs.append((n, pos, end))
+            pos = end
+        segments.append(segs)
+    out["segments"] = segments
+    out["block_mask"] = block
+    return out
+
+
+def _model_mask(block: "torch.Tensor", dtype) -> "torch.Tensor":
+    """
+    Convert a block-diagonal attention mask into the form accepted by the
+    model: a 3D mask for Transformers 4 (expanded by the model), a prepared
+    4D additive mask for Transformers 5
+    """
+    if int(transformers_version.split(".")[0]) < 5:
+        return block.long()
+    mask = torch.zeros(block.shape, dtype=dtype)
+    mask.masked_fill_(~block, torch.finfo(dtype).min)
+    return mask[:, None]
+
+
+def forward(pp, enc: Dict) -> "np.ndarray":
+    """
+    Run a tokenized batch (possibly a packed one) through the model, and
+    return the logits
+    """
+    _check()
+    inputs = {k: enc[k].to(pp.device)
+              for k in (*pp.tokenizer.model_input_names, "position_ids")
+              if k in enc}
+    if "block_mask" in enc:
+        inputs["attention_mask"] = _model_mask(enc["block_mask"],
+                                               pp.model.dtype).to(pp.device)
+    context = getattr(pp, "get_inference_context", None)
+    with (context() if context else torch.inference_mode)():
+        logits = pp.model(**inputs)[0]
+    return logits.float().cpu().numpy()
+
+
+class LabelMask:
+    """
+    The set of model labels to decode, as a mask over the label ids
+    """
+
+    def __init__(self, pp, labels: Iterable[str]):
+        """
+          :param pp: the pipeline
+          :param labels: the entity labels to keep (without B-/I- prefixes)
+        """
+        _check()
+        self.labels = set(labels)
+        id2label = pp.model.config.id2label
+        self.mask = np.array([id2label[i].split("-")[-1] in self.labels
+                              for i in range(len(id2label))])
+
+
+    def __repr__(self) -> str:
+        return f"<LabelMask {sorted(self.labels)}>"
+
+
+    def keep(self, entity: Dict) -> bool:
+        """
+        Check if an aggregated entity has one of the labels to keep
+        """
+        label = entity.get("entity_group") or entity.get("entity") or ""
+        return label.split("-")[-1] in self.labels
+
+
+def token_runs(selected: Sequence[bool], offsets: Sequence,
+               special: Sequence, words: bool) -> List[Tuple[int, int]]:
+    """
+    Find the runs of consecutive tokens to decode
+      :param selected: flags for the tokens predicted with a label to keep
+      :param offsets: the character offsets for the tokens
+      :param special: flags for special tokens
+      :param words: extend the selection to whole words (tokens with no
+        whitespace between them), for word-level aggregation
+      :return: a list of (start, end) token ranges
+    """
+    sel = [bool(s) for s in selected]
+    num = len(sel)
+    if words:
+        for n in [n for n in range(num) if sel[n]]:
+            s = n
+            while (s > 0 and not special[s-1] and not sel[s-1]
+                   and offsets[s][0] == offsets[s-1][1]):
+                s -= 1
+                sel[s] = True
+            e = n
+            while (e < num - 1 and not special[e+1] and not sel[e+1]
+                   and offsets[e+1][0] == offsets[e][1]):
+                e += 1
+                sel[e] = True
+
+    runs = []
+    start = None
+    for n, s in enumerate(sel + [False]):
+        if s and start is None:
+            start = n
+        elif not s and start is not None:
+            runs.append((start, n))
+            start = None
+    return runs
+
+
+def _softmax(lg: "np.ndarray") -> "np.ndarray":
+    maxes = np.max(lg, axis=-1, keepdims=True)
+    shifted_exp = np.exp(lg - maxes)
+    return shifted_exp / shifted_exp.sum(axis=-1, keepdims=True)
+
+
+def _decode_restricted(pp, text: str, ids, offsets, special, lg,
+                       agg: "AggregationStrategy",
+                       mask: LabelMask) -> List[Dict]:
+    """
+    Decode the entities for a text, only for the tokens predicted with one
+    of the labels to keep (plus the rest of their words, for word-level
+    aggregation strategies). Each run of tokens is aggregated separately:
+    tokens out of the runs have other labels, so they would break the groups
+    """
+    selected = mask.mask[lg.argmax(axis=-1)] & ~special.astype(bool)
+    if not selected.any():
+        return []
+    words = agg not in (AggregationStrategy.NONE, AggregationStrategy.SIMPLE)
+    entities = []
+    for s, e in token_runs(selected, offsets, special, words):
+        pre_entities = pp.gather_pre_entities(text, ids[s:e],
+                                              _softmax(lg[s:e]),
+                                              offsets[s:e], special[s:e], agg)
+        entities += [r for r in pp.aggregate(pre_entities, agg)
+                     if mask.keep(r)]
+    return entities
+
+
+def decode(pp, texts: List[str], enc: Dict, logits: "np.ndarray",
+           agg: "AggregationStrategy" = None,
+           mask: LabelMask = None) -> List[List[Dict]]:
+    """
+    Convert the model output for a batch into entities, using the
+    postprocessing methods of the pipeline
+      :param pp: the pipeline
+      :param texts: the texts in the batch
+      :param enc: the tokenized batch
+      :param logits: the model output for the batch
+      :param agg: the aggregation strategy (default: the pipeline one)
+      :param mask: decode only the entities with these labels
+      :return: a list of entities for each text in the batch
+    """
+    if agg is None:
+        agg = aggregation(pp)
+    out = []
+    for n, text in enumerate(texts):
+        # Remove padding
+        keep = enc["attention_mask"][n].numpy().astype(bool)
+        out.append(_decode_text(pp, text, enc, n, keep, logits[n][keep],
+                                agg, mask))
+    return out
+
+
+def decode_packed(pp, texts: List[str], enc: Dict, logits: "np.ndarray",
+                  agg: "AggregationStrategy" = None,
+                  mask: LabelMask = None) -> List[Tuple[int, List[Dict]]]:
+    """
+    Convert the model output for a packed batch into entities for each one
+    of the texts it contains
+      :param pp: the pipeline
+      :param texts: the full list of texts the packed batch was built from
+      :param enc: the packed batch (as produced by `pack_encoding()`)
+      :param logits: the model output for the packed batch
+      :param agg: the aggregation strategy (default: the pipeline one)
+      :param mask: decode only the entities with these labels
+      :return: a list of tuples (text index, entities)
+    """
+    if agg is None:
+        agg = aggregation(pp)
+    out = []
+    for r, segments in enumerate(enc["segments"]):
+        for n, start, end in segments:
+            keep = slice(start, end)
+            out.append((n, _decode_text(pp, texts[n], enc, r, keep,
+                                        logits[r][keep], agg, mask)))
+    return out
+
+
+def _decode_text(pp, text: str, enc: Dict, row: int, keep, lg: "np.ndarray",
+                 agg: "AggregationStrategy", mask: LabelMask) -> List[Dict]:
+    """
+    Convert the model output for one text into entities
+      :param row: the row of the text in the batch
+      :param keep: the selection of the text tokens within the row
+      :param lg: the logits for the text tokens
+    """
+    ids = enc["input_ids"][row].numpy()[keep]
+    offsets = enc["offset_mapping"][row].numpy()[keep]
+    special = enc["special_tokens_mask"][row].numpy()[keep]
+    if mask is not None:
+        return _decode_restricted(pp, text, ids, offsets, special, lg, agg,
+                                  mask)
+
+    # Softmax over the labels & aggregate
+    ignore = pp._postprocess_params.get("ignore_labels") or ["O"]
+    pre_entities = pp.gather_pre_entities(text, ids, _softmax(lg), offsets,
+                                          special, agg)
+    entities = pp.aggregate(pre_entities, agg)
+    return [e for e in entities
+            if e.get("entity") not in ignore
+            and e.get("entity_group") not in ignore]
@@ -0,0 +1,146 @@
+"""
+Background loading of the pipelines for a task, so that task construction
+does not block on model load time
+"""
+
+from collections import deque
+from time import perf_counter
+from threading import Thread, Lock, Event
+
+from pii_data.helper.exception import ProcException
+from pii_extract.helper.logger import PiiLogger
+
+from typing import Callable, Dict, Iterable
+
+
+class PipelineLoader:
+    """
+    Load the pipelines for a set of languages, one language at a time, in a
+    background thread. A language that is waited for before its load has
+    started is moved to the front of the queue
+    """
+
+    def __init__(self, load: Callable, languages: Iterable[str],
+                 logger: PiiLogger = None):
+        """
+          :param load: a function that receives a list of languages and
+            returns a dict with the pipeline for each one
+          :param languages: the languages to load
+          :param logger: a logger instance
+        """
+        self._load = load
+        self._log = logger
+        self._pending = deque(sorted(languages))
+        self._done = {lang: Event() for lang in self._pending}
+        self._result = {}
+        self._status = {lang: "pending" for lang in self._pending}
+        self._time = {}
+        self._lock = Lock()
+        self._thread = None
+
+
+    def __repr__(self) -> str:
+        return f"<PipelineLoader {self._status}>"
+
+
+    def __contains__(self, lang: str) -> bool:
+        return lang in self._done
+
+
+    def start(self) -> "PipelineLoader":
+        """
+        Start loading in the background
+        """
+        self._thread = Thread(target=self._run, name="pipeline-loader",
+                              daemon=True)
+        self._thread.start()
+        return self
+
+
+    def _next(self) -> str:
+        with self._lock:
+            if not self._pending:
+                return None
+            lang = self._pending.popleft()
+            self._status[lang] = "loading"
+            return lang
+
+
+    def _run(self):
+        """
+        Load all pending languages
+        """
+        while True:
+            lang = self._next()
+            if lang is None:
+                return
+            start = perf_counter()
+            try:
+                pp = self._load([lang])[lang]
+                status = "ready"
+            except BaseException as e:
+                pp, status = e, "error"
+                if self._log:
+                    self._log(".. pipeline load error for %s: %s", lang, e)
+            with self._lock:
+                self._result[lang] = pp
+                self._status[lang] = status
+                self._time[lang] = perf_counter() - start
+            self._done[lang].set()
+
+
+    def wait(self, lang: str, timeout: float = None):
+        """
+        Wait until the pipeline for a language is available
+          :param lang: the language
+          :param timeout: maximum time to wait, in seconds (default: no limit)
+          :return: the pipeline
+        An error raised while loading the pipeline is raised here
+        """
+        with self._lock:
+            if lang in self._pending and self._pending[0] != lang:
+                self._pending.remove(lang)
+                self._pending.appendleft(lang)
+        if not self._done[lang].wait(timeout):
+            raise ProcException("Transformers pipeline for '{}' not ready after {} secs",
+                                lang, timeout)
+        pp = self._result[lang]
+        if isinstance(pp, BaseException):
+            raise pp
+        return pp
+
+
+    def ready(self, lang: str = None) -> bool:
+        """
+        Check if the pipeline for a language (or for all languages, if none
+        is given) has been loaded
+        """
+        with self._lock:
+            if lang is not None:
+                return self._status.get(lang) == "ready"
+            return all(s == "ready" for s in self._status.values())
+
+
+    def close(self) -> Dict:
+        """
+        Cancel the loads that have not started yet (a load in progress is
+        finished, and the thread ends afterwards)
+          :return: the pipelines loaded so far
+        """
+        with self._lock:
+            for lang in self._pending:
+                self._status[lang] = "cancelled"
+                self._result[lang] = ProcException("Transformers pipeline load for '{}' cancelled", lang)
+                self._done[lang].set()
+            self._pending.clear()
+            return {lang: pp for lang, pp in self._result.items()
+                    if self._status[lang] == "ready"}
+
+
+    def get_stats(self) -> Dict:
+        """
+        Return the load status and load time for each language
+        """
+        with self._lock:
+            return {lang: {"status": s, "time": self._time.get(lang)}
+                    for lang, s in self._status.items()}
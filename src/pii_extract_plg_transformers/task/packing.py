@@ -0,0 +1,64 @@
+"""
+Pack several short chunks into a single model input sequence
+"""
+
+from typing import List
+
+
+# Fallback value when the tokenizer does not define a usable max length
+DEFAULT_MAX_LENGTH = 512
+
+
+class ChunkPacker:
+    """
+    Group short texts into packed sequences of up to the model max length.
+    Inside a packed sequence each text keeps its own special tokens and
+    position ids, and attention is restricted to the tokens of the same text
+    (see `infer.pack_encoding()`), so that the results for a text do not
+    depend on the texts packed together with it
+    """
+
+    def __init__(self, tokenizer, max_length: int = None,
+                 max_item: int = None):
+        """
+          :param tokenizer: the tokenizer used by the pipeline
+          :param max_length: maximum length of a packed sequence, in tokens
+            (default is the model max length)
+          :param max_item: maximum length (in tokens) of a text for it to be
+            packed; longer texts are sent alone (default: a quarter of the
+            max length)
+        """
+        if not max_length:
+            max_length = getattr(tokenizer, "model_max_length", None)
+            if not max_length or max_length > 100000:
+                max_length = DEFAULT_MAX_LENGTH
+        self.max_length = max_length
+        self.max_item = max_item or self.max_length // 4
+
+
+    def __repr__(self) -> str:
+        return f"<ChunkPacker {self.max_length}/{self.max_item}>"
+
+
+    def pack(self, lengths: List[int]) -> List[List[int]]:
+        """
+        Group a list of texts into packed sequences
+          :param lengths: the length of each text, in tokens (including its
+            special tokens)
+          :return: the indices of the texts in each packed sequence
+        """
+        packs = []
+        current, size = [], 0
+        for n, ntok in enumerate(lengths):
+            if ntok > self.max_item:
+                packs.append([n])   # a long text goes in a sequence by itself
+                continue
+            if current and size + ntok > self.max_length:
+                packs.append(current)
+                current, size = [], 0
+            size += ntok
+            current.append(n)
+
+        if current:
+            packs.append(current)
+        return packs
@@ -2,6 +2,8 @@
 Load models from the Transformers library, using pipelines
 """
 
+from threading import Lock
+
 try:
     import torch
     from transformers import (
@@ -17,23 +19,126 @@ except ImportError:
     pipeline = object
     set_seed = None
 
-from pii_data.helper.exception import ProcException
+from pii_data.helper.exception import ProcException, ConfigException
 from pii_extract.helper.logger import PiiLogger
 
-from typing import Dict, Iterable, List
+from typing import Dict, Iterable, List, Optional, Tuple
 
 from .. import defs
 from .utils import package_languages
 
 
-# Cache for engine reuse
-ENGINE_CACHE = {}
-
-
 class MissingDependency(ProcException):
     pass
 
 
+class EngineCache:
+    """
+    A cache for model objects and the pipelines built over them, so that they
+    can be shared across languages and task objects. Model objects are
+    indexed by tokenizer/model name & params; pipelines are indexed by model
+    key plus the pipeline settings (aggregation & device).
+    """
+
+    def __init__(self):
+        self._models = {}
+        self._pipelines = {}
+        self._lock = Lock()
+
+
+    def __repr__(self) -> str:
+        return f"<EngineCache {len(self._models)}/{len(self._pipelines)}>"
+
+
+    def __len__(self) -> int:
+        return len(self._models)
+
+
+    def get_model(self, key: str) -> Optional[Tuple]:
+        """
+        Get a (tokenizer, model) tuple from the cache
+        """
+        with self._lock:
+            entry = self._models.get(key)
+        return entry[:2] if entry else None
+
+
+    def get_pipeline(self, pkey: str) -> Optional[pipeline]:
+        """
+        Get a pipeline from the cache
+        """
+        with self._lock:
+            entry = self._pipelines.get(pkey)
+        return entry[1] if entry else None
+
+
+    def add(self, key: str, pkey: str, tokenizer, model, pp: pipeline,
+            replace: bool = False):
+        """
+        Add a pipeline to the cache, together with its model objects
+          :param replace: replace the model objects, if already in the cache
+        """
+        with self._lock:
+            if replace or key not in self._models:
+                self._models[key] = tokenizer, model, model_bytes(model)
+            self._pipelines[pkey] = key, pp
+
+
+    def release(self, pipelines: Iterable[pipeline]) -> int:
+        """
+        Remove a set of pipelines from the cache, and the model objects that
+        are no longer used by any cached pipeline
+          :return: the number of model objects removed
+        """
+        ids = {id(pp) for pp in pipelines}
+        with self._lock:
+            for pkey, (_, pp) in list(self._pipelines.items()):
+                if id(pp) in ids:
+                    del self._pipelines[pkey]
+            used = {id(self._models[k][1]) for k, _ in self._pipelines.values()
+                    if k in self._models}
+            unused = [k for k, e in self._models.items() if id(e[1]) not in used]
+            for key in unused:
+                del self._models[key]
+        return len(unused)
+
+
+    def model_key(self, model) -> Optional[str]:
+        """
+        Find the cache key for a model object
+        """
+        with self._lock:
+            for key, entry in self._models.items():
+                if entry[1] is model:
+                    return key
+        return None
+
+
+    def clear(self):
+        """
+        Remove all objects from the cache
+        """
+        with self._lock:
+            self._models.clear()
+            self._pipelines.clear()
+
+
+    def get_stats(self) -> Dict:
+        """
+        Return the number of cached objects, and the memory taken by the
+        model weights (each model counted once, however many pipelines
+        share it)
+        """
+        with self._lock:
+            return {"models": len(self._models),
+                    "pipelines": len(self._pipelines),
+                    "bytes": sum(e[2] for e in self._models.values())}
+
+
+# Cache for engine reuse
+ENGINE_CACHE = EngineCache()
+
+
 def ner_labels(pl: pipeline) -> List[str]:
     """
     Return the labels the model will produce
@@ -46,6 +151,18 @@ def ner_labels(pl: pipeline) -> List[str]:
     return lbl
 
 
+def model_bytes(model) -> int:
+    """
+    Return the memory size of the weights in a model
+    """
+    try:
+        return sum(t.numel() * t.element_size()
+                   for t in model.state_dict().values()
+                   if hasattr(t, "element_size"))
+    except (AttributeError, TypeError):
+        return 0        # not a PyTorch model
+
+
 def set_random_seed(seed: int):
     """
     Set the random seed that will be used by the transformers library
@@ -55,15 +172,195 @@ def set_random_seed(seed: int):
     set_seed(seed)
 
 
-def create_pipelines(config: Dict, languages: Iterable[str] = None,
-                     logger: PiiLogger = None) -> Dict[str, pipeline]:
+def _pruned(mdname: str, layers: int, trimmed: bool = False):
     """
-    Create Transfomers pipelines for entity detection
-     :param config: the engine config (a section of the overall plugin config)
-     :param languages: restrict languages in the analyzer
+    Return the folder for the pruned version of a model (or of its trimmed
+    version), if it has been built
+    """
+    from ..model.prune import pruned_path
+    path = pruned_path(mdname, layers, trimmed)
+    return path if (path / "config.json").is_file() else None
+
+
+def _load_model(mdname: str, fmt: str, par: Dict):
+    """
+    Load a token classification model
+     :param mdname: the model name or folder
+     :param fmt: the format of a converted model (or None for a standard one)
+     :param par: additional parameters to pass to the model
+    """
+    if fmt == "quantized":
+        from ..model.cache import QUANTIZED_FILE
+        path = f"{mdname}/{QUANTIZED_FILE}"
+        try:
+            return torch.load(path, map_location="cpu", weights_only=False)
+        except TypeError:   # older PyTorch versions
+            return torch.load(path, map_location="cpu")
+    elif fmt == "onnx":
+        try:
+            from optimum.onnxruntime import ORTModelForTokenClassification
+        except ImportError:
+            raise MissingDependency("optimum[onnxruntime] package needed for ONNX models")
+        return ORTModelForTokenClassification.from_pretrained(mdname)
+    else:
+        return AutoModelForTokenClassification.from_pretrained(mdname, **par)
+
+
+def _build_pipeline(m: Dict, reuse: bool, default_agg: str,
+                    logger: PiiLogger = None,
+                    default_device: str = None, grad=None,
+                    refresh: bool = False) -> pipeline:
+    """
+    Build the pipeline for a model entry in the config
+     :param m: the model entry
+     :param reuse: use the engine cache
+     :param default_agg: aggregation strategy, if not defined in the model
      :param logger: a logger instance
-    Will reuse an object with the same configuration if it's in the cache
-    and `reuse_engine` in the config is True (which is its default value)
+     :param default_device: device for the pipeline, if not defined in the
+       model
+     :param grad: the gradient mode context for inference (default: the
+       pipeline default)
+     :param refresh: load the model again, instead of taking it from the
+       engine cache (the new objects replace the cached ones)
+    """
+    lang = m['lang_code']
+    mdname = m["model"]
+    tkname = m.get("tokenizer") or m["model"]
+    par = m.get("model_params", {})
+    agg = m.get("aggregation", default_agg)
+    device = m.get("device", default_device)
+    layers = m.get("layers")
+    compile_opt = m.get("compile")
+    snapshot = m.get("snapshot")
+
+    trimmed = m.get("trimmed")
+    fmt = m.get("format")
+    if fmt and layers:
+        raise ConfigException("layer pruning cannot be applied to the {} version of {}", fmt, m["model"])
+
+    # Use a pruned version of the model, built from the trimmed-vocabulary
+    # version if that is also requested (so that tokenizer & model match)
+    pruned = _pruned(m["model"], layers, trimmed) if layers else None
+    if pruned:
+        mdname = str(pruned)
+        if trimmed:
+            tkname = mdname
+        layers = None
+
+    # Use the trimmed-vocabulary version of the model
+    elif trimmed:
+        from ..model.trim import trimmed_path
+        path = trimmed_path(mdname)
+        if not (path / "config.json").is_file():
+            raise ConfigException("no trimmed model available for {} (use the model tool to build it)", mdname)
+        mdname = tkname = str(path)
+
+    # Use a converted version of the model, or a local copy from a mirror
+    if fmt:
+        from ..model.cache import model_name, converted_path
+        path = converted_path(fmt, model_name(m))
+        if not (path / "config.json").is_file():
+            raise ConfigException("no {} version available for {} (use the `info cache` command to build it)", fmt, m["model"])
+        mdname = tkname = str(path)
+    elif not (trimmed or pruned):
+        from ..model.cache import local_path
+        path = local_path(mdname)
+        if (path / "config.json").is_file():
+            mdname = str(path)
+        path = local_path(tkname)
+        if path.is_dir():
+            tkname = str(path)
+
+    # Build the cache keys: for model objects, and for pipelines using them
+    key = f"{tkname}/{mdname}"
+    if par:
+        key += '/' + '-'.join(f"{k}={par[k]}" for k in sorted(par))
+    if layers:
+        key += f"/layers={layers}"
+    if compile_opt:
+        from ..model.compile import compile_key
+        key += "/compiled=" + compile_key(compile_opt)
+    pkey = f"{key}|{agg}|{device}"
+    if grad is not None:
+        pkey += "|" + getattr(grad, "__name__", str(grad))
+
+    # Look for the pipeline in cache
+    if reuse and not refresh:
+        pp = ENGINE_CACHE.get_pipeline(pkey)
+        if pp is not None:
+            if logger:
+                logger(".... Reusing Transformers pipeline for %s: %s", lang, mdname)
+            return pp
+        objs = ENGINE_CACHE.get_model(key)
+    else:
+        objs = None
+
+    # Create objects (if not in cache) & build the pipeline
+    # (a refresh never restores a snapshot, and rewrites it after loading)
+    restored = revision = None
+    if snapshot and not objs:
+        from ..model.snapshot import snapshot_path, read_snapshot, \
+            source_revision
+        spath = snapshot_path(m["model"], key)
+        hub_timeout = snapshot.get("hub_timeout") \
+            if isinstance(snapshot, dict) else None
+        if spath.is_file() and not refresh:
+            revision = source_revision(mdname, tkname, par.get("revision"),
+                                       hub_timeout)
+            restored = read_snapshot(spath, key, revision, logger)
+            if restored and logger:
+                logger(".... Restored snapshot for %s: %s", lang, spath)
+    if objs or restored:
+        tokenizer, model = objs or restored
+    else:
+        tokenizer = AutoTokenizer.from_pretrained(tkname)
+        model = _load_model(mdname, fmt, par)
+        if layers:
+            from ..model.prune import truncate_layers
+            truncate_layers(model, layers)
+        if snapshot:
+            from ..model.snapshot import write_snapshot
+            # take the revision just loaded (now in the local cache)
+            revision = source_revision(mdname, tkname, par.get("revision"))
+            try:
+                write_snapshot(spath, tokenizer, model, key, revision)
+            except ProcException as e:
+                if logger:
+                    logger(".... %s", e)
+    dev = {} if device is None else {"device": device}
+    pp = pipeline("ner", tokenizer=tokenizer, model=model,
+                  aggregation_strategy=agg, **dev)
+    if grad is not None:
+        pp.get_inference_context = lambda: grad
+
+    # Compile the model (once it is in its device), if not done already
+    if compile_opt and not objs:
+        from ..model.compile import compile_model
+        opt = {} if compile_opt is True else compile_opt
+        compile_model(pp.model, tokenizer, m["model"], key, opt, logger)
+
+    # Save to cache
+    if reuse:
+        ENGINE_CACHE.add(key, pkey, tokenizer, model, pp, replace=refresh)
+    return pp
+
+
+def _execution(config: Dict, logger: PiiLogger = None):
+    """
+    Apply the execution settings in the config to the current process
+     :return: the gradient mode context to use in the pipelines
+    """
+    options = config.get("execution")
+    if not options:
+        return None
+    from .execution import apply_execution, grad_context
+    apply_execution(options, logger)
+    return grad_context(options)
+
+
+def _model_list(config: Dict, languages: Iterable[str] = None) -> List[Dict]:
+    """
+    Select the model entries in the config for a set of languages
     """
     if pipeline is None:
         raise MissingDependency("transformers package not found")
@@ -77,13 +374,29 @@ def create_pipelines(config: Dict, languages: Iterable[str] = None,
         langset = langset.intersection(languages)
 
     # Keep only the language models we'll use
-    model_list = [m for m in config.get(defs.CFG_TASK_MODELS)
-                  if not langset or m["lang_code"] in langset]
+    return [m for m in config.get(defs.CFG_TASK_MODELS)
+            if not langset or m["lang_code"] in langset]
+
+
+def create_pipelines(config: Dict, languages: Iterable[str] = None,
+                     logger: PiiLogger = None,
+                     refresh: bool = False) -> Dict[str, pipeline]:
+    """
+    Create Transfomers pipelines for entity detection
+     :param config: the engine config (a section of the overall plugin config)
+     :param languages: restrict languages in the analyzer
+     :param logger: a logger instance
+     :param refresh: load the models again, replacing the cached ones
+    Will reuse an object with the same configuration if it's in the cache
+    and `reuse_engine` in the config is True (which is its default value)
+    """
+    model_list = _model_list(config, languages)
     if logger:
         logger(".. Transformers models: %s",
                ','.join(m['lang_code'] for m in model_list))
 
     # Create pipelines, according to the configuration
+    grad = _execution(config, logger)
     reuse = config.get(defs.CFG_TASK_REUSE, True)
     default_agg = config.get("aggregation", "max")
     pdict = {}
@@ -91,39 +404,34 @@ def create_pipelines(config: Dict, languages: Iterable[str] = None,
         logger("... Instantiating Transformer models")
 
     for m in model_list:
-        lang = m['lang_code']
         if logger:
-            logger("... model: %s", lang)
-
-        mdname = m["model"]
-        tkname = m.get("tokenizer") or m["model"]
-        par = m.get("model_params", {})
-        agg = m.get("aggregation", default_agg)
-
-        # Look for it in cache
-        if reuse:
-            # Build the cache key
-            key = f"{tkname}/{mdname}"
-            if par:
-                key += '/' + '-'.join(f"{k}={par[k]}" for k in sorted(par))
-
-            # Try to find it in cache
-            model = ENGINE_CACHE.get(key)
-            if model:
-                pdict[lang] = pipeline("ner", tokenizer=model[0], model=model[1],
-                                       aggregation_strategy=agg)
-                if logger:
-                    logger(".... Reusing Transformers pipeline for %s: %s", lang, mdname)
-                continue
+            logger("... model: %s", m['lang_code'])
+        pdict[m['lang_code']] = _build_pipeline(m, reuse, default_agg, logger,
+                                                config.get("device"), grad,
+                                                refresh)
 
-        # Create objects & build the pipeline
-        tokenizer = AutoTokenizer.from_pretrained(tkname)
-        model = AutoModelForTokenClassification.from_pretrained(mdname, **par)
-        pdict[lang] = pipeline("ner", tokenizer=tokenizer, model=model,
-                               aggregation_strategy=agg)
+    return pdict
 
-        # Save to cache
-        if reuse:
-            ENGINE_CACHE[key] = tokenizer, model
 
+def create_cascade_pipelines(config: Dict, languages: Iterable[str] = None,
+                             logger: PiiLogger = None) -> Dict[str, pipeline]:
+    """
+    Create the pipelines for the first (fast) stage of cascade detection,
+    for the models in the config that define a cascade
+     :param config: the engine config (a section of the overall plugin config)
+     :param languages: restrict languages in the analyzer
+     :param logger: a logger instance
+    """
+    grad = _execution(config, logger)
+    reuse = config.get(defs.CFG_TASK_REUSE, True)
+    pdict = {}
+    for m in _model_list(config, languages):
+        cascade = m.get("cascade")
+        if not cascade:
+            continue
+        if logger:
+            logger("... cascade model: %s", m['lang_code'])
+        cm = {"lang_code": m["lang_code"], **cascade}
+        pdict[m['lang_code']] = _build_pipeline(cm, reuse, "simple", logger,
+                                                config.get("device"), grad)
     return pdict
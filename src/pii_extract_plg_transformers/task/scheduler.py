@@ -0,0 +1,207 @@
+"""
+A batching scheduler with priority lanes: chunks submitted by any thread are
+queued by priority, and a worker thread groups them into batches. Interactive
+chunks go into small batches, served ahead of the bulk queue; bulk chunks use
+the capacity left over
+"""
+
+from collections import deque
+from concurrent.futures import Future
+from threading import Condition, Lock, Thread
+from time import perf_counter
+
+from pii_data.helper.exception import ConfigException
+from pii_data.types.doc import DocumentChunk
+from pii_extract.helper.logger import PiiLogger
+
+from typing import Callable, Dict, Iterable, List
+
+from .adaptive import percentile
+
+
+# Request priorities, from highest to lowest
+PRIORITIES = ("interactive", "bulk")
+
+
+class _Lane:
+    """
+    The queue for one priority, plus its queue wait measurements
+    """
+
+    def __init__(self, batch_size: int, window: int = 1000):
+        self.batch_size = batch_size
+        self.queue = deque()
+        self.wait = deque(maxlen=window)
+        self.chunks = 0
+        self.batches = 0
+
+
+    def get_stats(self) -> Dict:
+        wait = list(self.wait)
+        return {"batch_size": self.batch_size, "queued": len(self.queue),
+                "chunks": self.chunks, "batches": self.batches,
+                "wait_avg": sum(wait)/len(wait) if wait else None,
+                "wait_p50": percentile(wait, 0.5) if wait else None,
+                "wait_p95": percentile(wait, 0.95) if wait else None,
+                "wait_max": max(wait) if wait else None}
+
+
+class BatchScheduler:
+    """
+    Queue chunks by priority, and process them in batches in a worker thread.
+    Each batch takes chunks from a single lane: the highest priority lane
+    with queued chunks
+    """
+
+    def __init__(self, process: Callable, batch_size: int = 8,
+                 interactive_batch: int = 4, max_wait: float = 0.002,
+                 window: int = 1000, logger: PiiLogger = None):
+        """
+          :param process: a function that receives a list of chunks, and
+            returns a list with the results for each one
+          :param batch_size: maximum size of bulk batches
+          :param interactive_batch: maximum size of interactive batches
+          :param max_wait: time to wait for more interactive chunks to fill
+            a batch, in seconds
+          :param window: number of queue wait measurements kept per lane
+          :param logger: a logger instance
+        """
+        self._process = process
+        self._lanes = {"interactive": _Lane(interactive_batch, window),
+                       "bulk": _Lane(batch_size, window)}
+        self.max_wait = max_wait
+        self._log = logger
+        self._cond = Condition(Lock())
+        self._thread = None
+        self._closed = False
+
+
+    def __repr__(self) -> str:
+        return "<BatchScheduler {}>".format(
+            " ".join(f"{p}={len(lane.queue)}" for p, lane in self._lanes.items()))
+
+
+    def _lane(self, priority: str) -> _Lane:
+        try:
+            return self._lanes[priority]
+        except KeyError:
+            raise ConfigException("invalid priority: {}", priority) from None
+
+
+    def submit(self, chunk: DocumentChunk, priority: str = "bulk") -> Future:
+        """
+        Queue a chunk for detection
+          :param chunk: the chunk
+          :param priority: the priority ("interactive" or "bulk")
+          :return: a future for the results of the chunk
+        """
+        lane = self._lane(priority)
+        fut = Future()
+        with self._cond:
+            if self._closed:
+                raise ConfigException("the scheduler is closed")
+            lane.queue.append((chunk, fut, perf_counter()))
+            if self._thread is None:
+                self._thread = Thread(target=self._run, name="batch-scheduler",
+                                      daemon=True)
+                self._thread.start()
+            self._cond.notify()
+        return fut
+
+
+    def batch_size(self, priority: str) -> int:
+        """
+        Return the maximum batch size for a priority
+        """
+        return self._lane(priority).batch_size
+
+
+    def map(self, chunks: Iterable[DocumentChunk], priority: str = "bulk",
+            window: int = None) -> Iterable:
+        """
+        Queue a sequence of chunks, and produce their results in order. At
+        most `window` chunks are queued ahead of the results consumed
+        """
+        lane = self._lane(priority)
+        window = window or 4*lane.batch_size
+        pending = deque()
+        for chunk in chunks:
+            pending.append((chunk, self.submit(chunk, priority)))
+            if len(pending) >= window:
+                chunk, fut = pending.popleft()
+                yield chunk, fut.result()
+        while pending:
+            chunk, fut = pending.popleft()
+            yield chunk, fut.result()
+
+
+    def _next(self) -> List:
+        """
+        Wait for queued chunks, and take the next batch
+        """
+        with self._cond:
+            while not self._closed and not any(lane.queue for lane in self._lanes.values()):
+                self._cond.wait()
+            if self._closed:
+                return None
+            lane = next(lane for lane in self._lanes.values() if lane.queue)
+            if lane is self._lanes["interactive"] and self.max_wait:
+                # give concurrent interactive requests a chance to join
+                end = perf_counter() + self.max_wait
+                while len(lane.queue) < lane.batch_size:
+                    left = end - perf_counter()
+                    if left <= 0:
+                        break
+                    self._cond.wait(left)
+            num = min(lane.batch_size, len(lane.queue))
+            batch = [lane.queue.popleft() for _ in range(num)]
+            now = perf_counter()
+            lane.wait.extend(now - t for _, _, t in batch)
+            lane.chunks += num
+            lane.batches += 1
+            return batch
+
+
+    def _run(self):
+        """
+        Process batches until the scheduler is closed
+        """
+        while True:
+            batch = self._next()
+            if batch is None:
+                return
+            # skip the chunks whose futures have been cancelled
+            batch = [b for b in batch if b[1].set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            futures = [f for _, f, _ in batch]
+            try:
+                results = self._process([c for c, _, _ in batch])
+            except BaseException as e:
+                if self._log:
+                    self._log(".. batch error: %s", e)
+                for f in futures:
+                    f.set_exception(e)
+                continue
+            for f, r in zip(futures, results):
+                f.set_result(r)
+
+
+    def close(self):
+        """
+        Stop the worker thread. Queued chunks are cancelled
+        """
+        with self._cond:
+            self._closed = True
+            for lane in self._lanes.values():
+                while lane.queue:
+                    lane.queue.popleft()[1].cancel()
+            self._cond.notify_all()
+
+
+    def get_stats(self) -> Dict:
+        """
+        Return the queue depth and queue wait times per priority
+        """
+        with self._cond:
+            return {p: lane.get_stats() for p, lane in self._lanes.items()}
@@ -0,0 +1,142 @@
+"""
+Sentence segmentation of chunks, with a cache of sentence detection results
+"""
+
+import re
+from collections import OrderedDict, Counter
+from threading import Lock
+
+from typing import Dict, List, Tuple
+
+
+# Abbreviations (personal titles) that do not end a sentence
+ABBREVIATIONS = ("Mr", "Mrs", "Ms", "Dr", "Dra", "Prof", "Rev", "Hon", "Sr",
+                 "Sra", "Srta", "Jr", "St", "Mme", "Mlle", "Pr", "Gen", "Col",
+                 "Capt", "Lt", "Sgt")
+
+# A sentence ends at a line end, or at final punctuation followed by a space.
+# The punctuation must be preceded by at least two word characters (to avoid
+# splitting at initials) that are not one of the abbreviations
+SENTENCE = re.compile(r"\S.*?(?:(?<=\w\w)" +
+                      "".join(rf"(?<!\b{a})" for a in ABBREVIATIONS) +
+                      r"[.!?]+(?=\s)|$)", re.M)
+
+
+def split_sentences(text: str) -> List[Tuple[int, str]]:
+    """
+    Split a text into sentences
+      :return: a list of tuples (sentence offset in text, sentence)
+    """
+    return [(m.start(), m.group().rstrip()) for m in SENTENCE.finditer(text)]
+
+
+class SentenceCache:
+    """
+    Split texts into sentences, remove duplicated sentences and reuse the
+    results for sentences already processed. Keeps an LRU cache of sentence
+    results, by language.
+    """
+
+    def __init__(self, size: int = 10000):
+        """
+          :param size: maximum number of sentences to keep in the cache
+        """
+        self.size = size
+        self._cache = OrderedDict()
+        self._lock = Lock()
+        self._generation = 0
+        self.stats = Counter()
+
+
+    def __repr__(self) -> str:
+        return f"<SentenceCache {len(self._cache)}/{self.size}>"
+
+
+    def __getstate__(self) -> Dict:
+        return {"size": self.size}
+
+
+    def __setstate__(self, state: Dict):
+        self.__init__(state["size"])
+
+
+    def clear(self):
+        """
+        Remove all the cached sentence results. Results for sentences
+        prepared before this call are not added to the cache (they may come
+        from a model that has been replaced)
+        """
+        with self._lock:
+            self._cache.clear()
+            self._generation += 1
+
+
+    def prepare(self, lang: str, texts: List[str]) -> Tuple[List[str], Tuple]:
+        """
+        Split a list of texts into sentences and find the ones that need
+        detection
+          :param lang: the language for the texts
+          :param texts: the list of texts
+          :return: a tuple (list of unique sentences not in the cache,
+            state to pass to `complete()`)
+        """
+        split = [split_sentences(t) for t in texts]
+        pending = {}
+        cached = {}
+        with self._lock:
+            generation = self._generation
+            for sentences in split:
+                for _, s in sentences:
+                    self.stats["sentences"] += 1
+                    if s in pending or s in cached:
+                        continue
+                    r = self._cache.get((lang, s))
+                    if r is None:
+                        pending[s] = len(pending)
+                    else:
+                        self._cache.move_to_end((lang, s))
+                        cached[s] = r
+                        self.stats["hits"] += 1
+            self.stats["detected"] += len(pending)
+        return list(pending), (split, pending, cached, generation)
+
+
+    def complete(self, lang: str, state: Tuple,
+                 results: List[List[Dict]]) -> List[List[Dict]]:
+        """
+        Rebuild the results for the texts, adding the results for the pending
+        sentences to the cache
+          :param lang: the language for the texts
+          :param state: the state returned by `prepare()`
+          :param results: the detection results for the pending sentences
+          :return: the list of results for each text, with text offsets
+        """
+        split, pending, cached, generation = state
+        new = dict(zip(pending, results))
+
+        # Add the new results to the cache (unless it was cleared meanwhile)
+        with self._lock:
+            if generation == self._generation:
+                for s, r in new.items():
+                    self._cache[(lang, s)] = r
+                while len(self._cache) > self.size:
+                    self._cache.popitem(last=False)
+
+        # Assemble results, shifting offsets
+        out = []
+        for sentences in split:
+            res = []
+            for offset, s in sentences:
+                r = new.get(s)
+                for e in r if r is not None else cached[s]:
+                    res.append({**e, "start": e["start"] + offset,
+                                "end": e["end"] + offset})
+            out.append(res)
+        return out
+
+
+    def get_stats(self) -> Dict:
+        """
+        Return the cache statistics
+        """
+        return {**self.stats, "cached": len(self._cache)}
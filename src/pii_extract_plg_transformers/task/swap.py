@@ -0,0 +1,124 @@
+"""
+Replacement of the pipelines in a live task: a gate that lets a swap happen
+only between batches, and a signal handler to trigger reloads
+"""
+
+import signal
+from threading import Condition, Lock, Thread
+from time import perf_counter
+
+from pii_extract.helper.logger import PiiLogger
+
+from typing import Callable, Dict
+
+
+class Pass:
+    """
+    The right to use the current pipelines for one batch
+    """
+
+    __slots__ = "_gate", "_done"
+
+    def __init__(self, gate: "SwapGate"):
+        self._gate = gate
+        self._done = False
+
+
+    def __enter__(self) -> "Pass":
+        return self
+
+
+    def __exit__(self, *args):
+        self.leave()
+
+
+    def leave(self):
+        """
+        Give back the pass (calling it again has no effect)
+        """
+        with self._gate._cond:
+            if self._done:
+                return
+            self._done = True
+            self._gate._active -= 1
+            if self._gate._active == 0:
+                self._gate._cond.notify_all()
+
+
+class SwapGate:
+    """
+    Coordinate batches using the pipelines with swaps replacing them. Each
+    batch takes a pass while it uses the pipelines; a swap waits for all the
+    passes in use to be given back (draining the batches in flight), and new
+    passes wait while a swap is pending, so it cannot be starved
+    """
+
+    def __init__(self):
+        self._cond = Condition(Lock())
+        self._active = 0
+        self._swapping = False
+
+
+    def __repr__(self) -> str:
+        return f"<SwapGate active={self._active} swapping={self._swapping}>"
+
+
+    def enter(self) -> Pass:
+        """
+        Take a pass to use the pipelines for one batch (waiting if a swap is
+        pending)
+        """
+        with self._cond:
+            while self._swapping:
+                self._cond.wait()
+            self._active += 1
+        return Pass(self)
+
+
+    def swap(self, func: Callable):
+        """
+        Wait for all the batches in flight to end, and call a function while
+        no batch is using the pipelines
+          :return: a tuple (function result, time waiting for the batches)
+        """
+        start = perf_counter()
+        with self._cond:
+            while self._swapping:
+                self._cond.wait()
+            self._swapping = True
+            try:
+                while self._active:
+                    self._cond.wait()
+                wait = perf_counter() - start
+                return func(), wait
+            finally:
+                self._swapping = False
+                self._cond.notify_all()
+
+
+def reload_on_signal(task, load_config: Callable[[], Dict],
+                     signum: int = signal.SIGHUP,
+                     logger: PiiLogger = None) -> Callable:
+    """
+    Install a signal handler that reloads the pipelines of a task (e.g. after
+    a model rollout). The configuration is loaded and the pipelines built in
+    a background thread, so that the process keeps serving meanwhile. It
+    must be called from the main thread.
+      :param task: the task object
+      :param load_config: a function returning the plugin configuration
+        to reload from
+      :param signum: the signal to install the handler for
+      :param logger: a logger instance
+      :return: the previous handler for the signal
+    """
+    def run():
+        try:
+            task.reload(load_config(), wait=True)
+        except Exception as e:
+            if logger:
+                logger(".. reload failed: %s", e)
+
+    def handler(sig, frame):
+        Thread(target=run, name="pipeline-reload", daemon=True).start()
+
+    return signal.signal(signum, handler)
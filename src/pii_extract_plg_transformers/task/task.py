@@ -3,8 +3,12 @@ The Transformers-based PiiTask
 """
 
 import logging
+import weakref
 from operator import itemgetter
 from collections import defaultdict
+from threading import Lock, Thread
+from concurrent.futures import Future
+from time import perf_counter
 
 from pii_data.helper.exception import ProcException, ConfigException
 from pii_data.types import PiiEntity, PiiEntityInfo
@@ -12,13 +16,32 @@ from pii_data.types.doc import DocumentChunk
 from pii_extract.build.task import BaseMultiPiiTask
 from pii_extract.helper.utils import taskd_field
 from pii_extract.helper.logger import PiiLogger
+from pii_extract.helper.normalizer import normalize
 
-from typing import Iterable, Dict, List
+from typing import Callable, Iterable, Dict, List, Optional, Tuple
 
 from .. import VERSION, defs
 from .utils import hf_cachedir
+from .packing import ChunkPacker
+from .cascade import Cascade
+from .sentence import SentenceCache
+from .adaptive import BatchController, approx_tokens
+from .loader import PipelineLoader
+from .columnar import ColumnarResults
+from .swap import SwapGate
+from .scheduler import BatchScheduler
 
 
+# The detection results for a chunk
+ChunkResult = Tuple[DocumentChunk, List[PiiEntity]]
+
+# The pipeline results for a batch: a (lang, results) tuple for each chunk
+BatchResults = List[Tuple[str, List[Dict]]]
+
+# Default texts to warm up the pipelines built by a reload
+WARMUP_TEXTS = ["John Smith was born in London on 3 May 1970.",
+                "Please call 555-0100 or write to jsmith@example.com"]
+
 
 def einfo(p: Dict) -> PiiEntityInfo:
     """
@@ -27,17 +50,56 @@ def einfo(p: Dict) -> PiiEntityInfo:
     return PiiEntityInfo(p["pii"], p.get("lang"), p.get("country"),
                          p.get("subtype"))
 
+
+def _feature_options(cfg: Dict, name: str) -> Optional[Dict]:
+    """
+    Read the options for an optional feature in the task config: `true`
+    enables it with default options, a dict enables it with those options,
+    and a missing or false value disables it
+      :return: the options dict, or `None` if the feature is disabled
+    """
+    value = cfg.get(name)
+    return {} if value is True else value or None
+
 # ---------------------------------------------------------------------
 
 
+def _weak_batch_results(task: "TransformersTask") -> Callable:
+    """
+    Build the batch function for the scheduler worker of a task. It holds
+    only a weak reference to the task, so that a discarded task can be
+    collected (and its scheduler stopped)
+    """
+    ref = weakref.ref(task)
+
+    def process(batch: List[DocumentChunk]) -> BatchResults:
+        task = ref()
+        if task is None:
+            raise ProcException("Transformers task has been discarded")
+        return task._batch_results(batch, len(batch))
+    return process
+
+
 class TransformersTask(BaseMultiPiiTask):
     """
     PII Detector wrapper over models in the HF Transformers Library
+
+    Task objects can be pickled: they are serialized as a lightweight spec
+    (configuration, languages and entity map), and their pipelines are
+    re-created on first use after unpickling
     """
     pii_source = defs.TASK_SOURCE
     pii_name = "Transformers wrapper"
     pii_version = VERSION
 
+    # Runtime state: it is not serialized, and a new value is created by the
+    # given factory when the task is built or unpickled
+    _RUNTIME = (("models", dict), ("_packers", dict), ("_cascades", dict),
+                ("_masks", dict), ("_loader", type(None)),
+                ("_scheduler", type(None)), ("_gate", SwapGate),
+                ("_reloader", type(None)), ("_reload_lock", Lock),
+                ("_reload_stats", lambda: {"count": 0, "status": None}))
+
 
     def __init__(self, task: Dict, pii: List[Dict], cfg: Dict,
                  model_lang: Iterable[str], log: PiiLogger, **kwargs):
@@ -74,19 +136,121 @@ class TransformersTask(BaseMultiPiiTask):
 
         # Call parent constructor
         super().__init__(task=task, pii=pii)
+        self._init_runtime()
         self._log = log
+        self._cfg = cfg
+        self._batch_size = cfg.get(defs.CFG_TASK_BATCH, 8)
+        self._packing = _feature_options(cfg, "packing")
+        self._pipelined = _feature_options(cfg, "pipelined")
+        self._cascade_cfg = {m["lang_code"]: m["cascade"]
+                             for m in cfg.get(defs.CFG_TASK_MODELS, [])
+                             if m.get("cascade")}
+        sentences = _feature_options(cfg, "sentences")
+        self._sentences = None if sentences is None else \
+            SentenceCache(sentences.get("cache_size", 10000))
+        self._restrict = cfg.get("restrict_labels", False)
+        self._types = None
+        adaptive = _feature_options(cfg, "adaptive")
+        self._adaptive = None if adaptive is None else \
+            BatchController(batch_size=self._batch_size, **adaptive)
+        self._sched_cfg = _feature_options(cfg, "scheduler")
+        async_load = _feature_options(cfg, "async_load")
+        self._load_timeout = async_load.get("timeout") if async_load else None
 
         # Decide a default language for this task (possible if we have only one)
         self.lang = next(iter(total_lang)) if len(total_lang) == 1 else None
         self._log(".. TransformersTask (%s): #pii=%d lang=%s", VERSION,
                   len(pii), self.lang)
 
+        # Set up the Transformers pipeline engine (possibly in the background)
+        if async_load is None:
+            self.models = self._load_pipelines(total_lang)
+        else:
+            self._loader = PipelineLoader(self._load_pipelines, total_lang,
+                                          self._log).start()
+
+
+    def __repr__(self) -> str:
+        return f"<{TransformersTask.pii_name} #{len(self)}>"
+
+
+    def __len__(self) -> int:
+        return sum(len(k) for k in self._ent_map.values())
+
+
+    def __enter__(self) -> "TransformersTask":
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    def __del__(self):
+        # Stop the scheduler worker of a discarded task
+        sched = self.__dict__.get("_scheduler")
+        if sched is not None:
+            sched.close()
+
+
+    def close(self):
+        """
+        Release the background resources of the task: stop the worker thread
+        of the batching scheduler (cancelling its queued chunks) and the
+        pending background model loads. The task can still be used
+        afterwards: a scheduler is created again if needed, and models not
+        loaded yet are loaded on first use
+        """
+        with self._reload_lock:
+            sched, self._scheduler = self._scheduler, None
+            loader, self._loader = self._loader, None
+        if sched is not None:
+            sched.close()
+        if loader is not None:
+            self.models.update(loader.close())
+
+
+    def _init_runtime(self):
+        """
+        Create the runtime state of the task (empty pipelines & helpers)
+        """
+        for name, factory in self._RUNTIME:
+            setattr(self, name, factory())
+
+
+    def __getstate__(self) -> Dict:
+        """
+        Serialize the task as a lightweight spec, without the pipelines
+        """
+        runtime = {name for name, _ in self._RUNTIME}
+        return {k: v for k, v in self.__dict__.items() if k not in runtime}
+
+
+    def __setstate__(self, state: Dict):
+        """
+        Restore the task from its spec. Pipelines will be loaded on first use
+        (reusing the engine cache in the current process)
+        """
+        self.__dict__.update(state)
+        self._init_runtime()
+
+
+    def _load_pipelines(self, languages: Iterable[str], cfg: Dict = None,
+                        refresh: bool = False) -> Dict:
+        """
+        Create the Transformers pipelines for a set of languages
+          :param cfg: the task config to use (default: the task one)
+          :param refresh: load the models again, instead of reusing the ones
+            in the engine cache
+        """
+        if cfg is None:
+            cfg = self._cfg
+
         # Define cache directory (_before_ importing the pipeline module)
         cachedir = cfg.get("cachedir")
         if cachedir is not False:
             hf_cachedir(cachedir)
 
-        # Set up the Transformers pipeline engine
         try:
             from .pipeline import create_pipelines, ner_labels, set_random_seed
 
@@ -94,17 +258,18 @@ class TransformersTask(BaseMultiPiiTask):
             if seed:
                 set_random_seed(seed)
 
-            self.models = create_pipelines(cfg, languages=total_lang,
-                                           logger=self._log)
+            models = create_pipelines(cfg, languages=languages,
+                                      logger=self._log, refresh=refresh)
 
             # Check that all entities we want are actually supported
-            for lang, model in self.models.items():
+            for lang, model in models.items():
                 ent = ner_labels(model)
                 missing = {pname for pname in self._ent_map[lang]
                            if pname not in ent}
-            if missing:
-                raise ConfigException("entity for {} not found in model {}",
-                                      missing, lang)
+                if missing:
+                    raise ConfigException("entity for {} not found in model {}",
+                                          missing, lang)
+            return models
 
         except ConfigException:
             raise
@@ -116,19 +281,296 @@ class TransformersTask(BaseMultiPiiTask):
                                   e) from e
 
 
-    def __repr__(self) -> str:
-        return f"<{TransformersTask.pii_name} #{len(self)}>"
+    def _pipeline(self, lang: str):
+        """
+        Get the pipeline for a language, loading it if not available yet
+        """
+        pp = self.models.get(lang)
+        if pp is None:
+            if self._loader is not None and lang in self._loader:
+                pp = self._loader.wait(lang, self._load_timeout)
+                self.models[lang] = pp
+            else:
+                self.models.update(self._load_pipelines([lang]))
+                pp = self.models[lang]
+        return pp
 
 
-    def __len__(self) -> int:
-        return sum(len(k) for k in self._ent_map.values())
+    def reload(self, config: Dict = None, wait: bool = False,
+               warmup: List[str] = None) -> bool:
+        """
+        Replace the task pipelines with new ones, without stopping detection.
+        The new pipelines are built and warmed up in a background thread, and
+        then switched in between batches: batches in flight finish with the
+        old pipelines, and new batches wait only for them. Old pipelines are
+        then released from the engine cache
+          :param config: the new plugin configuration (or its `task_config`
+            section). If not given, the current one is used, and the models
+            are loaded again (e.g. after updating them in the cache)
+          :param wait: wait until the reload finishes (and raise its error,
+            if it fails)
+          :param warmup: texts to run through the new pipelines before
+            switching them in
+          :return: True if a reload was started, False if there was one
+            already in progress (in that case, the new config is ignored)
+        Only the model entries and the settings used to build pipelines are
+        taken from the new configuration. If building the new pipelines
+        fails, the current ones stay in place (the error is reported in the
+        `reload` entry in `get_stats()`)
+        """
+        cfg = self._cfg if config is None else config.get(defs.CFG_TASK, config)
+        with self._reload_lock:
+            thread = self._reloader
+            started = thread is None
+            if started:
+                thread = Thread(target=self._reload_run,
+                                args=(cfg, warmup or WARMUP_TEXTS),
+                                name="pipeline-reload", daemon=True)
+                self._reloader = thread
+                self._reload_stats.update(status="loading", error=None)
+                thread.start()
+        if wait:
+            thread.join()
+            error = self._reload_stats.get("exception")
+            if started and error is not None:
+                raise error
+        return started
 
 
-    def find(self, chunk: DocumentChunk) -> Iterable[PiiEntity]:
+    def _reload_run(self, cfg: Dict, warmup: List[str]):
         """
-        Perform PII detection on a document chunk
+        Build & warm up new pipelines, and switch them in
+        """
+        stats = self._reload_stats
+        stats["exception"] = None
+        start = perf_counter()
+        try:
+            models = self._load_pipelines(list(self._ent_map), cfg,
+                                          refresh=True)
+            for pp in models.values():
+                pp(warmup, batch_size=len(warmup))
+            load_time = perf_counter() - start
+            old, wait = self._gate.swap(lambda: self._swap(models, cfg))
+
+            # Old pipelines for models that are no longer configured are still
+            # in the engine cache (the others were replaced by the rebuild)
+            from .pipeline import ENGINE_CACHE
+            new = {id(pp) for pp in models.values()}
+            ENGINE_CACHE.release(pp for pp in old.values() if id(pp) not in new)
+            stats.update(count=stats["count"] + 1, status="done",
+                         load_time=load_time, swap_wait=wait)
+            self._log(".. pipelines reloaded in %.2f secs (swap wait %.3f secs)",
+                      load_time, wait)
+        except Exception as e:
+            stats.update(status="error", error=str(e), exception=e)
+            self._log(".. pipeline reload failed: %s", e)
+        finally:
+            with self._reload_lock:
+                self._reloader = None
+
+
+    def _swap(self, models: Dict, cfg: Dict) -> Dict:
+        """
+        Switch in a new set of pipelines (called while no batch is in flight)
+          :return: the old pipelines
+        """
+        old = self.models
+        self.models = models
+        self._cfg = cfg
+        self._cascade_cfg = {m["lang_code"]: m["cascade"]
+                             for m in cfg.get(defs.CFG_TASK_MODELS, [])
+                             if m.get("cascade")}
+        # Drop the objects built over the old pipelines or their results
+        self._packers = {}
+        self._masks = {}
+        self._cascades = {}
+        self._loader = None
+        if self._sentences is not None:
+            self._sentences.clear()
+        return old
+
+
+    def ready(self, lang: str = None) -> bool:
+        """
+        Check if the pipeline for a language (or for all the task languages,
+        if none is given) is loaded, so that detection will not block on
+        model loading
+        """
+        langs = [lang] if lang else list(self._ent_map)
+        return all(lang in self.models or
+                   (self._loader is not None and self._loader.ready(lang))
+                   for lang in langs)
+
+
+    def _packer(self, lang: str) -> ChunkPacker:
+        """
+        Get the chunk packer for a language, if packing is active
+        """
+        if self._packing is None:
+            return None
+        packer = self._packers.get(lang)
+        if packer is None:
+            from .infer import supports_packing
+            pp = self._pipeline(lang)
+            if supports_packing(pp):
+                opt = self._packing
+                packer = ChunkPacker(pp.tokenizer,
+                                     max_length=opt.get("max_length"),
+                                     max_item=opt.get("max_item"))
+            else:
+                self._log(".. packing not available for the %s model", lang)
+                packer = False
+            self._packers[lang] = packer
+        return packer or None
+
+
+    def _cascade(self, lang: str) -> Cascade:
+        """
+        Get the first stage of the cascade for a language, if it has one
+        """
+        if lang not in self._cascade_cfg:
+            return None
+        cascade = self._cascades.get(lang)
+        if cascade is None:
+            from .pipeline import create_cascade_pipelines
+            pp = create_cascade_pipelines(self._cfg, [lang], self._log)[lang]
+            opt = self._cascade_cfg[lang]
+            cascade = Cascade(pp, opt.get("labels") or self._ent_map[lang],
+                              threshold=opt.get("threshold", 0.3),
+                              sample=opt.get("sample", 0))
+            self._cascades[lang] = cascade
+        return cascade
+
+
+    def _label_mask(self, lang: str):
+        """
+        Get the mask for the model labels mapped to PII entities for a
+        language, if decoding is to be restricted to them
+        """
+        if not self._restrict:
+            return None
+        mask = self._masks.get(lang)
+        if mask is None:
+            from .infer import LabelMask
+            mask = LabelMask(self._pipeline(lang), self._ent_map[lang])
+            self._masks[lang] = mask
+        return mask
+
+
+    def _select(self, lang: str, texts: List[str],
+                batch_size: int) -> Tuple[List[int], List[bool], List[bool]]:
+        """
+        Decide which texts must be sent to the main model
+          :return: a tuple (indices of the texts to send, candidate flags,
+            sample flags). The flags are None if there is no cascade
+        """
+        cascade = self._cascade(lang)
+        if cascade is None:
+            return list(range(len(texts))), None, None
+        keep, sample = cascade.select(texts, batch_size)
+        idx = [n for n, (k, s) in enumerate(zip(keep, sample)) if k or s]
+        return idx, keep, sample
+
+
+    def _merge(self, lang: str, num: int, idx: List[int], results: List,
+               keep: List[bool], sample: List[bool],
+               cascade: Cascade = None) -> List[List[Dict]]:
+        """
+        Assemble the main model results for the texts selected by the cascade
+        (and record the results for the sampled texts)
+          :param cascade: the cascade that selected the texts (default: the
+            current one for the language)
+        """
+        if keep is None:
+            return results
+        entity_map = self._ent_map[lang]
+        out = [[] for _ in range(num)]
+        found = [0] * num
+        for n, r in zip(idx, results):
+            if keep[n]:
+                out[n] = r
+            found[n] = sum(e.get("entity_group") in entity_map for e in r)
+        (cascade or self._cascade(lang)).record(keep, sample, found)
+        return out
+
+
+    def _call_pipeline(self, lang: str, texts: List[str],
+                       batch_size: int) -> List[List[Dict]]:
+        """
+        Send a list of texts to the pipeline for a language, splitting them
+        into sentences if so configured
+        """
+        if self._sentences is None:
+            return self._detect(lang, texts, batch_size)
+        pending, state = self._sentences.prepare(lang, texts)
+        results = self._detect(lang, pending, batch_size)
+        return self._sentences.complete(lang, state, results)
+
+
+    def _detect(self, lang: str, texts: List[str],
+                batch_size: int) -> List[List[Dict]]:
+        """
+        Send a list of texts to the pipeline for a language, filtering them
+        through the cascade, if defined
+        """
+        idx, keep, sample = self._select(lang, texts, batch_size)
+        if keep is None:
+            return self._run_pipeline(lang, texts, batch_size)
+        results = self._run_pipeline(lang, [texts[n] for n in idx], batch_size)
+        return self._merge(lang, len(texts), idx, results, keep, sample)
+
+
+    def _run_pipeline(self, lang: str, texts: List[str],
+                      batch_size: int) -> List[List[Dict]]:
+        """
+        Send a list of texts to the pipeline for a language, packing them
+        into longer sequences if so configured
+        """
+        if not texts:
+            return []
+        packer = self._packer(lang)
+        if not packer:
+            return self._infer(lang, texts, batch_size)
+
+        from .infer import encode, token_lengths, pack_encoding, forward, \
+            decode_packed
+        pp = self._pipeline(lang)
+        enc = encode(pp, texts)
+        packs = packer.pack(token_lengths(enc))
+        out = [None] * len(texts)
+        for i in range(0, len(packs), batch_size):
+            penc = pack_encoding(pp, enc, packs[i:i+batch_size])
+            for n, r in decode_packed(pp, texts, penc, forward(pp, penc),
+                                      mask=self._label_mask(lang)):
+                out[n] = r
+        return out
+
+
+    def _infer(self, lang: str, texts: List[str],
+               batch_size: int) -> List[List[Dict]]:
+        """
+        Run a list of texts through the pipeline for a language. If decoding
+        is restricted to the mapped labels, the pipeline steps are run
+        separately, to decode the model output through the label mask
+        """
+        pp = self._pipeline(lang)
+        mask = self._label_mask(lang)
+        if mask is None:
+            return pp(texts, batch_size=batch_size)
+
+        from .infer import encode, forward, decode
+        out = []
+        for i in range(0, len(texts), batch_size):
+            mbatch = texts[i:i+batch_size]
+            enc = encode(pp, mbatch)
+            out += decode(pp, mbatch, enc, forward(pp, enc), mask=mask)
+        return out
+
+
+    def _chunk_lang(self, chunk: DocumentChunk) -> str:
+        """
+        Decide the model language for a chunk: chunk language or default
         """
-        # Decide the model languag: chunk language or default
         ctx = chunk.context or {}
         lang = ctx.get("lang", self.lang)
         if lang is None:
@@ -136,24 +578,24 @@ class TransformersTask(BaseMultiPiiTask):
         elif lang not in self._ent_map:
             raise ProcException("Transformers task exception: no tasks for lang: {}",
                                 lang)
+        return lang
 
-        # Take the entity map for our language
-        entity_map = self._ent_map[lang]
-        #print("LANG", lang, "\nDATA", chunk.data, "\nMAP", entity_map)
-
-        # Call the pipeline to get entity results
-        try:
-            pp = self.models[lang]
-            results = pp(chunk.data)
-        except Exception as e:
-            raise ProcException("Transformers exception: {}: {}",
-                                type(e).__name__, e) from e
 
+    def _matches(self, chunk: DocumentChunk, lang: str,
+                 results: List[Dict]) -> Iterable[Tuple[Dict, str]]:
+        """
+        Select the pipeline results for a chunk that are mapped to PII
+        entities, in position order, and adjust their start position to skip
+        whitespace
+          :return: an iterable of tuples (result, entity value)
+        """
         self._log("... Transformers results: %s", results if results else "NONE",
                   level=logging.DEBUG)
         #print("\n**** TRFS", lang, list(self._ent_map), chunk.data, "=>", results, sep="\n")
 
-        # Convert results into PiEntity objects
+        # Take the entity map for our language
+        entity_map = self._ent_map[lang]
+
         for r in sorted(results, key=itemgetter("start")):
 
             try:
@@ -169,7 +611,481 @@ class TransformersTask(BaseMultiPiiTask):
             if vs != v:
                 r["start"] += v.index(vs)
                 v = vs
+            yield r, v
+
 
+    def _entities(self, chunk: DocumentChunk, lang: str,
+                  results: List[Dict]) -> Iterable[PiiEntity]:
+        """
+        Convert pipeline results for a chunk into PiiEntity objects
+        """
+        entity_map = self._ent_map[lang]
+        for r, v in self._matches(chunk, lang, results):
             process = {"stage": "detection", "score": r["score"]}
             yield PiiEntity(entity_map[r["entity_group"]],
                             v, chunk.id, r["start"], process=process)
+
+
+    def entity_types(self) -> List[PiiEntityInfo]:
+        """
+        Return the table of entity types produced by the task (the one
+        indexed by the type ids in columnar results)
+        """
+        if self._types is None:
+            types = {}
+            for _, emap in sorted(self._ent_map.items()):
+                for info in emap.values():
+                    types.setdefault(info, len(types))
+            self._types = types
+        return list(self._types)
+
+
+    def _context_filter(self, chunk: DocumentChunk,
+                        pii_list: Iterable[PiiEntity]) -> Iterable[PiiEntity]:
+        """
+        Filter out the entities that do not have the required context
+        """
+        # Take the chunk text enlarged with its neighbors, if available
+        ctx = chunk.context or {}
+        bf = ctx.get("before", "")
+        fulltext = bf + chunk.data + ctx.get("after", "")
+        ndoc = None
+        for pii in pii_list:
+            if ndoc is None:
+                ndoc = normalize(fulltext, pii.info.lang, lowercase=True)
+            if self.check_context(ndoc, pii, len(bf)):
+                yield pii
+
+
+    def find_context(self, chunk: DocumentChunk) -> Iterable[PiiEntity]:
+        """
+        Perform PII detection on a document chunk, keeping only the entities
+        with the required context around them (the same validation used for
+        batched detection)
+        """
+        return self._context_filter(chunk, self.find(chunk))
+
+
+    def _sched(self) -> BatchScheduler:
+        """
+        Get the batching scheduler, creating it if needed
+        """
+        if self._scheduler is None:
+            with self._reload_lock:
+                if self._scheduler is None:
+                    opt = self._sched_cfg or {}
+                    self._scheduler = BatchScheduler(
+                        _weak_batch_results(self),
+                        batch_size=opt.get("bulk_batch", self._batch_size),
+                        interactive_batch=opt.get("interactive_batch", 4),
+                        max_wait=opt.get("max_wait", 0.002), logger=self._log)
+        return self._scheduler
+
+
+    def submit(self, chunk: DocumentChunk, priority: str = "interactive") -> "Future":
+        """
+        Queue a chunk for detection through the batching scheduler
+          :param chunk: the chunk
+          :param priority: the request priority: "interactive" or "bulk"
+          :return: a future whose result is the list of entities for the
+            chunk
+        """
+        self._chunk_lang(chunk)
+        fut = self._sched().submit(chunk, priority)
+        out = Future()
+
+        def done(f):
+            try:
+                r = f.result()
+                out.set_result(list(self._batch_entities([chunk], [r]))[0][1])
+            except BaseException as e:
+                out.set_exception(e)
+        fut.add_done_callback(done)
+        return out
+
+
+    def find(self, chunk: DocumentChunk) -> Iterable[PiiEntity]:
+        """
+        Perform PII detection on a document chunk
+        """
+        lang = self._chunk_lang(chunk)
+        #print("LANG", lang, "\nDATA", chunk.data, "\nMAP", self._ent_map[lang])
+
+        # Send it through the scheduler, as an interactive request
+        if self._sched_cfg is not None:
+            _, results = self._sched().submit(chunk, "interactive").result()
+            yield from self._entities(chunk, lang, results)
+            return
+
+        # Call the pipeline to get entity results
+        try:
+            with self._gate.enter():
+                results = self._call_pipeline(lang, [chunk.data], 1)[0]
+        except (ConfigException, ProcException):
+            raise
+        except Exception as e:
+            raise ProcException("Transformers exception: {}: {}",
+                                type(e).__name__, e) from e
+
+        # Convert results into PiEntity objects
+        yield from self._entities(chunk, lang, results)
+
+
+    def _group_lang(self, batch: List[DocumentChunk]) -> Dict[str, List[int]]:
+        """
+        Group the chunks in a batch by language
+        """
+        bylang = defaultdict(list)
+        for n, chunk in enumerate(batch):
+            bylang[self._chunk_lang(chunk)].append(n)
+        return bylang
+
+
+    def _batch_entities(self, batch: List[DocumentChunk],
+                        results: BatchResults) -> Iterable[ChunkResult]:
+        """
+        Produce the entities for a batch, in chunk order
+          :param batch: the chunks in the batch
+          :param results: a tuple (lang, pipeline results) for each chunk
+          :return: a tuple (chunk, list of entities) for each chunk
+        """
+        for chunk, (lang, r) in zip(batch, results):
+            pii_list = self._entities(chunk, lang, r)
+            if self.context:
+                pii_list = self._context_filter(chunk, pii_list)
+            yield chunk, list(pii_list)
+
+
+    def _batch_columns(self) -> Callable:
+        """
+        Create a function that produces the columnar results for a batch,
+        numbering the chunks across all the batches it is called for
+        """
+        types = self.entity_types()
+        ids = self._types
+        count = [0]
+
+        def columns(batch: List[DocumentChunk],
+                    results: BatchResults) -> Iterable[ColumnarResults]:
+            out = ColumnarResults(types)
+            for n, (chunk, (lang, r)) in enumerate(zip(batch, results),
+                                                   start=count[0]):
+                if self.context:
+                    # context validation needs the entity objects
+                    pii_list = self._entities(chunk, lang, r)
+                    for p in self._context_filter(chunk, pii_list):
+                        out.append(n, p.pos, p.pos + len(p), ids[p.info], lang,
+                                   p.fields["process"]["score"])
+                    continue
+                entity_map = self._ent_map[lang]
+                for m, v in self._matches(chunk, lang, r):
+                    out.append(n, m["start"], m["start"] + len(v),
+                               ids[entity_map[m["entity_group"]]], lang,
+                               m["score"])
+            count[0] += len(batch)
+            yield out
+
+        return columns
+
+
+    def _find_batch(self, batch: List[DocumentChunk], batch_size: int,
+                    convert: Callable) -> Iterable:
+        """
+        Process a list of chunks, calling the pipelines once per language
+          :param convert: the function to produce the output from the
+            pipeline results for the batch
+        """
+        yield from convert(batch, self._batch_results(batch, batch_size))
+
+
+    def _batch_results(self, batch: List[DocumentChunk],
+                       batch_size: int) -> BatchResults:
+        """
+        Get the pipeline results for a list of chunks, calling the pipelines
+        once per language
+        """
+        results = [None] * len(batch)
+        try:
+            with self._gate.enter():
+                for lang, idx in self._group_lang(batch).items():
+                    out = self._call_pipeline(lang, [batch[n].data for n in idx],
+                                              batch_size)
+                    for n, r in zip(idx, out):
+                        results[n] = lang, r
+        except (ConfigException, ProcException):
+            raise
+        except Exception as e:
+            raise ProcException("Transformers exception: {}: {}",
+                                type(e).__name__, e) from e
+        return results
+
+
+    def _find_pipelined(self, batches: Iterable[List[DocumentChunk]],
+                        batch_size: int, convert: Callable) -> Iterable:
+        """
+        Process batches of chunks with the pipelined engine: tokenization,
+        model inference and entity conversion run on separate threads, each
+        one working on a different batch. A batch keeps the pipeline objects
+        it started with until its results are converted; a swap pass is held
+        only around each forward call, so that a reload never waits for
+        batches queued between stages. Results of a batch finished after a
+        reload are recorded only in the sentence cache & cascade it started
+        with (which the reload discarded)
+        """
+        from .infer import encode, forward, decode, decode_packed, \
+            token_lengths, pack_encoding
+        from .engine import staged
+
+        ctrl = self._adaptive
+        bsize = batch_size
+
+        def tokenize(batch):
+            start = ctrl.start() if ctrl else None
+            batch_size = bsize or ctrl.limits()[0]
+            work = []
+            for lang, idx in self._group_lang(batch).items():
+                pp = self._pipeline(lang)
+                texts = [batch[n].data for n in idx]
+                sstate = None
+                if self._sentences is not None:
+                    texts, sstate = self._sentences.prepare(lang, texts)
+                sel, keep, sample = self._select(lang, texts, batch_size)
+                cascade = self._cascade(lang)
+                stexts = [texts[n] for n in sel]
+                packer = self._packer(lang)
+                if packer and stexts:
+                    enc = encode(pp, stexts)
+                    packs = packer.pack(token_lengths(enc))
+                    enc = [pack_encoding(pp, enc, packs[i:i+batch_size])
+                           for i in range(0, len(packs), batch_size)]
+                    mbatch = None
+                else:
+                    mbatch = [stexts[i:i+batch_size]
+                              for i in range(0, len(stexts), batch_size)]
+                    enc = [encode(pp, t) for t in mbatch]
+                work.append({"lang": lang, "idx": idx, "texts": stexts,
+                             "seqs": mbatch, "enc": enc,
+                             "num": len(texts), "select": (sel, keep, sample),
+                             "cascade": cascade,
+                             "sentences": sstate, "pp": pp,
+                             "mask": self._label_mask(lang)})
+            return batch, work, start
+
+        def infer(item):
+            for w in item[1]:
+                w["logits"] = []
+                for e in w["enc"]:
+                    with self._gate.enter():
+                        w["logits"].append(forward(w["pp"], e))
+            return item
+
+        qsize = self._pipelined.get("queue_size", 2)
+        try:
+            for batch, work, start in staged(batches, tokenize, infer,
+                                             queue_size=qsize):
+                results = [None] * len(batch)
+                for w in work:
+                    pp, mask = w["pp"], w["mask"]
+                    if w["seqs"] is None:       # packed sequences
+                        out = [None] * len(w["texts"])
+                        for enc, logits in zip(w["enc"], w["logits"]):
+                            for n, r in decode_packed(pp, w["texts"], enc,
+                                                      logits, mask=mask):
+                                out[n] = r
+                    else:
+                        out = []
+                        for seqs, enc, logits in zip(w["seqs"], w["enc"],
+                                                     w["logits"]):
+                            out += decode(pp, seqs, enc, logits, mask=mask)
+                    sel, keep, sample = w["select"]
+                    out = self._merge(w["lang"], w["num"], sel, out,
+                                      keep, sample, w["cascade"])
+                    if w["sentences"] is not None:
+                        out = self._sentences.complete(w["lang"],
+                                                       w["sentences"], out)
+                    for n, r in zip(w["idx"], out):
+                        results[n] = w["lang"], r
+                if ctrl:
+                    ctrl.record(start, len(batch),
+                                sum(approx_tokens(c.data) for c in batch))
+                yield from convert(batch, results)
+        except (ConfigException, ProcException):
+            raise
+        except Exception as e:
+            raise ProcException("Transformers exception: {}: {}",
+                                type(e).__name__, e) from e
+
+
+    def _find_adaptive(self, chunks: Iterable[DocumentChunk],
+                       convert: Callable) -> Iterable:
+        """
+        Perform batched detection with batches sized by the adaptive
+        controller
+        """
+        ctrl = self._adaptive
+        batches = ctrl.batches(chunks, key=lambda c: c.data)
+        if self._pipelined is not None:
+            yield from self._find_pipelined(batches, None, convert)
+            return
+        for batch in batches:
+            start = ctrl.start()
+            result = list(self._find_batch(batch, ctrl.limits()[0], convert))
+            ctrl.record(start, len(batch),
+                        sum(approx_tokens(c.data) for c in batch))
+            yield from result
+
+
+    def find_batch(self, chunks: Iterable[DocumentChunk],
+                   batch_size: int = None,
+                   priority: str = None) -> Iterable[PiiEntity]:
+        """
+        Perform PII detection on a sequence of document chunks, sending them
+        to the pipelines in batches. Context validation, if defined, is also
+        applied to the results
+          :param chunks: the chunks to process (each one may have a different
+            language)
+          :param batch_size: number of chunks to process in each pipeline
+            call (default is the `batch_size` config field, or 8)
+          :param priority: send the chunks through the batching scheduler,
+            with this priority
+        See `find_chunks()` for the batching options
+        """
+        for _, pii_list in self.find_chunks(chunks, batch_size, priority):
+            yield from pii_list
+
+
+    def find_chunks(self, chunks: Iterable[DocumentChunk],
+                    batch_size: int = None,
+                    priority: str = None) -> Iterable[ChunkResult]:
+        """
+        Perform batched PII detection on a sequence of document chunks, and
+        produce the results for each chunk
+          :param chunks: the chunks to process (each one may have a different
+            language)
+          :param batch_size: number of chunks to process in each pipeline
+            call (default is the `batch_size` config field, or 8)
+          :param priority: send the chunks through the batching scheduler,
+            with this priority ("interactive" or "bulk"). If the scheduler
+            is configured, the default is "bulk"
+          :return: an iterable of tuples (chunk, list of entities), one for
+            each chunk, in the same order
+        If chunk packing is active, chunks are gathered in groups of
+        `packing.chunks` (default 16 times the batch size), and each group
+        is packed into sequences before sending it to the pipeline.
+        If adaptive batching is active and no batch size is given, batches
+        are sized by the adaptive controller. Chunks sent through the
+        scheduler are batched by it, together with the chunks from other
+        calls with the same priority
+        """
+        return self._find(chunks, batch_size, self._batch_entities, priority)
+
+
+    def find_columns(self, chunks: Iterable[DocumentChunk],
+                     batch_size: int = None,
+                     priority: str = None) -> Iterable[ColumnarResults]:
+        """
+        Perform batched PII detection on a sequence of document chunks, and
+        produce the results as columns, without creating PiiEntity objects
+          :param chunks: the chunks to process
+          :param batch_size: number of chunks to process in each pipeline
+            call (default is the `batch_size` config field, or 8)
+          :return: an iterable of ColumnarResults objects, one per batch.
+            Chunk indices count the chunks across all batches, and entity
+            type ids index the table returned by `entity_types()`
+        Batching options are the same as in `find_chunks()`
+        """
+        return self._find(chunks, batch_size, self._batch_columns(), priority)
+
+
+    def _find_scheduled(self, chunks: Iterable[DocumentChunk], priority: str,
+                        convert: Callable) -> Iterable:
+        """
+        Perform PII detection on a sequence of document chunks through the
+        batching scheduler. The output is produced in the calling thread, in
+        groups of the scheduler batch size
+        """
+        sched = self._sched()
+        size = sched.batch_size(priority)
+
+        def checked():
+            for chunk in chunks:
+                self._chunk_lang(chunk)
+                yield chunk
+
+        batch, results = [], []
+        for chunk, r in sched.map(checked(), priority):
+            batch.append(chunk)
+            results.append(r)
+            if len(batch) >= size:
+                yield from convert(batch, results)
+                batch, results = [], []
+        if batch:
+            yield from convert(batch, results)
+
+
+    def _find(self, chunks: Iterable[DocumentChunk], batch_size: int,
+              convert: Callable, priority: str = None) -> Iterable:
+        """
+        Perform batched PII detection on a sequence of document chunks
+          :param convert: the function to produce the output from the
+            pipeline results for each batch
+          :param priority: the priority, to send the chunks through the
+            batching scheduler
+        """
+        if priority is None and self._sched_cfg is not None:
+            priority = "bulk"
+        if priority is not None:
+            yield from self._find_scheduled(chunks, priority, convert)
+            return
+        if batch_size is None and self._adaptive is not None:
+            yield from self._find_adaptive(chunks, convert)
+            return
+
+        batch_size = batch_size or self._batch_size
+        group_size = batch_size
+        if self._packing is not None:
+            group_size = self._packing.get("chunks", 16*batch_size)
+
+        def batches():
+            batch = []
+            for chunk in chunks:
+                batch.append(chunk)
+                if len(batch) >= group_size:
+                    yield batch
+                    batch = []
+            if batch:
+                yield batch
+
+        if self._pipelined is not None:
+            yield from self._find_pipelined(batches(), batch_size, convert)
+        else:
+            for batch in batches():
+                yield from self._find_batch(batch, batch_size, convert)
+
+
+    def get_stats(self) -> Dict:
+        """
+        Return processing statistics for the task
+        """
+        stats = {}
+        for lang, cascade in self._cascades.items():
+            stats[f"cascade.{lang}"] = cascade.get_stats()
+        if self._sentences is not None:
+            stats["sentences"] = self._sentences.get_stats()
+        if self._adaptive is not None:
+            stats["adaptive"] = self._adaptive.get_stats()
+        if self._loader is not None:
+            stats["loader"] = self._loader.get_stats()
+        if self._scheduler is not None:
+            stats["scheduler"] = self._scheduler.get_stats()
+        if self._reload_stats["status"]:
+            stats["reload"] = {k: v for k, v in self._reload_stats.items()
+                               if k != "exception"}
+        from ..model.compile import compile_stats
+        for lang, pp in self.models.items():
+            cstats = compile_stats(pp.model)
+            if cstats:
+                stats[f"compile.{lang}"] = cstats
+        from . import pipeline
+        stats["engine_cache"] = pipeline.ENGINE_CACHE.get_stats()
+        return stats
@@ -0,0 +1,101 @@
+"""
+Split large plain text files into chunks, lazily, over a memory-mapped
+view of the file. Chunks end at paragraph boundaries, or when they reach
+a maximum size, at a whitespace or UTF-8 character boundary
+"""
+
+import mmap
+from pathlib import Path
+
+from typing import Iterable, Tuple, Union
+
+from pii_data.helper.exception import FileException
+from pii_data.types.doc import DocumentChunk
+
+# Default maximum chunk size, in bytes
+CHUNK_SIZE = 2000
+
+# Separators to split at when a chunk is too big, in order of preference
+_SEPARATORS = (b"\n", b" ", b"\t")
+
+
+def _char_start(buf, pos: int, start: int) -> int:
+    """
+    Move a position back to the start of a UTF-8 character
+    """
+    while pos > start and (buf[pos] & 0xC0) == 0x80:
+        pos -= 1
+    return pos
+
+
+def split_points(buf, max_bytes: int = CHUNK_SIZE) -> Iterable[Tuple[int, int, int]]:
+    """
+    Find the chunk boundaries in a UTF-8 buffer
+      :param buf: the buffer (a bytes-like object supporting `find()` and
+        `rfind()`, such as an mmap)
+      :param max_bytes: maximum size of a chunk
+      :return: an iterable of tuples (start, end, next) with the byte range
+        for each chunk, and the start of the next one (bytes between `end`
+        and `next` are a separator, not part of any chunk)
+    """
+    pos = 0
+    size = len(buf)
+    while pos < size:
+        limit = min(pos + max_bytes, size)
+        # A paragraph break within the limit
+        p = buf.find(b"\n\n", pos, limit + 1)
+        if p != -1:
+            yield pos, p, p + 2
+            pos = p + 2
+            continue
+        if limit == size:
+            yield pos, size, size
+            return
+        # The last whitespace within the limit
+        for sep in _SEPARATORS:
+            p = buf.rfind(sep, pos, limit + 1)
+            if p > pos:
+                yield pos, p, p + 1
+                pos = p + 1
+                break
+        else:
+            # No whitespace: cut at a character boundary
+            end = _char_start(buf, limit, pos)
+            if end == pos:
+                end = limit
+            yield pos, end, end
+            pos = end
+
+
+def text_file_chunks(filename: Union[str, Path], lang: str = None,
+                     max_bytes: int = CHUNK_SIZE) -> Iterable[DocumentChunk]:
+    """
+    Read a UTF-8 text file as a sequence of chunks, lazily. Each chunk has
+    in its context the language (if given) and the character offset of the
+    chunk in the whole file (`offset`). Chunks containing only whitespace
+    are skipped
+      :param filename: the file to read
+      :param lang: the language for the chunks
+      :param max_bytes: maximum size of a chunk, in bytes
+    """
+    try:
+        f = open(filename, "rb")
+    except OSError as e:
+        raise FileException("cannot open text file '{}': {}", filename, e) from e
+    with f:
+        if f.seek(0, 2) == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            offset = 0
+            num = 0
+            for start, end, nxt in split_points(buf, max_bytes):
+                text = buf[start:end].decode("utf-8", errors="replace")
+                if text.strip():
+                    num += 1
+                    ctx = {"offset": offset}
+                    if lang:
+                        ctx["lang"] = lang
+                    yield DocumentChunk(str(num), text, ctx)
+                offset += len(text)
+                if nxt > end:
+                    offset += len(buf[end:nxt].decode("utf-8", errors="replace"))
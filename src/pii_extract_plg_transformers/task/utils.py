@@ -3,11 +3,12 @@ Some configuration utilities
 """
 
 import sys
-from os import environ
+import hashlib
+from os import environ, sysconf
 from pathlib import Path
 from importlib.metadata import version
 
-from typing import Dict, Set
+from typing import Dict, Optional, Set
 
 from pii_data.helper.exception import ConfigException, FileException
 
@@ -39,6 +40,43 @@ def hf_cachedir(cachedir: str = None):
     #print("CACHEDIR", str(cachedir))
 
 
+def artifact_dir(kind: str, name: str, key: str = None) -> Path:
+    """
+    Return the folder where to keep a model artifact produced by the package
+    (inside the HF cache directory)
+      :param kind: type of artifact
+      :param name: model name
+      :param key: an optional key identifying the model variant (e.g. its
+        engine cache key); a digest of it is added to the name
+    """
+    cachedir = environ.get(ENV_HF_CACHE)
+    if cachedir:
+        cachedir = Path(cachedir)
+    else:
+        cachedir = Path.home() / ".cache" / "huggingface" / "hub"
+    name = name.replace("/", "--")
+    if key:
+        name += "-" + hashlib.sha1(key.encode("utf-8")).hexdigest()[:12]
+    return cachedir / "piisa" / kind / name
+
+
+def process_rss() -> Optional[int]:
+    """
+    Return the resident set size of the current process, in bytes (or None
+    if it cannot be obtained)
+    """
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
 def package_languages(config: Dict) -> Set[str]:
     """
     Return the set of languages defined in the configuration for the package
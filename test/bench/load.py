@@ -0,0 +1,423 @@
+"""
+Load test for the detection engine under concurrent callers: an open-loop
+generator sends requests (one chunk each) at a given arrival rate, from a
+pool of caller threads or through the batching scheduler, and measures
+throughput, latency percentiles over time, queue depth and CPU utilization.
+
+By default the model pipeline is replaced by a fake that takes a configurable
+time per call and per text (sleeping, so that it releases the GIL as model
+inference does); a real (tiny) model can be used instead with `--model`.
+
+Usage:
+   PYTHONPATH=src:test python test/bench/load.py run [options] [--out FILE]
+   PYTHONPATH=src:test python test/bench/load.py compare BASE RESULTS
+
+Latencies are measured from the scheduled arrival time of each request, so
+that time spent waiting for a free caller is included
+"""
+
+import os
+import sys
+import json
+import random
+import argparse
+import platform
+import threading
+from time import perf_counter, process_time, sleep
+from types import SimpleNamespace
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from typing import Dict, List
+
+from pii_data.types.doc import DocumentChunk
+
+from pii_extract_plg_transformers import VERSION
+from pii_extract_plg_transformers.plugin_loader import load_plugin_config
+from pii_extract_plg_transformers.app.detect import create_task_object
+from pii_extract_plg_transformers.task.adaptive import percentile
+
+from taux.monkey_patch import patch_transformer_pipeline, patch_env
+
+
+# Sentence used to build the request chunks
+SENTENCE = "Alan Turing was born in Maida Vale, London. "
+
+# Latency percentiles reported
+PERCENTILES = (0.5, 0.9, 0.95, 0.99)
+
+
+# -------------------------------------------------------------------------
+
+
+class FakePipeline:
+    """
+    A pipeline replacement that takes a fixed time per call plus a time per
+    text. With `exclusive`, calls are serialized (as in a single device)
+    """
+
+    def __init__(self, results: List[Dict], call_time: float,
+                 text_time: float, exclusive: bool = False):
+        self.results = results
+        self.call_time = call_time
+        self.text_time = text_time
+        self.model = SimpleNamespace(
+            config=SimpleNamespace(label2id={"PER": 0, "LOC": 1}))
+        self._lock = threading.Lock() if exclusive else None
+
+
+    def __call__(self, data, **kwargs):
+        num = len(data) if isinstance(data, list) else 1
+        if self._lock:
+            with self._lock:
+                sleep(self.call_time + num*self.text_time)
+        else:
+            sleep(self.call_time + num*self.text_time)
+        return [self.results]*num if isinstance(data, list) else self.results
+
+
+def fake_results(num: int) -> List[Dict]:
+    """
+    Build the pipeline results for a chunk of `num` sentences
+    """
+    out = []
+    size = len(SENTENCE)
+    for n in range(num):
+        base = n*size
+        out += [
+            {"entity_group": "PER", "start": base, "end": base + 11, "score": 0.98},
+            {"entity_group": "LOC", "start": base + 24, "end": base + 34, "score": 0.95},
+            {"entity_group": "LOC", "start": base + 36, "end": base + 42, "score": 0.97}
+        ]
+    return out
+
+
+def build_task(mp, args: argparse.Namespace):
+    """
+    Create the task to be tested
+    """
+    config = load_plugin_config(args.config)
+    task_config = config["task_config"]
+    if args.model:
+        task_config["models"] = [{"lang_code": "en", "model": args.model}]
+    else:
+        mck = patch_transformer_pipeline(mp, [], ["PER", "LOC"])
+        mck.return_value = FakePipeline(fake_results(args.sentences),
+                                        args.call_time, args.text_time,
+                                        args.exclusive)
+    if args.mode == "submit" and task_config.get("scheduler") is None:
+        task_config["scheduler"] = True
+    return create_task_object(config, "en")
+
+
+# -------------------------------------------------------------------------
+
+
+def arrivals(rate: float, duration: float, poisson: bool = True,
+             seed: int = None) -> List[float]:
+    """
+    Generate the request arrival times (in seconds from the start)
+    """
+    rnd = random.Random(seed)
+    out = []
+    t = 0.0
+    while True:
+        t += rnd.expovariate(rate) if poisson else 1/rate
+        if t >= duration:
+            return out
+        out.append(t)
+
+
+class LoadRun:
+    """
+    Send requests to a task at the scheduled arrival times, and record
+    their latency, plus periodic samples of queue depth and CPU usage
+    """
+
+    def __init__(self, task, mode: str, concurrency: int,
+                 interval: float = 1.0):
+        self.task = task
+        self.mode = mode
+        self.concurrency = concurrency
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self.requests = []      # (arrival, end, ok), by request
+        self.samples = []       # periodic samples
+        self.in_flight = 0
+
+
+    def _finish(self, arrival: float, ok: bool):
+        end = perf_counter() - self.start
+        with self._lock:
+            self.requests.append((arrival, end, ok))
+            self.in_flight -= 1
+
+
+    def _call(self, chunk: DocumentChunk, arrival: float):
+        try:
+            list(self.task.find(chunk))
+            ok = True
+        except Exception:
+            ok = False
+        self._finish(arrival, ok)
+
+
+    def _submit(self, chunk: DocumentChunk, arrival: float):
+        try:
+            fut = self.task.submit(chunk)
+        except Exception:
+            self._finish(arrival, False)
+            return
+        fut.add_done_callback(
+            lambda f: self._finish(arrival, f.exception() is None))
+
+
+    def _sampler(self):
+        """
+        Take periodic samples of queue depth and CPU utilization, plus a
+        final one when the run ends
+        """
+        cpus = os.cpu_count() or 1
+        last_wall, last_cpu = perf_counter(), process_time()
+        stop = False
+        while not stop:
+            stop = self._done.wait(self.interval)
+            wall, cpu = perf_counter(), process_time()
+            sched = self.task.get_stats().get("scheduler", {})
+            with self._lock:
+                in_flight = self.in_flight
+            self.samples.append({
+                "t": round(wall - self.start, 3),
+                "in_flight": in_flight,
+                "queued": sum(s["queued"] for s in sched.values()),
+                "cpu": (cpu - last_cpu)/(wall - last_wall)/cpus,
+                "threads": threading.active_count()})
+            last_wall, last_cpu = wall, cpu
+
+
+    def run(self, times: List[float], chunk: DocumentChunk,
+            timeout: float = 60) -> float:
+        """
+        Send the requests, and wait for them to complete
+          :return: the elapsed time
+        """
+        pool = ThreadPoolExecutor(self.concurrency, "load-caller") \
+            if self.mode == "find" else None
+        self.start = perf_counter()
+        sampler = threading.Thread(target=self._sampler, daemon=True)
+        sampler.start()
+        for n, t in enumerate(times):
+            left = t - (perf_counter() - self.start)
+            if left > 0:
+                sleep(left)
+            c = DocumentChunk(str(n), chunk.data, chunk.context)
+            with self._lock:
+                self.in_flight += 1
+            if pool:
+                pool.submit(self._call, c, t)
+            else:
+                self._submit(c, t)
+        limit = perf_counter() + timeout
+        while self.in_flight and perf_counter() < limit:
+            sleep(0.01)
+        elapsed = perf_counter() - self.start
+        self._done.set()
+        sampler.join()
+        if pool:
+            pool.shutdown(wait=False)
+        return elapsed
+
+
+def latency_stats(latencies: List[float]) -> Dict:
+    """
+    Summarize a list of latencies
+    """
+    if not latencies:
+        return {"avg": None, "max": None,
+                **{f"p{int(q*100)}": None for q in PERCENTILES}}
+    return {"avg": sum(latencies)/len(latencies), "max": max(latencies),
+            **{f"p{int(q*100)}": percentile(latencies, q) for q in PERCENTILES}}
+
+
+def timeline(load: LoadRun, interval: float) -> List[Dict]:
+    """
+    Aggregate the requests completed in each sampling interval
+    """
+    out = []
+    lo = 0.0
+    for s in load.samples:
+        hi = s["t"]
+        done = [(a, e, ok) for a, e, ok in load.requests if lo <= e < hi]
+        lat = [e - a for a, e, ok in done if ok]
+        out.append({**s, "completed": len(done),
+                    "errors": sum(1 for d in done if not d[2]),
+                    "throughput": len(done)/(hi - lo),
+                    "latency": latency_stats(lat)})
+        lo = hi
+    return out
+
+
+def run(args: argparse.Namespace) -> Dict:
+    """
+    Run the load test
+    """
+    with pytest.MonkeyPatch.context() as mp:
+        patch_env(mp)
+        task = build_task(mp, args)
+        chunk = DocumentChunk("0", SENTENCE*args.sentences, {"lang": "en"})
+        list(task.find(chunk))      # load & warm up
+        times = arrivals(args.rate, args.duration, not args.uniform, args.seed)
+        print(f"  {len(times)} requests over {args.duration} s ({args.mode})",
+              file=sys.stderr)
+        load = LoadRun(task, args.mode, args.concurrency, args.interval)
+        elapsed = load.run(times, chunk, args.timeout)
+        stats = task.get_stats()
+
+    # Summary, over the requests arriving after the warmup period
+    reqs = [r for r in load.requests if r[0] >= args.warmup]
+    ok = [e - a for a, e, k in reqs if k]
+    span = max((e for _, e, _ in reqs), default=0) - args.warmup
+    cpu = [s["cpu"] for s in load.samples]
+    summary = {"requests": len(times), "completed": len(load.requests),
+               "errors": sum(1 for r in load.requests if not r[2]),
+               "elapsed": elapsed,
+               "offered_rate": len(times)/args.duration,
+               "throughput": len(ok)/span if span > 0 else None,
+               "latency": latency_stats(ok),
+               "queued_max": max((s["queued"] for s in load.samples), default=0),
+               "in_flight_max": max((s["in_flight"] for s in load.samples),
+                                    default=0),
+               "cpu_avg": sum(cpu)/len(cpu) if cpu else None}
+    params = {k: v for k, v in vars(args).items()
+              if k not in ("cmd", "out", "config")}
+    return {"version": VERSION, "python": platform.python_version(),
+            "date": datetime.now().isoformat(timespec="seconds"),
+            "cpu_count": os.cpu_count(), "params": params,
+            "summary": summary, "timeline": timeline(load, args.interval),
+            "task_stats": {k: v for k, v in stats.items()
+                           if k in ("scheduler", "adaptive", "engine_cache")}}
+
+
+# -------------------------------------------------------------------------
+
+
+def _ms(v) -> str:
+    return f"{v*1000:9.1f}" if v is not None else f"{'-':>9}"
+
+
+def report(results: Dict):
+    """
+    Print a summary of the results
+    """
+    s = results["summary"]
+    print(f"  {'t':>6} {'done':>6} {'req/s':>8} {'p50 ms':>9} {'p95 ms':>9} "
+          f"{'p99 ms':>9} {'flight':>6} {'queue':>6} {'cpu':>6}")
+    for r in results["timeline"]:
+        lat = r["latency"]
+        print(f"  {r['t']:6.1f} {r['completed']:6} {r['throughput']:8.1f} "
+              f"{_ms(lat['p50'])} {_ms(lat['p95'])} {_ms(lat['p99'])} "
+              f"{r['in_flight']:6} {r['queued']:6} {r['cpu']:6.1%}")
+    lat = s["latency"]
+    print(f"\n  requests: {s['requests']}  completed: {s['completed']}  "
+          f"errors: {s['errors']}")
+    print(f"  offered: {s['offered_rate']:.1f} req/s  throughput: "
+          f"{s['throughput'] or 0:.1f} req/s")
+    print("  latency (ms): " + "  ".join(f"{k} {_ms(v).strip()}"
+                                         for k, v in lat.items()))
+    if s["cpu_avg"] is not None:
+        print(f"  cpu: {s['cpu_avg']:.1%} of {results['cpu_count']} cores")
+
+
+def compare(results: Dict, baseline: Dict, tolerance: float) -> bool:
+    """
+    Compare the throughput and latency percentiles of two runs
+      :return: True if the results are not worse than the baseline by more
+        than the tolerance
+    """
+    if results["params"] != baseline["params"]:
+        print("  warning: runs have different parameters")
+    ok = True
+    print(f"  {'metric':12} {'baseline':>10} {'current':>10} {'ratio':>7}")
+    cur, base = results["summary"], baseline["summary"]
+    rows = [("throughput", base["throughput"], cur["throughput"], False)]
+    rows += [(f"latency.{k}", base["latency"][k], cur["latency"][k], True)
+             for k in base["latency"]]
+    for name, b, c, lower in rows:
+        if not b or c is None:
+            print(f"  {name:12} {b or 0:10.4f} {c or 0:10.4f}")
+            continue
+        ratio = c/b
+        flag = ""
+        if (ratio > 1 + tolerance) if lower else (ratio < 1 - tolerance):
+            flag, ok = "  REGRESSION", False
+        print(f"  {name:12} {b:10.4f} {c:10.4f} {ratio:7.2f}{flag}")
+    return ok
+
+
+def parse_args(args: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Load test for the detection engine under concurrent callers")
+    subp = parser.add_subparsers(dest="cmd", required=True)
+
+    s1 = subp.add_parser("run", help="run a load test")
+    s1.add_argument("--mode", choices=("find", "submit"), default="find",
+                    help="call find() from a pool of caller threads, or submit() requests to the batching scheduler (default: %(default)s)")
+    s1.add_argument("--rate", type=float, default=50,
+                    help="request arrival rate, in requests/s (default: %(default)s)")
+    s1.add_argument("--uniform", action="store_true",
+                    help="use uniform arrivals instead of a Poisson process")
+    s1.add_argument("--concurrency", type=int, default=8,
+                    help="number of caller threads, in find mode (default: %(default)s)")
+    s1.add_argument("--duration", type=float, default=10,
+                    help="duration of the arrivals, in seconds (default: %(default)s)")
+    s1.add_argument("--warmup", type=float, default=1,
+                    help="initial seconds excluded from the summary (default: %(default)s)")
+    s1.add_argument("--interval", type=float, default=1,
+                    help="sampling interval, in seconds (default: %(default)s)")
+    s1.add_argument("--timeout", type=float, default=60,
+                    help="maximum wait for pending requests at the end (default: %(default)s)")
+    s1.add_argument("--seed", type=int, help="random seed for the arrivals")
+    s1.add_argument("--sentences", type=int, default=5,
+                    help="sentences per request chunk (default: %(default)s)")
+
+    g = s1.add_argument_group("Model")
+    g.add_argument("--config", help="plugin configuration file")
+    g.add_argument("--model", help="use this model for English, instead of a fake pipeline")
+    g.add_argument("--call-time", type=float, default=0.005,
+                   help="fake pipeline: time per call, in seconds (default: %(default)s)")
+    g.add_argument("--text-time", type=float, default=0.002,
+                   help="fake pipeline: time per text, in seconds (default: %(default)s)")
+    g.add_argument("--exclusive", action="store_true",
+                   help="fake pipeline: serialize calls, as in a single device")
+    s1.add_argument("--out", help="write the results to this file")
+
+    s2 = subp.add_parser("compare", help="compare the results of two runs")
+    s2.add_argument("baseline", help="the baseline results file")
+    s2.add_argument("results", help="the results file")
+    s2.add_argument("--tolerance", type=float, default=0.25,
+                    help="allowed degradation ratio (default: %(default)s)")
+    return parser.parse_args(args)
+
+
+def main(args: List[str] = None):
+    args = parse_args(args)
+    if args.cmd == "run":
+        results = run(args)
+        report(results)
+        if args.out:
+            with open(args.out, "w", encoding="utf-8") as f:
+                json.dump(results, f, indent=2, default=str)
+        return
+    with open(args.results, encoding="utf-8") as f:
+        results = json.load(f)
+    with open(args.baseline, encoding="utf-8") as f:
+        baseline = json.load(f)
+    if not compare(results, baseline, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,271 @@
+"""
+Micro-benchmarks for the Python work done by the plugin around model
+inference: conversion of pipeline results into PiiEntity objects, batched
+detection and task construction. Model pipelines are replaced by the fakes
+in `taux.monkey_patch`, so only the plugin overhead is measured.
+
+Usage:
+   PYTHONPATH=src:test python test/bench/overhead.py run [--out FILE] [--compare]
+   PYTHONPATH=src:test python test/bench/overhead.py compare RESULTS
+
+Times are normalized by a pure-Python calibration loop (run before each
+benchmark), so that results from different machines can be compared against
+the stored baseline
+"""
+
+import gc
+import sys
+import json
+import argparse
+import platform
+from pathlib import Path
+from time import perf_counter
+from datetime import datetime
+
+import pytest
+
+from typing import Callable, Dict, List
+
+from pii_data.types.doc import DocumentChunk
+
+from pii_extract_plg_transformers import VERSION
+from pii_extract_plg_transformers.plugin_loader import load_plugin_config
+from pii_extract_plg_transformers.app.detect import create_task_object
+from pii_extract_plg_transformers.task.collector import _pii_list, TaskCollector
+
+from taux.monkey_patch import patch_transformer_pipeline, patch_env
+
+
+BASELINE = Path(__file__).parent / "baseline.json"
+
+# Number of repetitions for each benchmark (the best one is taken)
+REPEAT = 7
+
+# Minimum time for a repetition, in seconds
+MIN_TIME = 0.2
+
+# Sentence used to build synthetic chunks
+SENTENCE = "Alan Turing was born in Maida Vale, London. "
+
+
+# -------------------------------------------------------------------------
+
+
+def synthetic_chunk(num: int) -> str:
+    return SENTENCE * num
+
+
+def synthetic_results(num: int) -> List[Dict]:
+    """
+    Build a list of pipeline results for a chunk of `num` sentences: one
+    person (with trailing whitespace, to exercise value stripping) and two
+    locations per sentence, plus an unmapped label. Results are not in
+    order, so that they must be sorted
+    """
+    out = []
+    size = len(SENTENCE)
+    for n in reversed(range(num)):
+        base = n*size
+        out += [
+            {"entity_group": "PER", "start": base, "end": base + 12, "score": 0.98},
+            {"entity_group": "LOC", "start": base + 24, "end": base + 34, "score": 0.95},
+            {"entity_group": "LOC", "start": base + 36, "end": base + 42, "score": 0.97},
+            {"entity_group": "MISC", "start": base + 5, "end": base + 11, "score": 0.41}
+        ]
+    return out
+
+
+def big_config(num_pii: int, num_lang: int) -> Dict:
+    """
+    Build a plugin config with a large PII list: `num_pii` entities (as
+    subtypes), each one for `num_lang` languages
+    """
+    config = load_plugin_config()
+    langs = [f"l{n:02}" for n in range(num_lang)]
+    config["task_config"]["models"] = [{"lang_code": lang, "model": "fake/ner"}
+                                       for lang in langs]
+    config["pii_list"] = [{"type": "PERSON", "subtype": f"S{n}", "lang": langs,
+                           "method": "model", "extra": {"map": f"L{n}"}}
+                          for n in range(num_pii)]
+    return config
+
+
+# -------------------------------------------------------------------------
+
+
+def timeit(func: Callable) -> float:
+    """
+    Time a function: find a number of calls that takes at least MIN_TIME,
+    and return the best time per call over REPEAT repetitions (with garbage
+    collection disabled, as `timeit` does)
+    """
+    gc.collect()
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return _timeit(func)
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def _timeit(func: Callable) -> float:
+    number = 1
+    while True:
+        start = perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = perf_counter() - start
+        if elapsed >= MIN_TIME:
+            break
+        number *= 2 if elapsed*10 > MIN_TIME else 10
+    best = elapsed
+    for _ in range(REPEAT - 1):
+        start = perf_counter()
+        for _ in range(number):
+            func()
+        best = min(best, perf_counter() - start)
+    return best/number
+
+
+def calibration():
+    """
+    A pure-Python reference workload
+    """
+    d = {}
+    for n in range(2000):
+        d[str(n)] = sorted([n % 7, n % 5, n % 3])
+    return "".join(d)
+
+
+def bench_find(mp, sentences: int) -> Callable:
+    patch_transformer_pipeline(mp, synthetic_results(sentences),
+                               ["LOC", "PER", "MISC"])
+    task = create_task_object(load_plugin_config(), "en")
+    chunk = DocumentChunk("1", synthetic_chunk(sentences))
+    return lambda: list(task.find(chunk))
+
+
+def bench_find_batch(mp, chunks: int, sentences: int) -> Callable:
+    patch_transformer_pipeline(mp, synthetic_results(sentences),
+                               ["LOC", "PER", "MISC"])
+    task = create_task_object(load_plugin_config(), "en")
+    text = synthetic_chunk(sentences)
+    data = [DocumentChunk(str(n), text, {"lang": "en"}) for n in range(chunks)]
+    return lambda: list(task.find_batch(data, 32))
+
+
+def bench_task_init(mp, num_pii: int, num_lang: int) -> Callable:
+    labels = [f"L{n}" for n in range(num_pii)]
+    patch_transformer_pipeline(mp, [], labels)
+    config = big_config(num_pii, num_lang)
+    return lambda: create_task_object(config, None)
+
+
+def bench_pii_list(mp, num_pii: int, num_lang: int) -> Callable:
+    config = big_config(num_pii, num_lang)
+    langs = {m["lang_code"] for m in config["task_config"]["models"]}
+    return lambda: _pii_list(config, langs)
+
+
+def bench_gather(mp, num_pii: int, num_lang: int) -> Callable:
+    config = big_config(num_pii, num_lang)
+    collector = TaskCollector(config, debug=False)
+    return lambda: list(collector.gather_tasks())
+
+
+BENCHMARKS = {
+    "find.small": (bench_find, 2),
+    "find.large": (bench_find, 50),
+    "find_batch": (bench_find_batch, 256, 5),
+    "task_init.large": (bench_task_init, 500, 20),
+    "pii_list.large": (bench_pii_list, 500, 20),
+    "gather_tasks.large": (bench_gather, 500, 20),
+}
+
+
+def run(names: List[str] = None) -> Dict:
+    """
+    Run the benchmarks
+    """
+    results = {}
+    calib = None
+    for name, (func, *args) in BENCHMARKS.items():
+        if names and not any(name.startswith(n) for n in names):
+            continue
+        # Calibrate next to each benchmark, to follow changes in machine load
+        calib = timeit(calibration)
+        with pytest.MonkeyPatch.context() as mp:
+            patch_env(mp)
+            elapsed = timeit(func(mp, *args))
+        results[name] = {"time": elapsed, "relative": elapsed/calib}
+        print(f"  {name:20} {elapsed*1e6:12.1f} us  {elapsed/calib:10.3f}",
+              file=sys.stderr)
+    return {"version": VERSION, "python": platform.python_version(),
+            "date": datetime.now().isoformat(timespec="seconds"),
+            "calibration": calib, "results": results}
+
+
+def compare(results: Dict, baseline: Dict, tolerance: float) -> bool:
+    """
+    Compare benchmark results against a baseline, using the normalized times
+      :return: True if no benchmark is slower than the baseline by more
+        than the tolerance
+    """
+    ok = True
+    print(f"  {'benchmark':20} {'baseline':>10} {'current':>10} {'ratio':>7}")
+    for name, r in results["results"].items():
+        base = baseline["results"].get(name)
+        if base is None:
+            print(f"  {name:20} {'-':>10} {r['relative']:10.3f}")
+            continue
+        ratio = r["relative"]/base["relative"]
+        flag = ""
+        if ratio > 1 + tolerance:
+            flag, ok = "  REGRESSION", False
+        print(f"  {name:20} {base['relative']:10.3f} {r['relative']:10.3f} {ratio:7.2f}{flag}")
+    return ok
+
+
+def parse_args(args: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Micro-benchmarks for the plugin overhead around inference")
+    subp = parser.add_subparsers(dest="cmd", required=True)
+
+    s1 = subp.add_parser("run", help="run the benchmarks")
+    s1.add_argument("names", nargs="*", help="run only benchmarks with these prefixes")
+    s1.add_argument("--out", help="write the results to this file")
+    s1.add_argument("--compare", action="store_true",
+                    help="compare the results against the baseline")
+
+    s2 = subp.add_parser("compare", help="compare saved results against the baseline")
+    s2.add_argument("results", help="the results file")
+
+    for s in (s1, s2):
+        s.add_argument("--baseline", default=BASELINE,
+                       help="baseline file (default: %(default)s)")
+        s.add_argument("--tolerance", type=float, default=0.25,
+                       help="allowed slowdown ratio (default: %(default)s)")
+    return parser.parse_args(args)
+
+
+def main(args: List[str] = None):
+    args = parse_args(args)
+    if args.cmd == "run":
+        results = run(args.names)
+        if args.out:
+            with open(args.out, "w", encoding="utf-8") as f:
+                json.dump(results, f, indent=2)
+        if not args.compare:
+            return
+    else:
+        with open(args.results, encoding="utf-8") as f:
+            results = json.load(f)
+    with open(args.baseline, encoding="utf-8") as f:
+        baseline = json.load(f)
+    if not compare(results, baseline, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
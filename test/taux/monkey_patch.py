@@ -6,10 +6,12 @@ from os import environ
 
 from unittest.mock import Mock
 
-from typing import List, Dict
+from typing import List, Dict, Iterable, Tuple
 
 from pii_extract.gather.collection.sources.defs import PII_EXTRACT_PLUGIN_ID
-from pii_extract_plg_transformers.plugin_loader import PiiExtractPluginLoader
+from pii_extract_plg_transformers.plugin_loader import PiiExtractPluginLoader, \
+    load_plugin_config
+from pii_extract_plg_transformers.app.detect import create_task_object
 from pii_extract_plg_transformers.task.utils import ENV_HF_CACHE
 
 import pii_extract.gather.collection.sources.plugin as mod1
@@ -61,14 +63,16 @@ def patch_transformer_pipeline(monkeypatch, results: Dict,
     mock_class = Mock()
     monkeypatch.setattr(mod_pl, 'AutoModelForTokenClassification', mock_class)
 
-    # Patch pipeline
-    pipeline = Mock(return_value=results)
+    # Patch pipeline (a list input produces a list of results)
+    def call(data, **kwargs):
+        return [results]*len(data) if isinstance(data, list) else results
+    pipeline = Mock(side_effect=call)
     pipeline.model.config.label2id = model_labels or []
     pipeline_creator = Mock(return_value=pipeline)
     monkeypatch.setattr(mod_pl, 'pipeline', pipeline_creator)
 
     # Reset cache
-    monkeypatch.setattr(mod_pl, 'ENGINE_CACHE', {})
+    monkeypatch.setattr(mod_pl, 'ENGINE_CACHE', mod_pl.EngineCache())
 
     return pipeline_creator
 
@@ -80,3 +84,30 @@ def patch_env(monkeypatch):
     m = environ.get(ENV_HF_CACHE)
     if m:
         monkeypatch.delenv(ENV_HF_CACHE)
+
+
+# ---------------------------------------------------------------------
+
+
+def patch_task(monkeypatch, results: List[Dict], lang: Iterable[str] = "en",
+               task_config: Dict = None, model_config: Dict = None,
+               pipeline: Mock = None) -> Tuple:
+    """
+    Build a Transformers task over a patched pipeline, using the default
+    plugin configuration
+      :param results: the pipeline results for each text
+      :param lang: the language(s) to create the task for
+      :param task_config: values to set in the task config
+      :param model_config: values to set in the first model entry
+      :param pipeline: the pipeline object to return (instead of the
+        default mock)
+      :return: a tuple (task, plugin config, pipeline creator mock)
+    """
+    mck = patch_transformer_pipeline(monkeypatch, results, ["LOC", "PER"])
+    if pipeline is not None:
+        mck.return_value = pipeline
+    patch_env(monkeypatch)
+    config = load_plugin_config()
+    config["task_config"].update(task_config or {})
+    config["task_config"]["models"][0].update(model_config or {})
+    return create_task_object(config, lang), config, mck
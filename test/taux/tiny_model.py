@@ -0,0 +1,59 @@
+"""
+Build a tiny token classification model (random weights, small vocabulary)
+in a local folder, so that tests can run real inference without downloads.
+Needs the PyTorch & Transformers packages
+"""
+
+from pathlib import Path
+
+from typing import List
+
+
+# Labels for the tiny model
+LABELS = ["O", "B-PER", "I-PER", "B-LOC", "I-LOC"]
+
+# Words in the tiny vocabulary (other words are split into characters)
+WORDS = ["alan", "turing", "was", "born", "in", "london", "england", "the",
+         "father", "of", "ai", "paris", "maida", "vale", "a", "short", "text",
+         "and", "considered", "##s", "##ing"]
+
+
+def _vocab() -> List[str]:
+    special = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"]
+    chars = [chr(c) for c in range(ord("a"), ord("z") + 1)]
+    chars += list(".,;:!?'-0123456789")
+    return special + WORDS + chars + [f"##{c}" for c in chars]
+
+
+def build_tiny_model(path: Path, arch: str = "bert", seed: int = 42) -> str:
+    """
+    Create a tiny model and its tokenizer in a folder
+      :param path: the destination folder
+      :param arch: model architecture: "bert" or "roberta" (for the latter,
+        position ids are offset by the padding index)
+      :param seed: random seed for the model weights
+      :return: the folder name
+    """
+    import torch
+    from transformers import BertTokenizerFast, BertConfig, RobertaConfig, \
+        AutoModelForTokenClassification
+
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    vocab = path / "vocab.txt"
+    vocab.write_text("\n".join(_vocab()) + "\n", encoding="utf-8")
+    tokenizer = BertTokenizerFast(str(vocab), do_lower_case=True,
+                                  model_max_length=64)
+    tokenizer.save_pretrained(str(path))
+
+    cls = RobertaConfig if arch == "roberta" else BertConfig
+    config = cls(vocab_size=len(_vocab()), hidden_size=32,
+                 num_hidden_layers=2, num_attention_heads=2,
+                 intermediate_size=64, max_position_embeddings=80,
+                 pad_token_id=0, num_labels=len(LABELS),
+                 id2label=dict(enumerate(LABELS)),
+                 label2id={lbl: n for n, lbl in enumerate(LABELS)})
+    torch.manual_seed(seed)
+    model = AutoModelForTokenClassification.from_config(config)
+    model.save_pretrained(str(path))
+    return str(path)
@@ -84,5 +84,38 @@ def test30_engine_cache(monkeypatch):
     tasks = piic.build_tasks("es")
     tasks = list(tasks)
 
-    # Check this time there *was* a second pipeline call
+    # Same model & settings: the EN pipeline is shared
+    assert mck.call_count == 1
+
+
+def test31_engine_cache_settings(monkeypatch):
+    """
+    Check engine object reuse with different pipeline settings
+    """
+    import pii_extract_plg_transformers.task.pipeline as mod_pl
+
+    patch_env(monkeypatch)
+    mck = patch_transformer_pipeline(monkeypatch, {}, model_labels=["PER", "LOC"])
+
+    model = "Babelscape/wikineural-multilingual-ner"
+    config = {"models": [{"lang_code": "en", "model": model},
+                         {"lang_code": "es", "model": model,
+                          "aggregation": "first"},
+                         {"lang_code": "fr", "model": model}]}
+    pp = mod_pl.create_pipelines(config)
+
+    # A different aggregation builds a new pipeline, over the same model
     assert mck.call_count == 2
+    assert mod_pl.AutoModelForTokenClassification.from_pretrained.call_count == 1
+    assert pp["en"] is pp["fr"]
+    assert mod_pl.ENGINE_CACHE.get_stats()["pipelines"] == 2
+    assert mod_pl.ENGINE_CACHE.get_stats()["models"] == 1
+
+    # A new build reuses everything
+    mod_pl.create_pipelines(config)
+    assert mck.call_count == 2
+
+    # A different device builds a new pipeline
+    mod_pl.create_pipelines({**config, "device": "cpu"}, languages=["en"])
+    assert mck.call_count == 3
+    assert mck.call_args.kwargs["device"] == "cpu"
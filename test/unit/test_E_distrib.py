@@ -0,0 +1,96 @@
+"""
+Test task serialization and detection over partitions of chunks
+"""
+
+import pickle
+
+from pii_data.types.doc import DocumentChunk
+
+from pii_extract_plg_transformers.plugin_loader import load_plugin_config
+from pii_extract_plg_transformers.app.detect import create_task_object
+from pii_extract_plg_transformers.task.distrib import PartitionDetector
+
+from taux.monkey_patch import patch_task, patch_transformer_pipeline, patch_env
+
+
+TEXT = "Alan Turing. considered the father of AI, was born in England"
+
+RESULTS = [{"start": 54, "end": 61, "entity_group": "LOC", "score": 0.85},
+           {"start": 0, "end": 11, "entity_group": "PER", "score": 0.85}]
+
+
+# ---------------------------------------------------------------------------
+
+
+def test10_pickle(monkeypatch):
+    """
+    Check the task is serialized without pipelines
+    """
+    task, _, _ = patch_task(monkeypatch, RESULTS)
+    assert list(task.models) == ["en"]
+
+    task2 = pickle.loads(pickle.dumps(task))
+    assert str(task2) == str(task)
+    assert task2.models == {}
+    assert task2.lang == "en"
+
+
+def test20_lazy_load(monkeypatch):
+    """
+    Check pipelines are re-created on first use
+    """
+    task, _, _ = patch_task(monkeypatch, RESULTS)
+    task2 = pickle.loads(pickle.dumps(task))
+
+    chunk = DocumentChunk("1", TEXT, {"lang": "en"})
+    got = [p.asdict()["value"] for p in task2.find(chunk)]
+    assert got == ["Alan Turing", "England"]
+    assert list(task2.models) == ["en"]
+
+
+def test30_find_batch(monkeypatch):
+    """
+    Check batched detection
+    """
+    task, _, _ = patch_task(monkeypatch, RESULTS, ["en", "es"])
+    chunks = [DocumentChunk(str(n), TEXT, {"lang": lang})
+              for n, lang in enumerate(["en", "es", "en"], start=1)]
+
+    got = [(p.fields["chunkid"], p.info.lang, p.pos)
+           for p in task.find_batch(chunks, batch_size=2)]
+    exp = [("1", "en", 0), ("1", "en", 54), ("2", "es", 0), ("2", "es", 54),
+           ("3", "en", 0), ("3", "en", 54)]
+    assert got == exp
+
+
+def test35_context(monkeypatch):
+    """
+    Check batched detection applies the entity context as single-chunk
+    detection does
+    """
+    patch_transformer_pipeline(monkeypatch, RESULTS, ["LOC", "PER"])
+    patch_env(monkeypatch)
+    config = load_plugin_config()
+    config["pii_list"][1]["context"] = ["born"]
+    task = create_task_object(config, "en")
+    texts = [TEXT, TEXT.replace("born", "seen")]
+    chunks = [DocumentChunk(str(n), t, {"lang": "en"})
+              for n, t in enumerate(texts)]
+
+    exp = [(p.fields["chunkid"], p.pos) for c in chunks for p in task(c)]
+    assert exp == [("0", 0), ("0", 54), ("1", 0)]
+    got = [(p.fields["chunkid"], p.pos) for p in task.find_batch(chunks)]
+    assert got == exp
+
+
+def test40_partition(monkeypatch):
+    """
+    Check the partition detector
+    """
+    task, _, _ = patch_task(monkeypatch, RESULTS)
+    det = pickle.loads(pickle.dumps(PartitionDetector(task)))
+
+    chunks = [DocumentChunk(str(n), TEXT) for n in range(3)]
+    got = det(chunks)
+    assert len(got) == 6
+    assert [p.fields["chunkid"] for p in got] == ["0", "0", "1", "1", "2", "2"]
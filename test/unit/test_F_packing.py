@@ -0,0 +1,119 @@
+"""
+Test packing of short chunks into model sequences
+"""
+
+import pytest
+
+from pii_data.types.doc import DocumentChunk
+
+from pii_extract_plg_transformers.plugin_loader import load_plugin_config
+from pii_extract_plg_transformers.app.detect import create_task_object
+from pii_extract_plg_transformers.task.packing import ChunkPacker
+
+from taux.monkey_patch import patch_env
+from taux.tiny_model import build_tiny_model
+
+
+class FakeTokenizer:
+    model_max_length = 12
+
+
+TEXTS = ["Alan Turing was born in London", "Paris",
+         "considered the father of AI", "a short text",
+         "Alan Turing and Maida Vale, London, England, Paris and the father"]
+
+
+def _entities(task, chunks):
+    out = [p.asdict() for p in task.find_batch(chunks, batch_size=4)]
+    for p in out:
+        p["process"]["score"] = round(float(p["process"]["score"]), 4)
+    return out
+
+
+def _norm(results):
+    return [(r["entity_group"], r["start"], r["end"], round(float(r["score"]), 4))
+            for r in results]
+
+
+def test10_pack():
+    """
+    Check grouping texts into packed sequences
+    """
+    packer = ChunkPacker(FakeTokenizer(), max_item=5)
+    assert packer.max_length == 12
+    assert packer.pack([3, 4, 8, 5, 2, 1]) == [[2], [0, 1, 3], [4, 5]]
+    assert packer.pack([]) == []
+    assert ChunkPacker(FakeTokenizer(), 6, 3).pack([3, 3, 1]) == \
+        [[0, 1], [2]]
+
+
+def test15_supported(tmp_path):
+    """
+    Check which models can process packed sequences
+    """
+    pytest.importorskip("torch")
+    transformers = pytest.importorskip("transformers")
+    from pii_extract_plg_transformers.task import infer
+    from pii_extract_plg_transformers.model.compile import CompiledForward
+
+    path = build_tiny_model(tmp_path / "model")
+    pp = transformers.pipeline("ner", model=path, tokenizer=path)
+    assert infer.supports_packing(pp)
+
+    # A compiled model still can (packed inputs run in eager mode)
+    pp.model.forward = CompiledForward(pp.model.forward, ("input_ids",), 0)
+    assert infer.supports_packing(pp)
+
+    pp.model = object()
+    assert not infer.supports_packing(pp)
+
+
+@pytest.mark.parametrize("arch", ["bert", "roberta"])
+def test20_independent(tmp_path, arch):
+    """
+    Check the results for a text are the same whether it is packed or not
+    """
+    pytest.importorskip("torch")
+    transformers = pytest.importorskip("transformers")
+    from pii_extract_plg_transformers.task import infer
+
+    path = build_tiny_model(tmp_path / "model", arch)
+    pp = transformers.pipeline("ner", model=path, tokenizer=path,
+                               aggregation_strategy="max")
+    exp = [_norm(r) for r in pp(TEXTS)]
+    assert any(exp)
+
+    enc = infer.encode(pp, TEXTS)
+    packs = ChunkPacker(pp.tokenizer, 24, 12).pack(
+        infer.token_lengths(enc))
+    assert packs == [[4], [0, 1, 2, 3]]
+    penc = infer.pack_encoding(pp, enc, packs)
+    got = dict(infer.decode_packed(pp, TEXTS, penc, infer.forward(pp, penc)))
+    assert [_norm(got[n]) for n in range(len(TEXTS))] == exp
+
+
+def test30_task(tmp_path, monkeypatch):
+    """
+    Check batched detection with packing gives the same entities as without
+    """
+    pytest.importorskip("torch")
+    pytest.importorskip("transformers")
+    patch_env(monkeypatch)
+    config = load_plugin_config()
+    config["task_config"]["models"][0]["model"] = \
+        build_tiny_model(tmp_path / "model")
+    config["task_config"]["reuse_engine"] = False
+    chunks = [DocumentChunk(str(n), t, {"lang": "en"})
+              for n, t in enumerate(TEXTS*3)]
+
+    task = create_task_object(config, "en")
+    exp = _entities(task, chunks)
+    assert exp
+
+    config["task_config"]["packing"] = {"max_length": 24, "max_item": 12}
+    task = create_task_object(config, "en")
+    assert _entities(task, chunks) == exp
+
+    config["task_config"]["pipelined"] = True
+    task = create_task_object(config, "en")
+    assert _entities(task, chunks) == exp
@@ -0,0 +1,145 @@
+"""
+Test the pipelined execution engine
+"""
+
+from threading import Thread
+from time import sleep
+
+import pytest
+
+from pii_data.helper.exception import ProcException
+from pii_data.types.doc import DocumentChunk
+
+from pii_extract_plg_transformers.plugin_loader import load_plugin_config
+from pii_extract_plg_transformers.app.detect import create_task_object
+from pii_extract_plg_transformers.task.engine import staged
+import pii_extract_plg_transformers.task.infer as mod_infer
+
+from taux.monkey_patch import patch_task, patch_env
+from taux.tiny_model import build_tiny_model
+
+
+TEXT = "Alan Turing. considered the father of AI, was born in England"
+
+RESULTS = [{"start": 54, "end": 61, "entity_group": "LOC", "score": 0.85},
+           {"start": 0, "end": 11, "entity_group": "PER", "score": 0.85}]
+
+
+def _task(monkeypatch, pipelined: bool):
+    return patch_task(monkeypatch, RESULTS, ["en", "es"],
+                      {"pipelined": pipelined})[0]
+
+
+def _patch_infer(monkeypatch):
+    """
+    Replace the inference steps with fakes
+    """
+    monkeypatch.setattr(mod_infer, "encode", lambda pp, texts: texts)
+    monkeypatch.setattr(mod_infer, "forward", lambda pp, enc: len(enc))
+    monkeypatch.setattr(mod_infer, "decode",
+                        lambda pp, texts, enc, lg, **kw: [RESULTS]*lg)
+
+
+# ---------------------------------------------------------------------------
+
+
+def test10_staged():
+    """
+    Check the staged processing
+    """
+    got = staged(range(20), lambda x: x*2, lambda x: x+1, queue_size=1)
+    assert list(got) == [2*x+1 for x in range(20)]
+
+
+def test11_staged_error():
+    """
+    Check exception propagation
+    """
+    def fail(x):
+        if x == 3:
+            raise ValueError("bad item")
+        return x
+
+    got = []
+    with pytest.raises(ValueError):
+        for x in staged(range(10), fail, lambda x: x):
+            got.append(x)
+    assert got == [0, 1, 2]
+
+
+def test20_pipelined(monkeypatch):
+    """
+    Check the pipelined task path produces the same output as the serial one
+    """
+    chunks = [DocumentChunk(str(n), TEXT, {"lang": lang})
+              for n, lang in enumerate(["en", "es", "en", "en", "es"])]
+
+    task = _task(monkeypatch, False)
+    exp = [p.asdict() for p in task.find_batch(chunks, batch_size=2)]
+
+    _patch_infer(monkeypatch)
+    task = _task(monkeypatch, True)
+    got = [p.asdict() for p in task.find_batch(chunks, batch_size=2)]
+
+    assert len(got) == 10
+    assert got == exp
+
+
+def test30_pipelined_error(monkeypatch):
+    """
+    Check errors in the pipelined path
+    """
+    _patch_infer(monkeypatch)
+    task = _task(monkeypatch, True)
+    chunks = [DocumentChunk("1", TEXT, {"lang": "it"})]
+    with pytest.raises(ProcException):
+        list(task.find_batch(chunks))
+
+
+def test40_pipelined_model(monkeypatch, tmp_path):
+    """
+    Check the pipelined path gives the same results as the serial find(),
+    running a real (tiny) model through the separate inference steps
+    """
+    pytest.importorskip("torch")
+    pytest.importorskip("transformers")
+    patch_env(monkeypatch)
+    config = load_plugin_config()
+    path = build_tiny_model(tmp_path / "model")
+    for m in config["task_config"]["models"]:
+        m["model"] = path
+    texts = [TEXT, "Alan Turing was born in Maida Vale, London", "Paris"]
+    chunks = [DocumentChunk(str(n), texts[n % 3], {"lang": lang})
+              for n, lang in enumerate(["en", "es", "en", "en", "es"])]
+
+    task = create_task_object(config, ["en", "es"])
+    exp = [p.asdict() for c in chunks for p in task.find(c)]
+    assert exp
+
+    config["task_config"]["pipelined"] = True
+    task = create_task_object(config, ["en", "es"])
+    for bs in (1, 2, 4):
+        got = [p.asdict() for p in task.find_batch(chunks, batch_size=bs)]
+        for p in exp + got:
+            p["process"]["score"] = round(float(p["process"]["score"]), 4)
+        assert got == exp
+
+
+def test50_pipelined_reload(monkeypatch):
+    """
+    Check a reload does not wait for batches queued between stages while
+    the consumer is paused
+    """
+    _patch_infer(monkeypatch)
+    task = _task(monkeypatch, True)
+    chunks = [DocumentChunk(str(n), TEXT, {"lang": "en"}) for n in range(40)]
+    it = task.find_batch(chunks, batch_size=2)
+    next(it)
+    sleep(0.1)      # let the stages fill their queues
+
+    done = []
+    t = Thread(target=lambda: done.append(task.reload(wait=True)), daemon=True)
+    t.start()
+    t.join(5)
+    assert done == [True]
+    assert len(list(it)) == 79
@@ -0,0 +1,86 @@
+"""
+Test cascade detection
+"""
+
+from pii_data.types.doc import DocumentChunk
+
+from pii_extract_plg_transformers.task.cascade import Cascade
+
+from taux.monkey_patch import patch_task
+
+
+RESULTS = [{"start": 54, "end": 61, "entity_group": "LOC", "score": 0.85},
+           {"start": 0, "end": 11, "entity_group": "PER", "score": 0.85}]
+
+TEXTS = ["Alan Turing. considered the father of AI, was born in England",
+         "nothing to see here, all is fine, move on, keep walking, thank you",
+         "Alan Turing. considered the father of AI, was born in England",
+         "just some more text, without any kind of personal information"]
+
+
+def fake_pipeline(texts, **kwargs):
+    """
+    A first stage that detects a candidate in texts with uppercase letters
+    """
+    return [[{"entity_group": "PER", "score": 0.4}] if t[0].isupper()
+            else [{"entity_group": "PER", "score": 0.1}] for t in texts]
+
+
+def _task(monkeypatch, sample: float = 0):
+    cascade = {"model": "small", "sample": sample}
+    task, _, _ = patch_task(monkeypatch, RESULTS,
+                            model_config={"cascade": cascade})
+    task._cascades["en"] = Cascade(fake_pipeline, ["PER", "LOC"],
+                                   sample=sample)
+    return task
+
+
+# ---------------------------------------------------------------------------
+
+
+def test10_select():
+    """
+    Check the cascade selection
+    """
+    c = Cascade(fake_pipeline, ["PER"], sample=0.5)
+    keep, sample = c.select(TEXTS)
+    assert keep == [True, False, True, False]
+    assert sample == [True, False, True, False]
+
+    c.record(keep, sample, [2, 1, 2, 0])
+    assert c.get_stats() == {"chunks": 4, "candidates": 2, "sampled": 2,
+                             "sample_entities": 4, "skip_rate": 0.5,
+                             "recall": 1.0}
+
+
+def test20_task(monkeypatch):
+    """
+    Check task detection through the cascade
+    """
+    task = _task(monkeypatch)
+    chunks = [DocumentChunk(str(n), t) for n, t in enumerate(TEXTS)]
+    got = [p.fields["chunkid"] for p in task.find_batch(chunks)]
+    assert got == ["0", "0", "2", "2"]
+
+    got = list(task.find(chunks[1]))
+    assert got == []
+
+    stats = task.get_stats()["cascade.en"]
+    assert stats["chunks"] == 5
+    assert stats["candidates"] == 2
+
+
+def test30_task_sample(monkeypatch):
+    """
+    Check recall measurement
+    """
+    task = _task(monkeypatch, sample=1)
+    chunks = [DocumentChunk(str(n), t) for n, t in enumerate(TEXTS)]
+    got = [p.fields["chunkid"] for p in task.find_batch(chunks)]
+    assert got == ["0", "0", "2", "2"]
+
+    # The (mock) main model finds 2 entities in every chunk
+    stats = task.get_stats()["cascade.en"]
+    assert stats["sampled"] == 4
+    assert stats["sample_entities"] == 8
+    assert stats["recall"] == 0.5
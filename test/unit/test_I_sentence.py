@@ -0,0 +1,91 @@
+"""
+Test sentence segmentation and the sentence cache
+"""
+
+from pii_data.types.doc import DocumentChunk
+
+from pii_extract_plg_transformers.task.sentence import split_sentences, SentenceCache
+
+from taux.monkey_patch import patch_task
+
+
+TEXTS = [
+    "Alan Turing was born in England. He was a mathematician.\nBest regards.",
+    "He was a mathematician. He lived in England.\nBest regards."
+]
+
+NAMES = {"Alan Turing": "PER", "England": "LOC"}
+
+
+def fake_pipeline(data, **kwargs):
+    """
+    Locate the names in the texts
+    """
+    def find(text):
+        return [{"entity_group": g, "score": 0.9, "start": text.index(n),
+                 "end": text.index(n) + len(n)}
+                for n, g in NAMES.items() if n in text]
+    return [find(t) for t in data] if isinstance(data, list) else find(data)
+
+
+# ---------------------------------------------------------------------------
+
+
+def test10_split():
+    """
+    Check sentence splitting
+    """
+    got = split_sentences(TEXTS[0])
+    exp = [(0, "Alan Turing was born in England."),
+           (33, "He was a mathematician."), (57, "Best regards.")]
+    assert got == exp
+
+
+def test11_split_titles():
+    """
+    Check sentences are not split after initials or personal titles
+    """
+    assert split_sentences("I met Dr. Smith yesterday.") == \
+        [(0, "I met Dr. Smith yesterday.")]
+    got = split_sentences("Mrs. Jones and Mr. A. Turing came. Ms. Lee did not.")
+    assert got == [(0, "Mrs. Jones and Mr. A. Turing came."),
+                   (35, "Ms. Lee did not.")]
+    assert split_sentences("La Sra. García vive en Madrid. Mme. Dupont non.") \
+        == [(0, "La Sra. García vive en Madrid."), (31, "Mme. Dupont non.")]
+
+
+def test20_cache():
+    """
+    Check sentence deduplication and caching
+    """
+    cache = SentenceCache()
+    pending, state = cache.prepare("en", TEXTS)
+    assert pending == ["Alan Turing was born in England.",
+                       "He was a mathematician.", "Best regards.",
+                       "He lived in England."]
+    got = cache.complete("en", state, fake_pipeline(pending))
+    assert got == fake_pipeline(TEXTS)
+
+    # A second round only needs one new sentence
+    pending, state = cache.prepare("en", TEXTS + ["A new one."])
+    assert pending == ["A new one."]
+    got = cache.complete("en", state, [[]])
+    assert got == fake_pipeline(TEXTS) + [[]]
+
+    assert cache.get_stats() == {"sentences": 13, "hits": 4, "detected": 5,
+                                 "cached": 5}
+
+
+def test30_task(monkeypatch):
+    """
+    Check detection in sentence mode
+    """
+    task, _, mck = patch_task(monkeypatch, [], task_config={"sentences": True})
+    mck.return_value.side_effect = fake_pipeline
+
+    chunks = [DocumentChunk(str(n), t) for n, t in enumerate(TEXTS)]
+    got = [(p.fields["chunkid"], p.fields["value"], p.pos)
+           for p in task.find_batch(chunks)]
+    assert got == [("0", "Alan Turing", 0), ("0", "England", 24),
+                   ("1", "England", 36)]
+    assert task.get_stats()["sentences"]["detected"] == 4
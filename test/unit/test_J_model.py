@@ -0,0 +1,96 @@
+"""
+Test the model tools utilities
+"""
+
+import pytest
+
+from pii_data.helper.exception import ConfigException
+
+from pii_extract_plg_transformers.plugin_loader import load_plugin_config
+from pii_extract_plg_transformers.app.detect import create_task_object
+from pii_extract_plg_transformers.model.utils import read_corpus, agreement
+from pii_extract_plg_transformers.model.trim import _remap_processor
+from pii_extract_plg_transformers.app.model import parse_args
+
+from taux.monkey_patch import patch_transformer_pipeline, patch_env
+
+
+REF = [[{"entity_group": "PER", "start": 0, "end": 11, "score": 0.9},
+        {"entity_group": "LOC", "start": 24, "end": 31, "score": 0.9}],
+       [],
+       [{"entity_group": "LOC", "start": 5, "end": 10, "score": 0.9}]]
+
+GOT = [[{"entity_group": "PER", "start": 0, "end": 11, "score": 0.8}],
+       [],
+       [{"entity_group": "LOC", "start": 5, "end": 10, "score": 0.7},
+        {"entity_group": "PER", "start": 12, "end": 15, "score": 0.5}]]
+
+
+def test10_agreement():
+    """
+    Check result comparison
+    """
+    got = agreement(REF, GOT)
+    assert got == pytest.approx({"texts": 3, "equal": 1/3, "entities_ref": 3,
+                                 "entities": 3, "precision": 2/3,
+                                 "recall": 2/3, "f1": 2/3})
+
+    got = agreement(REF, GOT, labels=["LOC"])
+    assert got["equal"] == 2/3
+    assert got["recall"] == 0.5
+    assert got["precision"] == 1
+
+
+def test20_corpus(tmp_path):
+    """
+    Check corpus reading
+    """
+    name = tmp_path / "corpus.txt"
+    with open(name, "w", encoding="utf-8") as f:
+        f.write("one text\n\n  another text \nthird\n")
+    assert read_corpus([name]) == ["one text", "another text", "third"]
+    assert read_corpus([name, name], 4) == ["one text", "another text",
+                                            "third", "one text"]
+
+
+def test30_remap():
+    """
+    Check remapping of tokenizer postprocessor ids
+    """
+    proc = {"type": "TemplateProcessing",
+            "special_tokens": {"[CLS]": {"id": "[CLS]", "ids": [101]},
+                               "[SEP]": {"id": "[SEP]", "ids": [102]}}}
+    _remap_processor(proc, {101: 3, 102: 4})
+    assert proc["special_tokens"]["[CLS]"]["ids"] == [3]
+    assert proc["special_tokens"]["[SEP]"]["ids"] == [4]
+
+    proc = {"type": "BertProcessing", "sep": ["[SEP]", 102],
+            "cls": ["[CLS]", 101]}
+    _remap_processor(proc, {101: 3, 102: 4})
+    assert proc == {"type": "BertProcessing", "sep": ["[SEP]", 4],
+                    "cls": ["[CLS]", 3]}
+
+
+def test40_trimmed_missing(monkeypatch, tmp_path):
+    """
+    Check error when a trimmed model is not available
+    """
+    patch_transformer_pipeline(monkeypatch, [], ["LOC", "PER"])
+    patch_env(monkeypatch)
+    config = load_plugin_config()
+    config["task_config"]["cachedir"] = str(tmp_path)
+    config["task_config"]["models"][0]["trimmed"] = True
+    with pytest.raises(ConfigException):
+        create_task_object(config, "en")
+
+
+def test50_min_agreement():
+    """
+    Check the default validation thresholds for the model commands
+    """
+    args = parse_args(["trim", "--corpus", "c.txt"])
+    assert args.min_agreement == 1.0
+    args = parse_args(["trim", "--corpus", "c.txt", "--min-agreement", "0.9"])
+    assert args.min_agreement == 0.9
+    assert parse_args(["prune", "--layers", "4"]).min_agreement == 0
+    assert parse_args(["distill", "--corpus", "c.txt"]).min_agreement == 0
@@ -0,0 +1,110 @@
+"""
+Test the model cache preparation utilities
+"""
+
+import hashlib
+
+import pytest
+
+from pii_data.helper.exception import ConfigException, ProcException
+
+from pii_extract_plg_transformers.plugin_loader import load_plugin_config
+from pii_extract_plg_transformers.app.detect import create_task_object
+from pii_extract_plg_transformers.task.utils import ENV_HF_CACHE
+import pii_extract_plg_transformers.model.cache as mod
+import pii_extract_plg_transformers.task.pipeline as mod_pl
+
+from taux.monkey_patch import patch_transformer_pipeline, patch_env
+
+
+MODEL = "Babelscape/wikineural-multilingual-ner"
+
+
+def test10_checksums(tmp_path):
+    """
+    Check writing & verifying a checksum manifest
+    """
+    (tmp_path / "config.json").write_text("{}")
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "sub" / "weights.bin").write_bytes(b"1234")
+    sums = mod.write_checksums(tmp_path)
+    assert sorted(sums) == ["config.json", "sub/weights.bin"]
+    assert mod.verify_checksums(tmp_path) == []
+    assert mod.dir_size(tmp_path) == 6
+
+    (tmp_path / "sub" / "weights.bin").write_bytes(b"1235")
+    assert mod.verify_checksums(tmp_path) == ["sub/weights.bin"]
+
+
+def test20_snapshot(tmp_path):
+    """
+    Check verification of files in a Hub snapshot
+    """
+    blobs = tmp_path / "blobs"
+    snap = tmp_path / "snapshots" / "abc"
+    blobs.mkdir()
+    snap.mkdir(parents=True)
+
+    lfs = b"weights"
+    small = b"{}"
+    h_lfs = hashlib.sha256(lfs).hexdigest()
+    h_small = hashlib.sha1(b"blob 2\0" + small).hexdigest()
+    (blobs / h_lfs).write_bytes(lfs)
+    (blobs / h_small).write_bytes(small)
+    (snap / "model.bin").symlink_to(blobs / h_lfs)
+    (snap / "config.json").symlink_to(blobs / h_small)
+    assert mod.verify_snapshot(snap) == []
+
+    (blobs / h_lfs).write_bytes(b"changed")
+    assert mod.verify_snapshot(snap) == ["model.bin"]
+
+
+def test30_mirror(monkeypatch, tmp_path):
+    """
+    Check fetching a model from a local mirror
+    """
+    monkeypatch.setenv(ENV_HF_CACHE, str(tmp_path / "cache"))
+    src = tmp_path / "mirror" / MODEL
+    src.mkdir(parents=True)
+    (src / "config.json").write_text("{}")
+
+    path, snapshot = mod.fetch(MODEL, tmp_path / "mirror")
+    assert not snapshot
+    assert path == mod.local_path(MODEL)
+    assert (path / "config.json").is_file()
+    assert mod.verify_checksums(path) == []
+
+    with pytest.raises(ProcException):
+        mod.fetch("unknown/model", tmp_path / "mirror")
+
+
+def test40_format_missing(monkeypatch, tmp_path):
+    """
+    Check error when a converted model is not available
+    """
+    patch_transformer_pipeline(monkeypatch, [], ["LOC", "PER"])
+    patch_env(monkeypatch)
+    config = load_plugin_config()
+    config["task_config"]["cachedir"] = str(tmp_path)
+    config["task_config"]["models"][0]["format"] = "quantized"
+    with pytest.raises(ConfigException):
+        create_task_object(config, "en")
+
+
+def test50_format_load(monkeypatch, tmp_path):
+    """
+    Check that a converted model is loaded from the cache
+    """
+    patch_transformer_pipeline(monkeypatch, [], ["LOC", "PER"])
+    patch_env(monkeypatch)
+    monkeypatch.setenv(ENV_HF_CACHE, str(tmp_path))
+    config = load_plugin_config()
+    config["task_config"]["cachedir"] = str(tmp_path)
+    config["task_config"]["models"][0]["format"] = "safetensors"
+    path = mod.converted_path("safetensors", MODEL)
+    path.mkdir(parents=True)
+    (path / "config.json").write_text("{}")
+
+    create_task_object(config, "en")
+    mod_pl.AutoTokenizer.from_pretrained.assert_called_with(str(path))
+    mod_pl.AutoModelForTokenClassification.from_pretrained.assert_called_with(str(path))
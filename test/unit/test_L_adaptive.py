@@ -0,0 +1,101 @@
+"""
+Test adaptive batch sizing
+"""
+
+import pickle
+
+from pii_data.types.doc import DocumentChunk
+
+from pii_extract_plg_transformers.task.adaptive import BatchController, percentile
+import pii_extract_plg_transformers.task.adaptive as mod
+
+from taux.monkey_patch import patch_task
+
+
+RESULTS = [{"start": 0, "end": 11, "entity_group": "PER", "score": 0.85}]
+
+
+def _run(ctrl, monkeypatch, latency: float, num: int):
+    """
+    Record a number of batches with a given latency
+    """
+    monkeypatch.setattr(mod, "perf_counter", lambda: 10 + latency)
+    for _ in range(num):
+        ctrl.record(10, ctrl.batch_size, 100)
+
+
+# ---------------------------------------------------------------------------
+
+
+def test10_percentile():
+    """
+    Check percentile computation
+    """
+    values = list(range(1, 21))
+    assert percentile(values, 0.95) == 19
+    assert percentile(values, 0.5) == 10
+    assert percentile([3], 0.95) == 3
+
+
+def test20_batches():
+    """
+    Check batch splitting with the batch limits
+    """
+    ctrl = BatchController(batch_size=3, token_budget=10)
+    texts = ["x"*8, "x"*8, "x"*8, "x"*8, "x"*30, "x"]
+    got = [len(b) for b in ctrl.batches(texts)]
+    assert got == [3, 1, 2]
+
+
+def test30_adjust(monkeypatch):
+    """
+    Check the controller grows & shrinks the batch size
+    """
+    ctrl = BatchController(target_p95=1, batch_size=8, min_samples=5)
+
+    # Latency headroom: grow
+    _run(ctrl, monkeypatch, 0.2, 5)
+    assert ctrl.batch_size == 10
+    assert ctrl.token_budget == 1280
+
+    # Over the target: shrink
+    _run(ctrl, monkeypatch, 2, 5)
+    assert ctrl.batch_size == 7
+
+    # Close to the target: hold
+    _run(ctrl, monkeypatch, 0.9, 5)
+    assert ctrl.batch_size == 7
+
+    stats = ctrl.get_stats()
+    assert stats["batches"] == 15
+    assert stats["grow"] == 1
+    assert stats["shrink"] == 1
+    assert stats["target_p95"] == 1
+
+    ctrl2 = pickle.loads(pickle.dumps(ctrl))
+    assert ctrl2.limits() == (7, ctrl.token_budget)
+    assert ctrl2.get_stats().get("batches", 0) == 0
+
+
+def test40_task(monkeypatch):
+    """
+    Check batched detection with adaptive batch sizing
+    """
+    adaptive = {"target_p95": 10, "max_batch": 4}
+    task, _, mck = patch_task(monkeypatch, RESULTS,
+                              task_config={"adaptive": adaptive,
+                                           "batch_size": 2})
+
+    chunks = [DocumentChunk(str(n), "Alan Turing was born in England")
+              for n in range(5)]
+    got = [p.fields["chunkid"] for p in task.find_batch(chunks)]
+    assert got == ["0", "1", "2", "3", "4"]
+
+    # Batches of 2 chunks, and a last one of 1
+    sizes = [len(c.args[0]) for c in mck.return_value.call_args_list]
+    assert sizes == [2, 2, 1]
+
+    stats = task.get_stats()["adaptive"]
+    assert stats["batches"] == 3
+    assert stats["chunks"] == 5
+    assert stats["batch_size"] == 2
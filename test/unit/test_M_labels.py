@@ -0,0 +1,76 @@
+"""
+Test decoding restricted to the mapped labels
+"""
+
+from pii_data.types.doc import DocumentChunk
+
+from pii_extract_plg_transformers.plugin_loader import load_plugin_config
+from pii_extract_plg_transformers.app.detect import create_task_object
+from pii_extract_plg_transformers.task.infer import token_runs
+import pii_extract_plg_transformers.task.infer as mod_infer
+
+from taux.monkey_patch import patch_transformer_pipeline, patch_env
+
+
+TEXT = "Alan Turing was born in England"
+
+RESULTS = [{"start": 0, "end": 11, "entity_group": "PER", "score": 0.85}]
+
+#           [CLS]   Alan    Tur     ##ing    was       born      in        England   [SEP]
+OFFSETS = [(0, 0), (0, 4), (5, 8), (8, 11), (12, 15), (16, 20), (21, 23), (24, 31), (0, 0)]
+SPECIAL = [1, 0, 0, 0, 0, 0, 0, 0, 1]
+
+
+def test10_runs():
+    """
+    Check the selection of token runs
+    """
+    sel = [0, 1, 0, 0, 0, 0, 0, 1, 0]
+    assert token_runs(sel, OFFSETS, SPECIAL, False) == [(1, 2), (7, 8)]
+    assert token_runs(sel, OFFSETS, SPECIAL, True) == [(1, 2), (7, 8)]
+
+    sel = [0, 0, 0, 1, 0, 0, 0, 0, 0]
+    assert token_runs(sel, OFFSETS, SPECIAL, False) == [(3, 4)]
+    assert token_runs(sel, OFFSETS, SPECIAL, True) == [(2, 4)]
+
+    sel = [0, 1, 1, 0, 0, 0, 0, 0, 0]
+    assert token_runs(sel, OFFSETS, SPECIAL, True) == [(1, 4)]
+
+    assert token_runs([0]*9, OFFSETS, SPECIAL, True) == []
+
+
+class FakeMask:
+
+    def __init__(self, pp, labels):
+        self.labels = set(labels)
+
+
+def test20_task(monkeypatch):
+    """
+    Check that the task decodes through the label mask
+    """
+    mck = patch_transformer_pipeline(monkeypatch, RESULTS, ["LOC", "PER"])
+    patch_env(monkeypatch)
+    masks = []
+
+    def decode(pp, texts, enc, logits, mask=None):
+        masks.append(mask)
+        return [RESULTS]*len(texts)
+
+    monkeypatch.setattr(mod_infer, "LabelMask", FakeMask)
+    monkeypatch.setattr(mod_infer, "encode", lambda pp, texts: texts)
+    monkeypatch.setattr(mod_infer, "forward", lambda pp, enc: None)
+    monkeypatch.setattr(mod_infer, "decode", decode)
+
+    config = load_plugin_config()
+    config["task_config"]["restrict_labels"] = True
+    task = create_task_object(config, "en")
+
+    chunks = [DocumentChunk(str(n), TEXT) for n in range(3)]
+    got = [p.fields["value"] for p in task.find_batch(chunks, 2)]
+    assert got == ["Alan Turing"]*3
+
+    # Two minibatches, decoded with the mask, and the pipeline not called
+    assert len(masks) == 2
+    assert masks[0].labels == {"PER", "LOC"}
+    assert mck.return_value.call_count == 0
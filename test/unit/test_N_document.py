@@ -0,0 +1,49 @@
+"""
+Test detection over source documents
+"""
+
+from pii_data.types.doc.localdoc import SequenceLocalSrcDocument
+
+from pii_extract_plg_transformers.task.document import document_chunks, \
+    detect_documents
+
+from taux.monkey_patch import patch_task
+
+
+TEXT = "Alan Turing was born in England"
+
+RESULTS = [{"start": 0, "end": 11, "entity_group": "PER", "score": 0.85}]
+
+
+def _doc(docid: str, num: int) -> SequenceLocalSrcDocument:
+    doc = SequenceLocalSrcDocument(chunks=[TEXT]*num,
+                                   metadata={"document": {"main_lang": "en"}})
+    doc.set_id(docid)
+    return doc
+
+
+def test10_chunks():
+    """
+    Check document chunks share their context
+    """
+    chunks = list(document_chunks(_doc("a", 3)))
+    assert [c.id for c in chunks] == ["1", "2", "3"]
+    assert chunks[0].context == {"lang": "en"}
+    assert chunks[0].context is chunks[2].context
+
+
+def test20_detect(monkeypatch):
+    """
+    Check detection over documents, batching across document boundaries
+    """
+    task, _, mck = patch_task(monkeypatch, RESULTS)
+
+    docs = [_doc("a", 3), _doc("b", 0), _doc("c", 2), _doc("d", 0)]
+    got = [(doc.id, len(piic), set(p.fields["docid"] for p in piic))
+           for doc, piic in detect_documents(task, iter(docs), batch_size=2)]
+    assert got == [("a", 3, {"a"}), ("b", 0, set()), ("c", 2, {"c"}),
+                   ("d", 0, set())]
+
+    # 5 chunks in batches of 2
+    sizes = [len(c.args[0]) for c in mck.return_value.call_args_list]
+    assert sizes == [2, 2, 1]
@@ -0,0 +1,123 @@
+"""
+Test model footprint reporting
+"""
+
+import json
+from io import StringIO
+from types import SimpleNamespace
+
+from pii_extract_plg_transformers.model.footprint import pipeline_footprint
+from pii_extract_plg_transformers.app import info
+import pii_extract_plg_transformers.task.pipeline as mod_pl
+
+from taux.monkey_patch import patch_env
+
+
+class FakeTensor:
+
+    def __init__(self, num: int, size: int = 4, dtype: str = "torch.float32"):
+        self.num = num
+        self.size = size
+        self.dtype = dtype
+
+    def numel(self):
+        return self.num
+
+    def element_size(self):
+        return self.size
+
+
+class FakeModule:
+
+    def __init__(self, **tensors):
+        self.tensors = tensors
+
+    def state_dict(self):
+        return self.tensors
+
+
+class FakeModel(FakeModule):
+
+    def __init__(self):
+        emb = FakeModule(word=FakeTensor(1000), pos=FakeTensor(100))
+        enc = FakeModule(layer=FakeTensor(800, 2, "torch.float16"))
+        super().__init__(word=FakeTensor(1000), pos=FakeTensor(100),
+                         layer=FakeTensor(800, 2, "torch.float16"),
+                         head=FakeTensor(50), packed=object())
+        self.base_model = SimpleNamespace(embeddings=emb, encoder=enc)
+        self.config = SimpleNamespace(model_type="bert", _name_or_path="fake",
+                                      max_position_embeddings=512)
+
+    def parameters(self):
+        return [t for t in self.tensors.values() if isinstance(t, FakeTensor)]
+
+
+class FakeTokenizer(list):
+    model_max_length = 512
+
+
+def _pipeline():
+    return SimpleNamespace(model=FakeModel(), tokenizer=FakeTokenizer(range(30)))
+
+
+def test10_footprint():
+    """
+    Check footprint computation
+    """
+    got = pipeline_footprint(_pipeline())
+    assert got["params"] == 1950
+    assert got["bytes"] == 6200
+    assert got["bytes_by_dtype"] == {"float32": 4600, "float16": 1600}
+    assert got["embedding_bytes"] == 4400
+    assert got["encoder_bytes"] == 1600
+    assert got["other_bytes"] == 200
+    assert got["embedding_share"] == 4400/6200
+    assert got["vocab_size"] == 30
+    assert got["max_length"] == 512
+
+
+def test20_info_json(monkeypatch):
+    """
+    Check the JSON output of the info models command, with cache sharing
+    """
+    patch_env(monkeypatch)
+    pp = _pipeline()
+    monkeypatch.setattr(mod_pl, "create_pipelines",
+                        lambda cfg, languages, logger: {languages[0]: pp})
+    cache = mod_pl.EngineCache()
+    cache.add("key", "key|max|None", pp.tokenizer, pp.model, pp)
+    monkeypatch.setattr(mod_pl, "ENGINE_CACHE", cache)
+
+    args = info.parse_args(["models", "--json", "--lang", "en", "es"])
+    out = StringIO()
+    info.Processor(args).proc_models(out)
+    got = json.loads(out.getvalue())
+    assert [r["lang"] for r in got] == ["en", "es"]
+    assert got[0]["shared_with"] == ["es"]
+    assert got[0]["cache_key"] == "key"
+    assert got[1]["params"] == 1950
+    assert got[1]["load_time"] >= 0
+
+
+def test30_info_cachedir(monkeypatch):
+    """
+    Check that the models report uses the cache dir in the task config
+    """
+    patch_env(monkeypatch)
+    pp = _pipeline()
+    monkeypatch.setattr(mod_pl, "create_pipelines",
+                        lambda cfg, languages, logger: {languages[0]: pp})
+    monkeypatch.setattr(mod_pl, "ENGINE_CACHE", mod_pl.EngineCache())
+    load = info.load_plugin_config
+
+    def load_config(filenames):
+        config = load(filenames)
+        config[info.defs.CFG_TASK]["cachedir"] = "/my/cache"
+        return config
+    monkeypatch.setattr(info, "load_plugin_config", load_config)
+    got = []
+    monkeypatch.setattr(info, "hf_cachedir", got.append)
+
+    args = info.parse_args(["models", "--json", "--lang", "en"])
+    info.Processor(args).proc_models(StringIO())
+    assert got == ["/my/cache"]
@@ -0,0 +1,143 @@
+"""
+Test encoder layer pruning
+"""
+
+from types import SimpleNamespace
+
+import pytest
+
+from pii_data.helper.exception import ConfigException
+
+from pii_extract_plg_transformers.plugin_loader import load_plugin_config
+from pii_extract_plg_transformers.app.detect import create_task_object
+from pii_extract_plg_transformers.model.prune import truncate_layers, \
+    token_labels, read_labeled, pruned_path
+from pii_extract_plg_transformers.model.trim import trimmed_path
+import pii_extract_plg_transformers.task.pipeline as mod_pl
+
+from taux.monkey_patch import patch_transformer_pipeline, patch_env
+
+
+def _model(num: int):
+    """
+    Build a fake model with a list of encoder layers
+    """
+    encoder = SimpleNamespace(layer=list(range(num)))
+    return SimpleNamespace(base_model=SimpleNamespace(encoder=encoder),
+                           config=SimpleNamespace(num_hidden_layers=num))
+
+
+def test10_truncate():
+    """
+    Check layer truncation
+    """
+    model = _model(12)
+    assert truncate_layers(model, 4) == (12, 4)
+    assert model.base_model.encoder.layer == [0, 1, 2, 3]
+    assert model.config.num_hidden_layers == 4
+
+    assert truncate_layers(model, 6) == (4, 4)
+    with pytest.raises(ConfigException):
+        truncate_layers(model, 0)
+    with pytest.raises(ConfigException):
+        truncate_layers(SimpleNamespace(), 2)
+
+
+def test20_token_labels():
+    """
+    Check assignment of token labels from entity spans
+    """
+    label2id = {"O": 0, "B-PER": 1, "I-PER": 2, "B-LOC": 3, "I-LOC": 4}
+    offsets = [(0, 0), (0, 4), (5, 11), (12, 15), (16, 20), (20, 27), (0, 0)]
+    entities = [{"start": 0, "end": 11, "label": "PER"},
+                {"start": 16, "end": 27, "label": "LOC"}]
+    got = token_labels(offsets, entities, label2id)
+    assert got == [-100, 1, 2, 0, 3, 4, -100]
+
+
+def test30_labeled(tmp_path):
+    """
+    Check reading a labeled sample
+    """
+    name = tmp_path / "sample.jsonl"
+    with open(name, "w", encoding="utf-8") as f:
+        f.write('{"text": "Alan Turing", "entities": [{"start": 0, "end": 11, "label": "PER"}]}\n\n')
+        f.write('{"text": "no entities"}\n')
+    got = read_labeled([name])
+    assert got == [("Alan Turing", [{"start": 0, "end": 11, "label": "PER"}]),
+                   ("no entities", [])]
+    assert len(read_labeled([name, name], 3)) == 3
+
+
+def test40_pipeline(monkeypatch, tmp_path):
+    """
+    Check the pipeline uses a pruned model, or truncates the full one
+    """
+    mck = patch_transformer_pipeline(monkeypatch, [], ["LOC", "PER"])
+    patch_env(monkeypatch)
+    model = _model(12)
+    mod_pl.AutoModelForTokenClassification.from_pretrained.return_value = model
+
+    config = load_plugin_config()
+    config["task_config"]["cachedir"] = str(tmp_path)
+    entry = config["task_config"]["models"][0]
+    entry["layers"] = 6
+    create_task_object(config, "en")
+    assert model.config.num_hidden_layers == 6
+    assert mck.call_args.kwargs["model"] is model
+
+    # Now with a pre-built pruned model
+    path = pruned_path(entry["model"], 6)
+    path.mkdir(parents=True)
+    (path / "config.json").touch()
+    mod_pl.ENGINE_CACHE.clear()
+    create_task_object(config, "en")
+    mod_pl.AutoModelForTokenClassification.from_pretrained.assert_called_with(str(path))
+
+
+def test41_pipeline_trimmed(monkeypatch, tmp_path):
+    """
+    Check a trimmed model uses only a pruned model built from it
+    """
+    patch_transformer_pipeline(monkeypatch, [], ["LOC", "PER"])
+    patch_env(monkeypatch)
+    monkeypatch.setenv("HUGGINGFACE_HUB_CACHE", str(tmp_path))
+    from_pretrained = mod_pl.AutoModelForTokenClassification.from_pretrained
+    from_pretrained.return_value = _model(12)
+
+    config = load_plugin_config()
+    entry = config["task_config"]["models"][0]
+    entry.update({"layers": 6, "trimmed": True})
+    trimmed = trimmed_path(entry["model"])
+    trimmed.mkdir(parents=True)
+    (trimmed / "config.json").touch()
+
+    # A pruned model built from the full model is not used
+    path = pruned_path(entry["model"], 6)
+    path.mkdir(parents=True)
+    (path / "config.json").touch()
+    create_task_object(config, "en")
+    from_pretrained.assert_called_with(str(trimmed))
+    mod_pl.AutoTokenizer.from_pretrained.assert_called_with(str(trimmed))
+    assert from_pretrained.return_value.config.num_hidden_layers == 6
+
+    # A pruned model built from the trimmed one is used, with its tokenizer
+    path = pruned_path(entry["model"], 6, trimmed=True)
+    path.mkdir(parents=True)
+    (path / "config.json").touch()
+    mod_pl.ENGINE_CACHE.clear()
+    create_task_object(config, "en")
+    from_pretrained.assert_called_with(str(path))
+    mod_pl.AutoTokenizer.from_pretrained.assert_called_with(str(path))
+
+
+def test42_pipeline_format(monkeypatch):
+    """
+    Check layer pruning is rejected for converted models
+    """
+    patch_transformer_pipeline(monkeypatch, [], ["LOC", "PER"])
+    patch_env(monkeypatch)
+    config = load_plugin_config()
+    config["task_config"]["models"][0].update({"layers": 6, "format": "onnx"})
+    with pytest.raises(ConfigException):
+        create_task_object(config, "en")
@@ -0,0 +1,96 @@
+"""
+Test background pipeline loading
+"""
+
+from threading import Event
+
+import pytest
+
+from pii_data.helper.exception import ProcException, ConfigException
+from pii_data.types.doc import DocumentChunk
+
+from pii_extract_plg_transformers.plugin_loader import load_plugin_config
+from pii_extract_plg_transformers.app.detect import create_task_object
+from pii_extract_plg_transformers.task.loader import PipelineLoader
+
+from taux.monkey_patch import patch_transformer_pipeline, patch_env
+
+
+RESULTS = [{"start": 0, "end": 11, "entity_group": "PER", "score": 0.85}]
+
+
+def test10_loader_order():
+    """
+    Check a language waited for is loaded first
+    """
+    order = []
+
+    def load(langs):
+        order.extend(langs)
+        if langs[0] == "fr":
+            raise ConfigException("bad model")
+        return {langs[0]: f"pp-{langs[0]}"}
+
+    loader = PipelineLoader(load, ["de", "en", "fr"])
+    assert not loader.ready("en")
+    with pytest.raises(ProcException):
+        loader.wait("en", timeout=0.01)
+    loader.start()
+
+    assert loader.wait("en") == "pp-en"
+    assert loader.wait("de", timeout=5) == "pp-de"
+    with pytest.raises(ConfigException):
+        loader.wait("fr", timeout=5)
+    assert order == ["en", "de", "fr"]
+    assert loader.ready("en")
+    assert not loader.ready()
+    assert loader.get_stats()["fr"]["status"] == "error"
+
+
+def test11_loader_close():
+    """
+    Check closing a loader cancels the pending loads
+    """
+    gate = Event()
+
+    def load(langs):
+        gate.wait(5)
+        return {langs[0]: f"pp-{langs[0]}"}
+
+    loader = PipelineLoader(load, ["de", "en", "fr"]).start()
+    loaded = loader.close()
+    gate.set()
+    assert loaded == {}
+    with pytest.raises(ProcException):
+        loader.wait("fr", timeout=5)
+    assert loader.get_stats()["en"]["status"] == "cancelled"
+    loader._thread.join(5)
+    assert not loader._thread.is_alive()
+    assert loader.get_stats()["de"]["status"] == "ready"
+
+
+def test20_task(monkeypatch):
+    """
+    Check task construction does not wait for model loading
+    """
+    mck = patch_transformer_pipeline(monkeypatch, RESULTS, ["LOC", "PER"])
+    patch_env(monkeypatch)
+    gate = Event()
+    pp = mck.return_value
+    mck.side_effect = lambda *args, **kwargs: gate.wait(5) and pp
+
+    config = load_plugin_config()
+    config["task_config"]["async_load"] = {"timeout": 0.05}
+    task = create_task_object(config, "en")
+    assert not task.ready()
+
+    chunk = DocumentChunk("1", "Alan Turing was born in England")
+    with pytest.raises(ProcException):
+        list(task.find(chunk))
+
+    gate.set()
+    got = list(task.find(chunk))
+    assert [p.fields["value"] for p in got] == ["Alan Turing"]
+    assert task.ready()
+    assert task.ready("en")
+    assert task.get_stats()["loader"]["en"]["status"] == "ready"
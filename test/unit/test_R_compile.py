@@ -0,0 +1,103 @@
+"""
+Test model compilation options
+"""
+
+from unittest.mock import Mock
+
+from pii_extract_plg_transformers.plugin_loader import load_plugin_config
+from pii_extract_plg_transformers.app.detect import create_task_object
+from pii_extract_plg_transformers.model.compile import choose_bucket, \
+    compiled_path, compile_stats, compile_key, CompiledForward
+import pii_extract_plg_transformers.model.compile as mod_compile
+import pii_extract_plg_transformers.task.pipeline as mod_pl
+
+from taux.monkey_patch import patch_transformer_pipeline, patch_env
+
+
+def test10_bucket():
+    """
+    Check bucket selection
+    """
+    buckets = [64, 128, 256]
+    assert choose_bucket(10, buckets) == 64
+    assert choose_bucket(64, buckets) == 64
+    assert choose_bucket(65, buckets) == 128
+    assert choose_bucket(300, buckets) is None
+    assert choose_bucket(10, []) is None
+
+
+def test20_path(monkeypatch, tmp_path):
+    """
+    Check the artifact folder depends on the model variant
+    """
+    patch_env(monkeypatch)
+    monkeypatch.setenv("HUGGINGFACE_HUB_CACHE", str(tmp_path))
+    p1 = compiled_path("org/model", "org/model/org/model")
+    p2 = compiled_path("org/model", "org/model/org/model/layers=6")
+    assert p1 != p2
+    assert p1 == compiled_path("org/model", "org/model/org/model")
+    assert p1.parent == tmp_path / "piisa" / "compiled"
+    assert p1.name.startswith("org--model-")
+
+
+def test30_stats():
+    """
+    Check compile stats are found only for compiled models
+    """
+    model = Mock()
+    assert compile_stats(model) is None
+    fwd = CompiledForward(None, ("input_ids",), 0)
+    fwd.compiled[64] = None
+    fwd.compile_time[64] = 1.5
+    model.forward = fwd
+    got = compile_stats(model)
+    assert got["buckets"] == [64]
+    assert got["compile_time_total"] == 1.5
+
+
+def test35_key():
+    """
+    Check the canonical form of the compile options
+    """
+    assert compile_key(True) == "trace:64,128,256,512"
+    assert compile_key({}) == compile_key(True)
+    assert compile_key({"buckets": [256, 64]}) == "trace:64,256"
+    assert compile_key({"buckets": [64, 256], "method": "trace"}) == \
+        compile_key({"buckets": [256, 64]})
+    assert compile_key({"method": "compile", "buckets": [64]}) == \
+        "compile:64"
+
+
+def test40_pipeline(monkeypatch):
+    """
+    Check the compile option in pipeline creation
+    """
+    patch_transformer_pipeline(monkeypatch, [], ["LOC", "PER"])
+    patch_env(monkeypatch)
+    cmp = Mock()
+    monkeypatch.setattr(mod_compile, "compile_model", cmp)
+    config = load_plugin_config()
+    config["task_config"]["models"][0]["compile"] = {"buckets": [128]}
+
+    create_task_object(config, "en")
+    assert cmp.call_count == 1
+    args = cmp.call_args.args
+    assert args[2] == "Babelscape/wikineural-multilingual-ner"
+    assert args[3].endswith("/compiled=trace:128")
+    assert args[4] == {"buckets": [128]}
+
+    # The compiled model is reused from the engine cache
+    create_task_object(config, "en")
+    assert cmp.call_count == 1
+
+    # Non-compiled models do not share it
+    create_task_object(config, "es")
+    assert cmp.call_count == 1
+    assert mod_pl.ENGINE_CACHE.get_stats()["models"] == 2
+
+    # Different compile options do not share the compiled model
+    config["task_config"]["models"][0]["compile"] = {"buckets": [64, 128]}
+    create_task_object(config, "en")
+    assert cmp.call_count == 2
+    assert cmp.call_args.args[3].endswith("/compiled=trace:64,128")
+    assert mod_pl.ENGINE_CACHE.get_stats()["models"] == 3
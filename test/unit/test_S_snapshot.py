@@ -0,0 +1,139 @@
+"""
+Test model snapshots
+"""
+
+import os
+from unittest.mock import Mock
+
+import pytest
+
+from pii_extract_plg_transformers.plugin_loader import load_plugin_config
+from pii_extract_plg_transformers.app.detect import create_task_object
+from pii_extract_plg_transformers.model.snapshot import snapshot_path, \
+    model_revision, _trusted
+import pii_extract_plg_transformers.model.snapshot as mod_snap
+import pii_extract_plg_transformers.task.pipeline as mod_pl
+
+from taux.monkey_patch import patch_transformer_pipeline, patch_env
+
+
+def _config(tmp_path):
+    config = load_plugin_config()
+    config["task_config"]["cachedir"] = str(tmp_path)
+    config["task_config"]["models"][0]["snapshot"] = True
+    return config
+
+
+def test10_write(monkeypatch, tmp_path):
+    """
+    Check a snapshot is written after a normal load
+    """
+    patch_transformer_pipeline(monkeypatch, [], ["LOC", "PER"])
+    patch_env(monkeypatch)
+    read, write = Mock(), Mock()
+    monkeypatch.setattr(mod_snap, "read_snapshot", read)
+    monkeypatch.setattr(mod_snap, "write_snapshot", write)
+    monkeypatch.setattr(mod_snap, "source_revision", Mock(return_value="r1"))
+
+    create_task_object(_config(tmp_path), "en")
+    assert read.call_count == 0
+    assert write.call_count == 1
+    path, tok, model, key, revision = write.call_args.args
+    assert revision == "r1"
+    assert path == snapshot_path("Babelscape/wikineural-multilingual-ner", key)
+    assert path.parent == tmp_path / "piisa" / "snapshots"
+    assert path.suffix == ".pt"
+    assert model is mod_pl.AutoModelForTokenClassification.from_pretrained.return_value
+
+
+def test20_restore(monkeypatch, tmp_path):
+    """
+    Check a model is restored from its snapshot
+    """
+    mck = patch_transformer_pipeline(monkeypatch, [], ["LOC", "PER"])
+    patch_env(monkeypatch)
+    tok, model = Mock(), Mock()
+    read = Mock(return_value=(tok, model))
+    write = Mock()
+    monkeypatch.setattr(mod_snap, "read_snapshot", read)
+    monkeypatch.setattr(mod_snap, "write_snapshot", write)
+    monkeypatch.setattr(mod_snap, "source_revision", Mock(return_value="r1"))
+
+    config = _config(tmp_path)
+    key = "Babelscape/wikineural-multilingual-ner/Babelscape/wikineural-multilingual-ner"
+    create_task_object(config, "en")
+    path = write.call_args.args[0]
+    path.parent.mkdir(parents=True)
+    path.touch()
+
+    mod_pl.ENGINE_CACHE.clear()
+    mod_pl.AutoModelForTokenClassification.from_pretrained.reset_mock()
+    create_task_object(config, "en")
+    assert read.call_args.args[:3] == (path, key, "r1")
+    assert mod_pl.AutoModelForTokenClassification.from_pretrained.call_count == 0
+    assert write.call_count == 1
+    assert mck.call_args.kwargs["model"] is model
+    assert mck.call_args.kwargs["tokenizer"] is tok
+
+
+def test30_refresh(monkeypatch, tmp_path):
+    """
+    Check a reload with refresh does not restore the snapshot, but rewrites it
+    """
+    patch_transformer_pipeline(monkeypatch, [], ["LOC", "PER"])
+    patch_env(monkeypatch)
+    read, write = Mock(return_value=(Mock(), Mock())), Mock()
+    monkeypatch.setattr(mod_snap, "read_snapshot", read)
+    monkeypatch.setattr(mod_snap, "write_snapshot", write)
+    monkeypatch.setattr(mod_snap, "source_revision", Mock(return_value="r1"))
+
+    task = create_task_object(_config(tmp_path), "en")
+    path = write.call_args.args[0]
+    path.parent.mkdir(parents=True)
+    path.touch()
+    assert task.reload(wait=True)
+    assert read.call_count == 0
+    assert write.call_count == 2
+
+
+def test40_revision(tmp_path):
+    """
+    Check the revision of a local model changes with its files
+    """
+    (tmp_path / "config.json").write_text('{"a": 1}')
+    (tmp_path / "model.bin").write_bytes(b"1234")
+    rev = model_revision(str(tmp_path))
+    assert rev.startswith("local:")
+    assert model_revision(str(tmp_path)) == rev
+    (tmp_path / "model.bin").write_bytes(b"12345")
+    assert model_revision(str(tmp_path)) != rev
+
+    os.chmod(tmp_path / "model.bin", 0o644)
+    assert _trusted(tmp_path / "model.bin")
+    os.chmod(tmp_path / "model.bin", 0o666)
+    assert not _trusted(tmp_path / "model.bin")
+
+
+def test50_hub_revision(monkeypatch):
+    """
+    Check the Hub is queried for the model revision only if so configured
+    """
+    hub = pytest.importorskip("huggingface_hub")
+    api = Mock()
+    api.return_value.model_info.return_value.sha = "remote"
+    monkeypatch.setattr(hub, "HfApi", api)
+    monkeypatch.setattr(hub, "try_to_load_from_cache",
+                        Mock(return_value="/cache/snapshots/local/config.json"))
+    for v in mod_snap.ENV_OFFLINE:
+        monkeypatch.delenv(v, raising=False)
+
+    assert model_revision("org/model") == "local"
+    assert api.call_count == 0
+
+    assert model_revision("org/model", hub_timeout=2) == "remote"
+    api.return_value.model_info.assert_called_once_with(
+        "org/model", revision=None, timeout=2)
+
+    # An unreachable Hub falls back to the local cache
+    api.return_value.model_info.side_effect = OSError("timeout")
+    assert model_revision("org/model", hub_timeout=2) == "local"
@@ -0,0 +1,106 @@
+"""
+Test the execution settings
+"""
+
+from unittest.mock import Mock
+
+import pytest
+
+from pii_data.helper.exception import ConfigException
+
+from pii_extract_plg_transformers.plugin_loader import load_plugin_config
+from pii_extract_plg_transformers.app.detect import create_task_object
+import pii_extract_plg_transformers.task.execution as mod
+import pii_extract_plg_transformers.task.pipeline as mod_pl
+
+from taux.monkey_patch import patch_transformer_pipeline, patch_env
+
+
+def test10_cpu_set(monkeypatch):
+    """
+    Check the selection of the CPU affinity set
+    """
+    monkeypatch.delenv(mod.ENV_WORKER, raising=False)
+    assert mod.cpu_set({}) is None
+    assert mod.cpu_set({"cpu_affinity": [0, 1]}) == {0, 1}
+
+    sets = {"cpu_affinity": [[0, 1], [2, 3]]}
+    with pytest.raises(ConfigException):
+        mod.cpu_set(sets)
+    assert mod.cpu_set({**sets, "worker_index": 1}) == {2, 3}
+    monkeypatch.setenv(mod.ENV_WORKER, "2")
+    assert mod.cpu_set(sets) == {0, 1}
+    monkeypatch.setenv("MY_WORKER", "1")
+    assert mod.cpu_set({**sets, "worker_env": "MY_WORKER"}) == {2, 3}
+
+
+def test20_apply(monkeypatch):
+    """
+    Check applying the execution settings
+    """
+    monkeypatch.setattr(mod, "_APPLIED", {})
+    monkeypatch.setattr(mod, "torch", Mock())
+    affinity = Mock()
+    monkeypatch.setattr(mod.os, "sched_setaffinity", affinity)
+    monkeypatch.delenv(mod.ENV_TOKENIZERS, raising=False)
+
+    got = mod.apply_execution({"cpu_affinity": [[0, 1], [2, 3]],
+                               "worker_index": 1,
+                               "tokenizer_parallelism": False,
+                               "inter_op_threads": 1})
+    assert got == {"cpu_affinity": [2, 3], "tokenizer_parallelism": False,
+                   "intra_op_threads": 2, "inter_op_threads": 1}
+    affinity.assert_called_once_with(0, {2, 3})
+    mod.torch.set_num_threads.assert_called_once_with(2)
+    mod.torch.set_num_interop_threads.assert_called_once_with(1)
+    assert mod.os.environ[mod.ENV_TOKENIZERS] == "false"
+
+    # Settings already applied are not applied again
+    mod.apply_execution({"inter_op_threads": 1})
+    assert mod.torch.set_num_interop_threads.call_count == 1
+
+    with pytest.raises(ConfigException):
+        mod.apply_execution({"grad_mode": "train"})
+
+
+def test30_pipeline(monkeypatch):
+    """
+    Check the execution settings are applied when creating pipelines
+    """
+    mck = patch_transformer_pipeline(monkeypatch, [], ["LOC", "PER"])
+    patch_env(monkeypatch)
+    monkeypatch.setattr(mod, "_APPLIED", {})
+    monkeypatch.setattr(mod, "torch", Mock())
+    config = load_plugin_config()
+    config["task_config"]["execution"] = {"intra_op_threads": 3,
+                                          "grad_mode": "no_grad"}
+    create_task_object(config, "en")
+    mod.torch.set_num_threads.assert_called_once_with(3)
+    pp = mck.return_value
+    assert pp.get_inference_context() is mod.torch.no_grad
+
+
+def test40_pipeline_cache(monkeypatch):
+    """
+    Check pipelines with different grad modes are cached separately
+    """
+    mck = patch_transformer_pipeline(monkeypatch, [], ["LOC", "PER"])
+    patch_env(monkeypatch)
+    monkeypatch.setattr(mod, "_APPLIED", {})
+    monkeypatch.setattr(mod, "torch", Mock())
+    config = load_plugin_config()
+    config["task_config"]["execution"] = {"grad_mode": "no_grad"}
+    create_task_object(config, "en")
+    assert mck.return_value.get_inference_context() is mod.torch.no_grad
+
+    config["task_config"]["execution"] = {"grad_mode": "inference"}
+    create_task_object(config, "en")
+    assert mck.call_count == 2
+    pp = mck.return_value
+    assert pp.get_inference_context() is mod.torch.inference_mode
+    assert mod_pl.ENGINE_CACHE.get_stats() == {"models": 1, "pipelines": 2,
+                                               "bytes": 0}
+
+    # Same mode: the cached pipeline is reused
+    create_task_object(config, "en")
+    assert mck.call_count == 2
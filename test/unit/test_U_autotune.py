@@ -0,0 +1,91 @@
+"""
+Test automatic tuning of the model settings
+"""
+
+import json
+
+from pii_extract_plg_transformers import defs
+from pii_extract_plg_transformers.plugin_loader import load_plugin_config
+from pii_extract_plg_transformers.model.autotune import autotune, \
+    baseline_entry, model_variants
+import pii_extract_plg_transformers.model.autotune as mod_at
+
+from taux.monkey_patch import patch_transformer_pipeline, patch_env
+
+
+RESULTS = [{"start": 0, "end": 11, "entity_group": "PER", "score": 0.85}]
+
+
+def test10_variants(monkeypatch, tmp_path):
+    """
+    Check the candidate model variants
+    """
+    monkeypatch.setenv("HUGGINGFACE_HUB_CACHE", str(tmp_path))
+    m = {"lang_code": "en", "model": "org/model", "format": "onnx",
+         "model_params": {"torch_dtype": "float16", "dtype": "float16"}}
+    assert baseline_entry(m) == {"lang_code": "en", "model": "org/model"}
+
+    monkeypatch.setattr(mod_at, "transformers_version", lambda: "4.57.1")
+    got = model_variants(m)
+    assert sorted(got) == ["bf16", "compile", "fp32"]
+    assert got["bf16"]["model_params"] == {"torch_dtype": "bfloat16"}
+    assert got["compile"]["compile"] is True
+
+    # Transformers 5 renamed the dtype parameter
+    monkeypatch.setattr(mod_at, "transformers_version", lambda: "5.0.0")
+    got = model_variants(m)
+    assert got["bf16"]["model_params"] == {"dtype": "bfloat16"}
+
+    # Converted versions are used only if available
+    path = tmp_path / "piisa" / "onnx" / "org--model"
+    path.mkdir(parents=True)
+    (path / "config.json").touch()
+    got = model_variants(m, ["onnx", "quantized"])
+    assert got == {"onnx": {"lang_code": "en", "model": "org/model",
+                            "format": "onnx"}}
+
+
+def test20_autotune(monkeypatch, tmp_path):
+    """
+    Check the autotune process & the overlay it produces
+    """
+    patch_transformer_pipeline(monkeypatch, RESULTS, ["LOC", "PER"])
+    patch_env(monkeypatch)
+
+    # Make the timings deterministic: only batch size 2 is faster
+    real_measure = mod_at.measure
+
+    def measure(config, lang, texts, batch_size):
+        r = real_measure(config, lang, texts, batch_size)
+        r["texts_per_sec"] = 100.0 if batch_size == 2 else 10.0
+        return r
+    monkeypatch.setattr(mod_at, "measure", measure)
+
+    config = load_plugin_config()
+    texts = ["Alan Turing was born in England"] * 5
+    overlay, report = autotune(config, "en", texts, variants=["fp32", "bf16"],
+                               batch_sizes=[2], aggregations=["simple"])
+
+    assert [r["candidate"] for r in report] == [
+        "baseline", "variant=bf16", "batch_size=2", "aggregation=simple"]
+    assert all(r["f1"] == 1.0 and r["accepted"] for r in report)
+    assert report[0]["texts"] == 5
+    assert overlay["autotune"]["texts_per_sec"] == 100.0
+    assert overlay["autotune"]["baseline_texts_per_sec"] == 10.0
+
+    # The variant is not faster, the batch size is, the aggregation is not
+    task_config = overlay[defs.CFG_TASK]
+    assert task_config[defs.CFG_TASK_BATCH] == 2
+    models = task_config[defs.CFG_TASK_MODELS]
+    assert models[0] == {**baseline_entry(models[0]), "aggregation": "max"}
+    assert [m["lang_code"] for m in models] == ["en", "es", "fr"]
+    assert models[1] == config[defs.CFG_TASK][defs.CFG_TASK_MODELS][1]
+
+    # The overlay can be merged into the configuration
+    name = tmp_path / "overlay.json"
+    with open(name, "w", encoding="utf-8") as f:
+        json.dump(overlay, f)
+    merged = load_plugin_config([str(name)])
+    assert merged[defs.CFG_TASK][defs.CFG_TASK_MODELS] == models
+    assert merged[defs.CFG_TASK][defs.CFG_TASK_BATCH] == task_config[defs.CFG_TASK_BATCH]
+    assert merged[defs.CFG_MAP] == config[defs.CFG_MAP]
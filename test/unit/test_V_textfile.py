@@ -0,0 +1,107 @@
+"""
+Test splitting & processing large text files
+"""
+
+import json
+import re
+
+from pii_extract_plg_transformers.task.textfile import split_points, text_file_chunks
+from pii_extract_plg_transformers.app.detect import process
+
+from taux.monkey_patch import patch_transformer_pipeline, patch_env
+
+
+TEXT = """First paragraph, with Alan Turing in it.
+
+Second paragraph. It is quite a bit longer than the first one, and it will need to be split into several chunks. Ada Lovelace appears here.
+
+
+Überraschung: ein Absatz mit Umlauten, für Alan Turing.
+"""
+
+
+def _check_chunks(filename, text: str, max_bytes: int):
+    chunks = []
+    for c in text_file_chunks(filename, "en", max_bytes=max_bytes):
+        start = c.context["offset"]
+        assert text[start:start+len(c.data)] == c.data
+        assert c.context["lang"] == "en"
+        chunks.append(c)
+    return chunks
+
+
+def test10_split_points():
+    """
+    Check the split points of a buffer
+    """
+    buf = "aa bb\n\ncc dd ee\nff".encode("utf-8")
+    got = list(split_points(buf, 8))
+    assert got == [(0, 5, 7), (7, 15, 16), (16, 18, 18)]
+
+    # No whitespace: cut at a character boundary
+    buf = ("x" + "é"*5).encode("utf-8")
+    got = list(split_points(buf, 4))
+    assert got == [(0, 3, 3), (3, 7, 7), (7, 11, 11)]
+    for start, end, _ in got:
+        buf[start:end].decode("utf-8")
+
+
+def test20_chunks(tmp_path):
+    """
+    Check chunk texts & offsets
+    """
+    infile = tmp_path / "doc.txt"
+    infile.write_text(TEXT, encoding="utf-8")
+
+    chunks = _check_chunks(infile, TEXT, 2000)
+    assert len(chunks) == 3
+    assert chunks[2].data.startswith("\nÜberraschung")
+
+    chunks = _check_chunks(infile, TEXT, 40)
+    assert len(chunks) > 3
+    assert all(len(c.data.encode("utf-8")) <= 40 for c in chunks)
+    assert [c.id for c in chunks] == [str(n+1) for n in range(len(chunks))]
+
+
+def test21_chunks_empty(tmp_path):
+    """
+    Check an empty file
+    """
+    f = tmp_path / "empty.txt"
+    f.touch()
+    assert list(text_file_chunks(f)) == []
+
+
+def test30_detect_file(monkeypatch, tmp_path):
+    """
+    Check processing a text file, with positions relative to the file
+    """
+    mck = patch_transformer_pipeline(monkeypatch, [], ["LOC", "PER"])
+    patch_env(monkeypatch)
+
+    def call(data, **kwargs):
+        def find(text):
+            return [{"start": m.start(), "end": m.end(),
+                     "entity_group": "PER", "score": 0.9}
+                    for m in re.finditer(r"Alan Turing|Ada Lovelace", text)]
+        return [find(t) for t in data] if isinstance(data, list) else find(data)
+    mck.return_value.side_effect = call
+
+    infile = tmp_path / "doc.txt"
+    infile.write_text(TEXT, encoding="utf-8")
+    outfile = tmp_path / "out.jsonl"
+    process(input_file=str(infile), outfile=str(outfile), lang="en",
+            chunk_size=80, batch_size=4)
+
+    with open(outfile, encoding="utf-8") as f:
+        lines = [json.loads(r) for r in f]
+    hdr, pii = lines[0], lines[1:]
+    assert hdr["lang"] == "en"
+    assert list(hdr["detectors"]) == ["1"]
+    assert [p["value"] for p in pii] == ["Alan Turing", "Ada Lovelace",
+                                         "Alan Turing"]
+    for p in pii:
+        assert TEXT[p["start"]:p["end"]] == p["value"]
+        assert p["chunkid"] == "1"
+        assert p["docid"] == str(infile)
+        assert p["detector"] == 1
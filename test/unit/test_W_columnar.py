@@ -0,0 +1,98 @@
+"""
+Test columnar detection results
+"""
+
+import pytest
+
+from pii_data.types.doc import DocumentChunk
+
+from pii_extract_plg_transformers.plugin_loader import load_plugin_config
+from pii_extract_plg_transformers.app.detect import create_task_object, process
+
+from taux.monkey_patch import patch_task, patch_transformer_pipeline, patch_env
+
+
+TEXT = "Alan Turing. considered the father of AI, was born in England"
+
+RESULTS = [{"start": 53, "end": 61, "entity_group": "LOC", "score": 0.85},
+           {"start": 0, "end": 11, "entity_group": "PER", "score": 0.75}]
+
+
+def test10_columns(monkeypatch):
+    """
+    Check columnar results against entity objects
+    """
+    task, _, _ = patch_task(monkeypatch, RESULTS)
+    chunks = [DocumentChunk(str(n), TEXT, {"lang": "en"}) for n in range(5)]
+
+    got = list(task.find_columns(chunks, batch_size=2))
+    assert [len(r) for r in got] == [4, 4, 2]
+    assert list(got[1].chunk) == [2, 2, 3, 3]
+
+    exp = [p for _, pii_list in task.find_chunks(chunks, 2) for p in pii_list]
+    rows = [row for r in got for row in r.rows()]
+    assert len(rows) == len(exp)
+    for (chunk, start, end, info, lang, score), pii in zip(rows, exp):
+        assert TEXT[start:end] == pii.fields["value"]
+        assert start == pii.pos
+        assert info == pii.info
+        assert lang == "en"
+        assert score == pytest.approx(pii.fields["process"]["score"])
+
+    types = task.entity_types()
+    assert got[0].types == types
+    assert types[got[0].type[0]].pii.name == "PERSON"
+    # whitespace removed from the entity
+    assert TEXT[got[0].start[1]:got[0].end[1]] == "England"
+
+
+def test15_context(monkeypatch):
+    """
+    Check columnar results apply the entity context
+    """
+    patch_transformer_pipeline(monkeypatch, RESULTS, ["LOC", "PER"])
+    patch_env(monkeypatch)
+    config = load_plugin_config()
+    config["pii_list"][1]["context"] = ["born"]
+    task = create_task_object(config, "en")
+    chunks = [DocumentChunk(str(n), t, {"lang": "en"})
+              for n, t in enumerate([TEXT, TEXT.replace("born", "seen")])]
+    res = next(iter(task.find_columns(chunks)))
+    assert list(zip(res.chunk, res.start)) == [(0, 0), (0, 54), (1, 0)]
+
+
+def test20_shift(monkeypatch):
+    """
+    Check shifting positions by chunk offsets
+    """
+    task, _, _ = patch_task(monkeypatch, RESULTS)
+    chunks = [DocumentChunk(str(n), TEXT, {"lang": "en"}) for n in range(2)]
+    res = next(iter(task.find_columns(chunks)))
+    res.shift([0, 100])
+    assert list(res.start) == [0, 54, 100, 154]
+
+
+@pytest.mark.parametrize("fmt", ["arrow", "parquet"])
+def test30_write(monkeypatch, tmp_path, fmt):
+    """
+    Check writing columnar results from the detect script
+    """
+    pa = pytest.importorskip("pyarrow")
+    import pyarrow.ipc
+    import pyarrow.parquet
+    import json
+
+    patch_task(monkeypatch, RESULTS)
+    outfile = tmp_path / f"out.{fmt}"
+    process(input_data=TEXT, outfile=str(outfile), lang="en",
+            output_format=fmt)
+
+    if fmt == "arrow":
+        table = pa.ipc.open_file(str(outfile)).read_all()
+    else:
+        table = pa.parquet.read_table(str(outfile))
+    assert table.column("start").to_pylist() == [0, 54]
+    assert table.column("lang").to_pylist() == ["en", "en"]
+    types = json.loads(table.schema.metadata[b"piisa:entity_types"])
+    assert [types[t]["type"] for t in table.column("type").to_pylist()] == \
+        ["PERSON", "LOCATION"]
@@ -0,0 +1,180 @@
+"""
+Test reloading the pipelines of a live task
+"""
+
+from copy import deepcopy
+from threading import Event, Thread
+from time import sleep
+from unittest.mock import Mock
+
+import pytest
+
+from pii_data.helper.exception import ConfigException
+from pii_data.types.doc import DocumentChunk
+
+import pii_extract_plg_transformers.task.pipeline as mod_pl
+import pii_extract_plg_transformers.task.infer as mod_infer
+from pii_extract_plg_transformers.task.swap import SwapGate
+
+from taux.monkey_patch import patch_task
+
+
+TEXT = "Alan Turing. considered the father of AI, was born in England"
+
+RESULTS_OLD = [{"start": 0, "end": 11, "entity_group": "PER", "score": 0.85}]
+RESULTS_NEW = [{"start": 54, "end": 61, "entity_group": "LOC", "score": 0.85}]
+
+
+def _pipeline(results, gate: Event = None):
+    def call(data, **kwargs):
+        if gate:
+            gate.wait(5)
+        return [results]*len(data) if isinstance(data, list) else results
+    pp = Mock(side_effect=call)
+    pp.model.config.label2id = ["LOC", "PER"]
+    return pp
+
+
+def _task(monkeypatch, gate: Event = None):
+    return patch_task(monkeypatch, RESULTS_OLD,
+                      pipeline=_pipeline(RESULTS_OLD, gate))
+
+
+def _values(task):
+    chunk = DocumentChunk("1", TEXT, {"lang": "en"})
+    return [p.fields["value"] for p in task.find(chunk)]
+
+
+def test10_gate():
+    """
+    Check a swap waits for the passes in use
+    """
+    gate = SwapGate()
+    p1 = gate.enter()
+    done = []
+    t = Thread(target=lambda: done.append(gate.swap(lambda: "swapped")))
+    t.start()
+    t.join(0.05)
+    assert not done
+    p1.leave()
+    p1.leave()
+    t.join(5)
+    assert done[0][0] == "swapped"
+    with gate.enter():
+        assert gate._active == 1
+    assert gate._active == 0
+
+
+def test20_reload(monkeypatch):
+    """
+    Check reloading with a new model
+    """
+    task, config, mck = _task(monkeypatch)
+    assert _values(task) == ["Alan Turing"]
+    old = task.models["en"]
+
+    new = _pipeline(RESULTS_NEW)
+    mck.return_value = new
+    config = deepcopy(config)
+    config["task_config"]["models"][0]["model"] = "new/model"
+    assert task.reload(config, wait=True)
+
+    assert task.models["en"] is new
+    assert _values(task) == ["England"]
+    # the new pipeline was warmed up before the switch
+    assert new.call_count == 2
+    stats = task.get_stats()
+    assert stats["reload"]["count"] == 1
+    assert stats["reload"]["status"] == "done"
+    # the old pipeline was released from the engine cache
+    assert stats["engine_cache"]["pipelines"] == 1
+    assert all(pp is not old for _, pp in mod_pl.ENGINE_CACHE._pipelines.values())
+
+
+def test21_reload_same(monkeypatch):
+    """
+    Check reloading the same config loads the models again
+    """
+    task, config, mck = _task(monkeypatch)
+    new = _pipeline(RESULTS_NEW)
+    mck.return_value = new
+    task.reload(wait=True)
+    assert _values(task) == ["England"]
+    assert task.get_stats()["engine_cache"]["models"] == 1
+
+
+def test30_reload_drain(monkeypatch):
+    """
+    Check the switch waits for the batches in flight
+    """
+    gate = Event()
+    task, config, mck = _task(monkeypatch, gate)
+
+    got = []
+    t = Thread(target=lambda: got.append(_values(task)))
+    t.start()
+    t.join(0.05)
+
+    mck.return_value = _pipeline(RESULTS_NEW)
+    assert task.reload()
+    assert not task.reload()        # already in progress
+    t.join(0.1)
+    assert task.get_stats()["reload"]["status"] == "loading"
+    gate.set()
+    t.join(5)
+    for _ in range(100):
+        if task.get_stats()["reload"]["status"] != "loading":
+            break
+        sleep(0.05)
+
+    assert got == [["Alan Turing"]]
+    assert task.get_stats()["reload"]["status"] == "done"
+    assert task.get_stats()["reload"]["swap_wait"] > 0
+    assert _values(task) == ["England"]
+
+
+def test40_reload_error(monkeypatch):
+    """
+    Check a failed reload keeps the current pipelines
+    """
+    task, config, mck = _task(monkeypatch)
+    old = task.models["en"]
+    mck.side_effect = OSError("model not found")
+    with pytest.raises(ConfigException):
+        task.reload(wait=True)
+    assert task.models["en"] is old
+    assert _values(task) == ["Alan Turing"]
+    stats = task.get_stats()["reload"]
+    assert stats["status"] == "error"
+    assert "model not found" in stats["error"]
+
+
+def test50_reload_pipelined_sentences(monkeypatch):
+    """
+    Check batches finished with the old pipelines after a reload do not
+    leave their results in the sentence cache
+    """
+    old = [{"start": 0, "end": 11, "entity_group": "PER", "score": 0.85}]
+    new = [{"start": 24, "end": 31, "entity_group": "LOC", "score": 0.85}]
+    opt = {"sentences": True, "pipelined": {"queue_size": 1}}
+    task, _, mck = patch_task(monkeypatch, old, task_config=opt,
+                              pipeline=_pipeline(old))
+    monkeypatch.setattr(mod_infer, "encode", lambda pp, texts: texts)
+    monkeypatch.setattr(mod_infer, "forward", lambda pp, enc: len(enc))
+    monkeypatch.setattr(mod_infer, "decode",
+                        lambda pp, texts, enc, lg, **kw: [pp([""])[0]]*lg)
+
+    chunks = [DocumentChunk(str(n), f"Alan Turing was born in England {n}",
+                            {"lang": "en"}) for n in range(8)]
+    it = task.find_batch(chunks, batch_size=1)
+    next(it)
+    sleep(0.1)      # let the stages fill their queues
+
+    mck.return_value = _pipeline(new)
+    assert task.reload(wait=True)
+    rest = [p.fields["value"] for p in it]
+    assert "Alan Turing" in rest    # batches in flight used the old model
+    assert rest[-1] == "England"
+
+    for chunk in chunks:
+        assert [p.fields["value"] for p in task.find(chunk)] == ["England"]
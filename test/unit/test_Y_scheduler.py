@@ -0,0 +1,152 @@
+"""
+Test the batching scheduler with priority lanes
+"""
+
+import gc
+from threading import Event
+
+import pytest
+
+from pii_data.helper.exception import ConfigException, ProcException
+from pii_data.types.doc import DocumentChunk
+
+from pii_extract_plg_transformers.task.scheduler import BatchScheduler
+
+from taux.monkey_patch import patch_task
+
+
+TEXT = "Alan Turing. considered the father of AI, was born in England"
+
+RESULTS = [{"start": 54, "end": 61, "entity_group": "LOC", "score": 0.85},
+           {"start": 0, "end": 11, "entity_group": "PER", "score": 0.85}]
+
+
+def _task(monkeypatch, scheduler=True):
+    task, _, mck = patch_task(monkeypatch, RESULTS,
+                              task_config={"scheduler": scheduler})
+    return task, mck
+
+
+def test10_priority():
+    """
+    Check interactive chunks are served ahead of queued bulk chunks
+    """
+    gate, started = Event(), Event()
+    batches = []
+
+    def process(chunks):
+        started.set()
+        gate.wait(5)
+        batches.append(chunks)
+        return [c.upper() for c in chunks]
+
+    sched = BatchScheduler(process, batch_size=4, interactive_batch=2,
+                           max_wait=0)
+    bulk = [sched.submit("b0", "bulk")]
+    started.wait(5)
+    bulk += [sched.submit(f"b{n}", "bulk") for n in range(1, 10)]
+    inter = [sched.submit(f"i{n}", "interactive") for n in range(2)]
+    gate.set()
+    assert [f.result(5) for f in inter] == ["I0", "I1"]
+    assert [f.result(5) for f in bulk] == [f"B{n}" for n in range(10)]
+
+    # the first bulk batch was taken before the interactive chunks arrived
+    assert batches[0] == ["b0"]
+    assert batches[1] == ["i0", "i1"]
+    assert [len(b) for b in batches[2:]] == [4, 4, 1]
+
+    stats = sched.get_stats()
+    assert stats["interactive"]["chunks"] == 2
+    assert stats["bulk"]["batches"] == 4
+    assert stats["bulk"]["wait_max"] >= stats["bulk"]["wait_p50"] > 0
+    assert stats["interactive"]["queued"] == 0
+
+    with pytest.raises(ConfigException):
+        sched.submit("x", "urgent")
+    sched.close()
+    with pytest.raises(ConfigException):
+        sched.submit("x")
+
+
+def test20_task(monkeypatch):
+    """
+    Check detection through the scheduler
+    """
+    task, _ = _task(monkeypatch)
+    chunks = [DocumentChunk(str(n), TEXT, {"lang": "en"}) for n in range(20)]
+
+    got = [p.fields["value"] for p in task.find(chunks[0])]
+    assert got == ["Alan Turing", "England"]
+
+    got = list(task.find_chunks(chunks))
+    assert [c.id for c, _ in got] == [c.id for c in chunks]
+    assert all(len(r) == 2 for _, r in got)
+
+    fut = task.submit(chunks[0])
+    assert [p.fields["value"] for p in fut.result(5)] == ["Alan Turing", "England"]
+
+    cols = list(task.find_columns(chunks[:10], priority="interactive"))
+    assert sum(len(c) for c in cols) == 20
+    assert cols[-1].chunk[-1] == 9
+
+    stats = task.get_stats()["scheduler"]
+    assert stats["interactive"]["chunks"] == 12
+    assert stats["bulk"]["chunks"] == 20
+    assert stats["bulk"]["batch_size"] == 8
+
+
+def test21_task_priority(monkeypatch):
+    """
+    Check an explicit priority uses the scheduler even if not configured
+    """
+    task, _ = _task(monkeypatch, scheduler=None)
+    chunks = [DocumentChunk(str(n), TEXT, {"lang": "en"}) for n in range(3)]
+    list(task.find_chunks(chunks))
+    assert "scheduler" not in task.get_stats()
+    got = list(task.find_batch(chunks, priority="bulk"))
+    assert len(got) == 6
+    assert task.get_stats()["scheduler"]["bulk"]["chunks"] == 3
+
+
+def test30_task_error(monkeypatch):
+    """
+    Check errors are raised in the caller
+    """
+    task, mck = _task(monkeypatch, {"interactive_batch": 1})
+    mck.return_value.side_effect = RuntimeError("model failure")
+    chunk = DocumentChunk("1", TEXT, {"lang": "en"})
+    with pytest.raises(ProcException):
+        list(task.find(chunk))
+    with pytest.raises(ProcException):
+        list(task.find(DocumentChunk("1", TEXT, {"lang": "xx"})))
+
+
+def test40_close(monkeypatch):
+    """
+    Check the scheduler worker thread stops when the task is closed or
+    discarded
+    """
+    task, _ = _task(monkeypatch)
+    chunk = DocumentChunk("1", TEXT, {"lang": "en"})
+    assert len(task.submit(chunk).result(5)) == 2
+    thread = task._scheduler._thread
+    assert thread.is_alive()
+    task.close()
+    thread.join(5)
+    assert not thread.is_alive()
+
+    # the task is still usable
+    with task:
+        assert len(list(task.find(chunk))) == 2
+        thread = task._scheduler._thread
+    thread.join(5)
+    assert not thread.is_alive()
+
+    # a discarded task stops its worker
+    task, _ = _task(monkeypatch)
+    assert len(list(task.find(chunk))) == 2
+    thread = task._scheduler._thread
+    del task
+    gc.collect()
+    thread.join(5)
+    assert not thread.is_alive()
@@ -0,0 +1,66 @@
+"""
+Test teacher-student distillation
+"""
+
+from pii_extract_plg_transformers.plugin_loader import load_plugin_config
+from pii_extract_plg_transformers.app.detect import create_task_object
+from pii_extract_plg_transformers.model.cache import fetch, local_path, \
+    DISTILL_INFO
+from pii_extract_plg_transformers.model.distill import teacher_labels, \
+    bio_labels, student_name, entity_labels, _results, _task_config
+from pii_extract_plg_transformers.model.utils import agreement
+
+from taux.monkey_patch import patch_transformer_pipeline, patch_env
+
+
+TEXT = "Alan Turing. considered the father of AI, was born in England"
+
+RESULTS = [{"start": 53, "end": 61, "entity_group": "LOC", "score": 0.85},
+           {"start": 0, "end": 11, "entity_group": "PER", "score": 0.85},
+           {"start": 28, "end": 34, "entity_group": "MISC", "score": 0.85}]
+
+
+def test10_labels():
+    """
+    Check student labels & names
+    """
+    assert bio_labels(["PER", "LOC", "PER"]) == \
+        {0: "O", 1: "B-LOC", 2: "I-LOC", 3: "B-PER", 4: "I-PER"}
+    assert student_name("org/model", "en", 4) == "org/model-student-en-L4"
+    assert student_name("org/model", "en") == "org/model-student-en"
+
+
+def test20_teacher(monkeypatch):
+    """
+    Check labeling a corpus with the teacher task
+    """
+    patch_transformer_pipeline(monkeypatch, RESULTS, ["LOC", "PER", "MISC"])
+    patch_env(monkeypatch)
+    config = load_plugin_config()
+    task = create_task_object(config, "en")
+
+    assert sorted(entity_labels(task, "en").values()) == ["LOC", "PER"]
+    samples = teacher_labels(task, "en", [TEXT, TEXT], batch_size=2)
+    assert len(samples) == 2
+    assert samples[0] == (TEXT, [{"start": 0, "end": 11, "label": "PER"},
+                                 {"start": 54, "end": 61, "label": "LOC"}])
+
+    res = _results(samples)
+    assert agreement(res, res)["f1"] == 1.0
+    assert agreement(res, [r[:1] for r in res], ["LOC"])["recall"] == 0.0
+
+    cfg = _task_config(config, "en", {"lang_code": "en", "model": "student"})
+    models = cfg["task_config"]["models"]
+    assert [m["model"] for m in models if m["lang_code"] == "en"] == ["student"]
+    assert config["task_config"]["models"][0]["model"] != "student"
+
+
+def test30_fetch(monkeypatch, tmp_path):
+    """
+    Check a distilled model is not fetched from the Hub
+    """
+    monkeypatch.setenv("HUGGINGFACE_HUB_CACHE", str(tmp_path))
+    path = local_path("org/model-student-en")
+    path.mkdir(parents=True)
+    (path / DISTILL_INFO).write_text("{}")
+    assert fetch("org/model-student-en") == (path, False)